@@ -0,0 +1,81 @@
+"""Measure Reed-Solomon encode/decode throughput and storage overhead.
+
+Encodes groups of random pieces with each k+m configuration and decodes
+them with m data pieces lost (the worst case: every lost piece has to be
+rebuilt from parity). Throughput is reported in MB/s of file data. Each
+configuration is compared with plain replication: stored bytes per file
+byte and how many node losses a piece survives.
+
+    python bench_erasure.py --configs 4+2 6+3 10+4 --replicas 2 3
+"""
+
+import argparse
+import json
+import os
+import time
+
+from erasure import ErasureCoder
+
+
+def run(k, m, piece_size, groups):
+    coder = ErasureCoder(k, m)
+    data = [[os.urandom(piece_size) for _ in range(k)] for _ in range(groups)]
+
+    start = time.perf_counter()
+    parity = [coder.encode(group) for group in data]
+    encode_elapsed = time.perf_counter() - start
+
+    # Lose the first m data pieces of every group
+    lost = set(range(min(m, k)))
+    start = time.perf_counter()
+    for group, group_parity in zip(data, parity):
+        shards = {j: piece for j, piece in enumerate(group) if j not in lost}
+        shards.update({k + j: piece for j, piece in enumerate(group_parity)})
+        assert coder.decode(shards) == group
+    decode_elapsed = time.perf_counter() - start
+
+    total = k * piece_size * groups
+    return {
+        "scheme": f"rs {k}+{m}",
+        "overhead": (k + m) / k,
+        "survives_losses": m,
+        "encode_mb_per_s": total / encode_elapsed / 1e6,
+        "decode_mb_per_s": total / decode_elapsed / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--configs", nargs="+", default=["4+2", "6+3", "10+4"])
+    parser.add_argument("--replicas", type=int, nargs="+", default=[2, 3])
+    parser.add_argument("--piece-size", type=int, default=1024 * 1024)
+    parser.add_argument("--groups", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+
+    results = [
+        {"scheme": f"replication x{r}", "overhead": float(r), "survives_losses": r - 1}
+        for r in args.replicas
+    ]
+    for config in args.configs:
+        k, m = map(int, config.split("+"))
+        results.append(run(k, m, args.piece_size, args.groups))
+
+    if args.json:
+        print(json.dumps({"args": vars(args), "results": results}, indent=2))
+        return
+    print(
+        f"{'scheme':>16} {'overhead':>9} {'survives':>9} {'encode MB/s':>12} "
+        f"{'decode MB/s':>12}"
+    )
+    for r in results:
+        encode = f"{r['encode_mb_per_s']:.0f}" if "encode_mb_per_s" in r else "-"
+        decode = f"{r['decode_mb_per_s']:.0f}" if "decode_mb_per_s" in r else "-"
+        print(
+            f"{r['scheme']:>16} {r['overhead']:>8.2f}x {r['survives_losses']:>9} "
+            f"{encode:>12} {decode:>12}"
+        )
+
+
+if __name__ == "__main__":
+    main()
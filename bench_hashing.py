@@ -0,0 +1,63 @@
+"""Measure piece verification throughput against the number of hash workers.
+
+Hashes the same set of in-memory pieces on verification pools of increasing
+size and reports MB/s and speedup over one worker. hashlib releases the GIL
+for large buffers, so throughput should scale with cores up to memory
+bandwidth.
+
+    python bench_hashing.py --pieces 256 --workers 1 2 4 8
+"""
+
+import argparse
+import json
+import os
+import time
+
+from function import generate_piece_hash
+from verify import PieceVerifier, create_hash_executor
+
+
+def run(pieces, piece_hashes, workers):
+    executor = create_hash_executor(workers)
+    verifier = PieceVerifier(piece_hashes, executor)
+    start = time.perf_counter()
+    futures = [verifier.submit(i, piece) for i, piece in enumerate(pieces)]
+    assert all(future.result() for future in futures)
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    total = sum(len(piece) for piece in pieces)
+    return {"workers": workers, "seconds": elapsed, "mb_per_s": total / elapsed / 1e6}
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pieces", type=int, default=256)
+    parser.add_argument("--piece-size", type=int, default=1024 * 1024)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, cores, cores * 2}),
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+
+    pieces = [os.urandom(args.piece_size) for _ in range(args.pieces)]
+    piece_hashes = [generate_piece_hash(piece) for piece in pieces]
+    results = [run(pieces, piece_hashes, workers) for workers in args.workers]
+    baseline = results[0]["mb_per_s"]
+    for r in results:
+        r["speedup"] = r["mb_per_s"] / baseline
+
+    if args.json:
+        print(json.dumps({"cores": cores, "results": results}, indent=2))
+        return
+    print(f"cores: {cores}")
+    print(f"{'workers':>8} {'MB/s':>10} {'speedup':>8}")
+    for r in results:
+        print(f"{r['workers']:>8} {r['mb_per_s']:>10.0f} {r['speedup']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Simulate replica placement strategies: load balance and data movement.
+
+Places every piece of a set of files on a simulated cluster with each
+strategy, then reports how evenly replicas are spread (max/mean and
+coefficient of variation of replicas per node) and which fraction of
+replicas must move when one node joins and when one node leaves. The
+weighted strategy is run on nodes with uneven capacities and reports how
+closely each node's share follows its capacity.
+
+    python bench_placement.py --nodes 50 --pieces 20000 --replicas 2
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from placement import create_placement
+
+
+def assign(placement, pieces, node_ids):
+    return {
+        (key, index): placement.place(key, index, node_ids) for key, index in pieces
+    }
+
+
+def balance(assignment, node_ids):
+    counts = dict.fromkeys(node_ids, 0)
+    for targets in assignment.values():
+        for node_id in targets:
+            counts[node_id] += 1
+    values = list(counts.values())
+    mean = statistics.mean(values)
+    return counts, {
+        "max_over_mean": max(values) / mean,
+        "cv": statistics.pstdev(values) / mean,
+    }
+
+
+def moved(before, after):
+    # Fraction of replicas that are on a node that did not hold them before
+    total = sum(len(targets) for targets in before.values())
+    changed = sum(
+        len(set(after[piece]) - set(targets)) for piece, targets in before.items()
+    )
+    return changed / total
+
+
+def run(strategy, args, node_ids, weights=None):
+    options = {"weights": weights} if weights else {}
+    if strategy == "consistent_hash":
+        options["vnodes"] = args.vnodes
+    placement = create_placement(strategy, args.replicas, **options)
+
+    rng = random.Random(args.seed)
+    pieces = [
+        (f"{rng.getrandbits(160):040x}", index)
+        for _ in range(args.files)
+        for index in range(args.pieces // args.files)
+    ]
+
+    start = time.perf_counter()
+    base = assign(placement, pieces, node_ids)
+    elapsed = time.perf_counter() - start
+    counts, result = balance(base, node_ids)
+
+    joined = node_ids + [f"new{len(node_ids)}"]
+    result["moved_on_join"] = moved(base, assign(placement, pieces, joined))
+    left = node_ids[1:]
+    result["moved_on_leave"] = moved(base, assign(placement, pieces, left))
+    result["placements_per_s"] = len(pieces) / elapsed
+
+    if weights:
+        total_weight = sum(weights.values())
+        total_replicas = sum(counts.values())
+        errors = [
+            abs(counts[n] / total_replicas - weights[n] / total_weight)
+            / (weights[n] / total_weight)
+            for n in node_ids
+        ]
+        result["share_error_mean"] = statistics.mean(errors)
+    return {"strategy": strategy, **result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--pieces", type=int, default=20000)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--vnodes", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+
+    node_ids = [str(i) for i in range(1, args.nodes + 1)]
+    rng = random.Random(args.seed)
+    weights = {node_id: rng.choice([1, 2, 4, 8]) for node_id in node_ids}
+    results = [
+        run("round_robin", args, node_ids),
+        run("consistent_hash", args, node_ids),
+        run("weighted", args, node_ids),
+        dict(run("weighted", args, node_ids, weights), strategy="weighted (uneven)"),
+    ]
+
+    if args.json:
+        print(json.dumps({"args": vars(args), "results": results}, indent=2))
+        return
+    print(
+        f"{'strategy':>18} {'max/mean':>9} {'cv':>6} {'join':>7} {'leave':>7} "
+        f"{'place/s':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['strategy']:>18} {r['max_over_mean']:>9.2f} {r['cv']:>6.3f} "
+            f"{r['moved_on_join']:>7.1%} {r['moved_on_leave']:>7.1%} "
+            f"{r['placements_per_s']:>9.0f}"
+        )
+        if "share_error_mean" in r:
+            print(
+                f"{'':>18} mean error of share vs capacity: {r['share_error_mean']:.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compare the legacy JSON + hex piece encoding with binary framing.
+
+Each round trip pushes one piece through a local socket pair: the sender
+encodes it and writes it, the receiver reads and decodes it. The report shows
+bytes on the wire and CPU time (all threads) per piece.
+
+    python bench_protocol.py --pieces 200 --piece-size 1048576
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from protocol import (
+    CMD_UPLOAD_PIECE,
+    FORMAT,
+    HEADER_SIZE,
+    recv_frame,
+    recv_json,
+    send_frame,
+)
+
+FILE_HASH = "0" * 40
+
+
+def json_round_trip(sender, receiver, piece, index):
+    data = {
+        "command": "upload_piece",
+        "node_id": 1,
+        "file_hash": FILE_HASH,
+        "piece_index": index,
+        "piece_data": piece.hex(),
+    }
+    message = json.dumps(data).encode(FORMAT)
+    result = {}
+
+    def receive():
+        request = recv_json(receiver)
+        result["piece"] = bytes.fromhex(request["piece_data"])
+
+    reader = threading.Thread(target=receive)
+    reader.start()
+    sender.sendall(message)
+    reader.join()
+    assert result["piece"] == piece
+    return len(message)
+
+
+def binary_round_trip(sender, receiver, piece, index):
+    result = {}
+
+    def receive():
+        result["frame"] = recv_frame(receiver)
+
+    reader = threading.Thread(target=receive)
+    reader.start()
+    send_frame(sender, CMD_UPLOAD_PIECE, FILE_HASH, index, piece)
+    reader.join()
+    assert result["frame"].payload == piece
+    return HEADER_SIZE + len(piece)
+
+
+def run(name, round_trip, pieces, piece_size):
+    sender, receiver = socket.socketpair()
+    piece = os.urandom(piece_size)
+    wire_bytes = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for index in range(pieces):
+        wire_bytes += round_trip(sender, receiver, piece, index)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    sender.close()
+    receiver.close()
+    return {
+        "encoding": name,
+        "bytes_per_piece": wire_bytes / pieces,
+        "overhead": wire_bytes / (pieces * piece_size),
+        "cpu_ms_per_piece": cpu * 1000 / pieces,
+        "throughput_mb_s": pieces * piece_size / wall / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pieces", type=int, default=100)
+    parser.add_argument("--piece-size", type=int, default=1024 * 1024)
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+
+    results = [
+        run("json+hex", json_round_trip, args.pieces, args.piece_size),
+        run("binary", binary_round_trip, args.pieces, args.piece_size),
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(
+        f"{'encoding':<10} {'bytes/piece':>12} {'overhead':>9} {'cpu ms/piece':>13} {'MB/s':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['encoding']:<10} {r['bytes_per_piece']:>12.0f} {r['overhead']:>8.3f}x "
+            f"{r['cpu_ms_per_piece']:>13.3f} {r['throughput_mb_s']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
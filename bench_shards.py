@@ -0,0 +1,229 @@
+"""Measure how tracker request throughput scales with the number of shards.
+
+For each shard count a fresh cluster from shards.py is started (a membership
+service plus the file shards, each in its own process), nodes are registered
+and files recorded on their owning shards. Asyncio clients spread over
+several load-generator processes then resolve random files, routing each
+request to its shard as nodes do. Reports requests/sec and p50/p99 latency.
+
+    python bench_shards.py --shards 1 2 4 --concurrency 200 --duration 5
+
+Throughput can only scale with the shard count while there are spare cores
+for the shard processes and the load generators.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+from bench_tracker import free_port, percentile, raise_file_limit
+from protocol import MESSAGE_HEADER, encode_message, recv_message, send_message
+from shards import shard_index, start_cluster
+
+HOST = "127.0.0.1"
+
+
+def free_ports(count):
+    # The first of `count` consecutive free ports
+    while True:
+        base = free_port()
+        try:
+            for port in range(base, base + count):
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.bind((HOST, port))
+            return base
+        except OSError:
+            continue
+
+
+def request(address, data):
+    deadline = time.time() + 10
+    while True:
+        try:
+            with socket.create_connection(address) as s:
+                send_message(s, data)
+                return recv_message(s)
+        except OSError:
+            if time.time() > deadline:
+                raise RuntimeError(f"Tracker at {address} did not start")
+            time.sleep(0.1)
+
+
+def populate(port, shards, nodes, files, pieces):
+    # Register nodes with the membership service and record every file on
+    # its shard, spread round-robin over the nodes
+    node_ids = []
+    for i in range(nodes):
+        response = request(
+            (HOST, port),
+            {"command": "register", "ip_address": HOST, "port": 10000 + i},
+        )
+        node_ids.append(response["node_id"])
+    for i in range(files):
+        file_name = f"file{i}"
+        request(
+            shards[shard_index(file_name, len(shards))],
+            {
+                "command": "upload",
+                "node_id": node_ids[0],
+                "file_name": file_name,
+                "file_hash": f"{i:064x}",
+                "magnet_link": f"magnet:?xt=urn:btih:{i:064x}",
+                "total_pieces": pieces,
+                "piece_distribution": {
+                    str(p): [node_ids[(i + p) % nodes], node_ids[(i + p + 1) % nodes]]
+                    for p in range(pieces)
+                },
+            },
+        )
+
+
+async def client(shards, files, deadline, latencies, errors):
+    connections = {}
+    while time.perf_counter() < deadline:
+        file_name = f"file{random.randrange(files)}"
+        shard = shards[shard_index(file_name, len(shards))]
+        data = encode_message(
+            {
+                "command": "resolve",
+                "file_name": file_name,
+                "requester_id": 1,
+                "compact": True,
+            }
+        )
+        start = time.perf_counter()
+        try:
+            if shard not in connections:
+                connections[shard] = await asyncio.open_connection(*shard)
+            reader, writer = connections[shard]
+            writer.write(data)
+            await writer.drain()
+            (length,) = MESSAGE_HEADER.unpack(
+                await reader.readexactly(MESSAGE_HEADER.size)
+            )
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.IncompleteReadError):
+            errors[0] += 1
+            connections.pop(shard, None)
+            await asyncio.sleep(0.01)
+    for _, writer in connections.values():
+        writer.close()
+
+
+def run_clients(shards, files, clients, duration, results):
+    raise_file_limit()
+
+    async def main():
+        latencies = []
+        errors = [0]
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(
+            *(
+                client(shards, files, deadline, latencies, errors)
+                for _ in range(clients)
+            )
+        )
+        return latencies, errors[0]
+
+    results.put(asyncio.run(main()))
+
+
+def run(count, args):
+    port = free_ports(count + 1)
+    shards = [(HOST, port + 1 + i) for i in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        cluster = start_cluster(
+            HOST, port, count, directory, args.server == "async", quiet=True
+        )
+        try:
+            populate(port, shards, args.nodes, args.files, args.pieces)
+            results = multiprocessing.Queue()
+            processes = min(args.processes, args.concurrency)
+            generators = [
+                multiprocessing.Process(
+                    target=run_clients,
+                    args=(
+                        shards,
+                        args.files,
+                        args.concurrency // processes
+                        + (1 if i < args.concurrency % processes else 0),
+                        args.duration,
+                        results,
+                    ),
+                )
+                for i in range(processes)
+            ]
+            for generator in generators:
+                generator.start()
+            latencies = []
+            errors = 0
+            for _ in generators:
+                part, part_errors = results.get()
+                latencies.extend(part)
+                errors += part_errors
+            for generator in generators:
+                generator.join()
+        finally:
+            for process in cluster:
+                process.kill()
+            for process in cluster:
+                process.join()
+
+    return {
+        "shards": count,
+        "server": args.server,
+        "concurrency": args.concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": len(latencies) / args.duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--server", default="async", choices=["threaded", "async"])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--nodes", type=int, default=50, help="registered nodes")
+    parser.add_argument("--files", type=int, default=1000, help="recorded files")
+    parser.add_argument("--pieces", type=int, default=64, help="pieces per file")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+
+    limit = raise_file_limit()
+    if args.concurrency * max(args.shards) + 100 > limit:
+        print(
+            f"Concurrency {args.concurrency} may exceed the open file limit {limit}",
+            file=sys.stderr,
+        )
+    results = [run(count, args) for count in args.shards]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    base = results[0]["requests_per_sec"] or 1
+    print(
+        f"{'shards':>6} {'req/s':>10} {'speedup':>8} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['shards']:>6} {r['requests_per_sec']:>10.0f} "
+            f"{r['requests_per_sec'] / base:>7.2f}x "
+            f"{r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
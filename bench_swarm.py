@@ -0,0 +1,504 @@
+"""Run scripted transfer scenarios against a local swarm on loopback.
+
+Every scenario gets a fresh tracker and --nodes nodes in a temporary
+directory, each in its own process (or all as threads of this process with
+--threads). Scenarios:
+
+    large       one node uploads a large file, a node that joins afterwards
+                (and so holds none of it) downloads it
+    small       one node uploads many small files, a node that joins
+                afterwards downloads them; with --bulk N through
+                upload_many/download_many, N at a time
+    concurrent  one file is downloaded by every other node at once
+    churn       like concurrent, but --churn nodes holding pieces are killed
+                --churn-after seconds into the downloads
+
+A scenario is only ok if every downloaded file has the same SHA-256 as its
+source. Reports upload/download MB/s, per-piece request latency percentiles, tracker
+requests per second and peak RSS per scenario. With --threads the swarm
+shares this process, so only its overall peak RSS is known.
+
+    python bench_swarm.py --nodes 8 --scenarios large churn --json
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from node import Node
+from tracker import Tracker
+
+SCENARIOS = ["large", "small", "concurrent", "churn"]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+    return {
+        "count": len(samples),
+        "p50_ms": at(0.50),
+        "p90_ms": at(0.90),
+        "p99_ms": at(0.99),
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+class BenchTracker(Tracker):
+    def bench_requests(self):
+        return sum(self.requests.snapshot().values())
+
+    def bench_rss(self):
+        return peak_rss_mb()
+
+    def bench_stop(self):
+        self.running = False
+        self.repair.stop()
+        self.store.close()
+
+
+class BenchNode(Node):
+    # Node that times every piece request it makes
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = {"upload": [], "download": []}
+
+    def request_piece(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().request_piece(*args, **kwargs)
+        finally:
+            self.latencies["download"].append(time.perf_counter() - start)
+
+    def send_piece_upload(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().send_piece_upload(*args, **kwargs)
+        finally:
+            self.latencies["upload"].append(time.perf_counter() - start)
+
+    def bench_upload(self, path, name):
+        start = time.perf_counter()
+        ok = self.upload_file(path, name)
+        return ok, time.perf_counter() - start
+
+    def bench_download(self, name):
+        start = time.perf_counter()
+        ok = self.download_file(name)
+        return ok, time.perf_counter() - start
+
+    def bench_upload_many(self, files, max_concurrent):
+        start = time.perf_counter()
+        results = self.upload_many(files, max_concurrent)
+        return all(results.values()), time.perf_counter() - start
+
+    def bench_download_many(self, names, max_concurrent):
+        start = time.perf_counter()
+        results = self.download_many(names, max_concurrent)
+        return all(results.values()), time.perf_counter() - start
+
+    def bench_digest(self, name):
+        return file_digest(os.path.join(self.file_directory, name))
+
+    def bench_latencies(self):
+        return self.latencies
+
+    def bench_rss(self):
+        return peak_rss_mb()
+
+    def bench_stop(self):
+        # Vanish without telling the tracker, like a crashed node
+        self.running = False
+        self.pool.close()
+        if self.compression_executor is not None:
+            self.compression_executor.shutdown(cancel_futures=True)
+
+
+def start_tracker(port, directory, use_async):
+    tracker = BenchTracker("127.0.0.1", port, directory)
+    target = tracker.start_async if use_async else tracker.start
+    threading.Thread(target=target, daemon=True).start()
+    wait_for_port(port)
+    return tracker
+
+
+def start_node(tracker_port, directory, options):
+    node = BenchNode("127.0.0.1", tracker_port, host="127.0.0.1", directory=directory)
+    for name, value in options.items():
+        setattr(node, name, value)
+    node.register_with_tracker()
+    if node.node_id is None:
+        raise RuntimeError("Node failed to register")
+    threading.Thread(target=node.node_start, daemon=True).start()
+    wait_for_port(node.port)
+    return node
+
+
+def serve(conn, factory, args):
+    # Child process: build the tracker or node, then run the driver's calls
+    sys.stdout = open(os.devnull, "w")
+    target = factory(*args)
+    conn.send("ready")
+    while True:
+        name, call_args = conn.recv()
+        if name == "exit":
+            break
+        conn.send(getattr(target, "bench_" + name)(*call_args))
+    target.bench_stop()
+    conn.close()
+    # Piece servers and worker pools are not daemon threads
+    os._exit(0)
+
+
+class ThreadHandle:
+    def __init__(self, factory, *args):
+        self.target = factory(*args)
+
+    def call(self, name, *args):
+        return getattr(self.target, "bench_" + name)(*args)
+
+    def kill(self):
+        self.target.bench_stop()
+
+    def close(self):
+        self.target.bench_stop()
+
+
+class ProcessHandle:
+    context = multiprocessing.get_context("forkserver")
+
+    def __init__(self, factory, *args):
+        self.conn, child = self.context.Pipe()
+        # Not a daemon, since daemons cannot start the compression worker
+        # pool; close() and kill() end it
+        self.process = self.context.Process(target=serve, args=(child, factory, args))
+        self.process.start()
+        child.close()
+        if self.conn.recv() != "ready":
+            raise RuntimeError("Swarm process failed to start")
+
+    def call(self, name, *args):
+        self.conn.send((name, args))
+        return self.conn.recv()
+
+    def kill(self):
+        # Stop the target first, so worker pools it started do not outlive it
+        if self.process.is_alive():
+            self.conn.send(("stop", ()))
+            self.conn.poll(5)
+        self.process.kill()
+        self.process.join()
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(("exit", ()))
+            self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+
+
+class Swarm:
+    def __init__(self, args, directory):
+        self.directory = directory
+        self.handle = ThreadHandle if args.threads else ProcessHandle
+        self.threads = args.threads
+        self.port = free_port()
+        self.tracker = self.handle(
+            start_tracker, self.port, os.path.join(directory, "tracker"), args.use_async
+        )
+        self.options = {
+            "storage_backend": args.storage_backend,
+            "placement_strategy": args.placement,
+            "replication_factor": args.replication_factor,
+            "compression": args.compression,
+            "chunking": args.chunking,
+        }
+        self.nodes = []
+        self.killed = set()
+        try:
+            for _ in range(args.nodes):
+                self.add_node()
+        except Exception:
+            self.close()
+            raise
+
+    def add_node(self):
+        # Start one more node; one started after an upload holds none of its
+        # pieces, so everything it downloads crosses the network
+        node = self.handle(start_node, self.port, self.directory, self.options)
+        self.nodes.append(node)
+        return node
+
+    def kill(self, index):
+        self.nodes[index].kill()
+        self.killed.add(index)
+
+    def live_nodes(self):
+        return [n for i, n in enumerate(self.nodes) if i not in self.killed]
+
+    def latencies(self):
+        samples = {"upload": [], "download": []}
+        for node in self.live_nodes():
+            for kind, values in node.call("latencies").items():
+                samples[kind].extend(values)
+        return {kind: percentiles(values) for kind, values in samples.items()}
+
+    def peak_rss(self):
+        if self.threads:
+            return {"process_mb": peak_rss_mb()}
+        nodes = [node.call("rss") for node in self.live_nodes()]
+        return {
+            "tracker_mb": self.tracker.call("rss"),
+            "node_max_mb": max(nodes, default=0),
+            "nodes_total_mb": sum(nodes),
+            "driver_mb": peak_rss_mb(),
+        }
+
+    def close(self):
+        for node in self.live_nodes():
+            node.close()
+        self.tracker.close()
+
+
+def make_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, 4 * 1024 * 1024)
+            f.write(os.urandom(block))
+            remaining -= block
+    return path
+
+
+def file_digest(path):
+    # SHA-256 of a file, or None if it does not exist
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(4 * 1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_all(swarm, downloaders, name):
+    # Download one file on several nodes at once; returns per-node results
+    results = [None] * len(downloaders)
+
+    def download(i, node):
+        results[i] = node.call("download", name)
+
+    threads = [
+        threading.Thread(target=download, args=(i, node))
+        for i, node in enumerate(downloaders)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def run_large(swarm, args):
+    path = make_file(swarm.directory, "large.bin", args.large_size)
+    uploaded, upload_seconds = swarm.nodes[0].call("upload", path, "large.bin")
+    downloader = swarm.add_node()
+    downloaded, download_seconds = downloader.call("download", "large.bin")
+    intact = downloader.call("digest", "large.bin") == file_digest(path)
+    return {
+        "ok": bool(uploaded and downloaded and intact),
+        "bytes": args.large_size,
+        "upload_mb_per_s": args.large_size / upload_seconds / 1e6,
+        "download_mb_per_s": args.large_size / download_seconds / 1e6,
+    }
+
+
+def run_small(swarm, args):
+    names = [f"small-{i}.bin" for i in range(args.small_count)]
+    paths = [make_file(swarm.directory, name, args.small_size) for name in names]
+    total = args.small_size * len(names)
+    ok = True
+    start = time.perf_counter()
+    if args.bulk:
+        ok &= swarm.nodes[0].call("upload_many", list(zip(paths, names)), args.bulk)[0]
+    else:
+        for path, name in zip(paths, names):
+            ok &= bool(swarm.nodes[0].call("upload", path, name)[0])
+    upload_seconds = time.perf_counter() - start
+    downloader = swarm.add_node()
+    start = time.perf_counter()
+    if args.bulk:
+        ok &= downloader.call("download_many", names, args.bulk)[0]
+    else:
+        for name in names:
+            ok &= bool(downloader.call("download", name)[0])
+    download_seconds = time.perf_counter() - start
+    for path, name in zip(paths, names):
+        ok &= downloader.call("digest", name) == file_digest(path)
+    return {
+        "ok": ok,
+        "bytes": total,
+        "files": len(names),
+        "upload_mb_per_s": total / upload_seconds / 1e6,
+        "download_mb_per_s": total / download_seconds / 1e6,
+        "upload_files_per_s": len(names) / upload_seconds,
+        "download_files_per_s": len(names) / download_seconds,
+    }
+
+
+def run_concurrent(swarm, args, churn=0):
+    path = make_file(swarm.directory, "shared.bin", args.file_size)
+    uploaded, upload_seconds = swarm.nodes[0].call("upload", path, "shared.bin")
+    # With churn, nodes 1..churn hold pieces but do not download
+    downloaders = swarm.nodes[1 + churn :]
+    start = time.perf_counter()
+    threads, results = download_all(swarm, downloaders, "shared.bin")
+    if churn:
+        time.sleep(args.churn_after)
+        for index in range(1, 1 + churn):
+            swarm.kill(index)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    expected = file_digest(path)
+    completed = sum(
+        1
+        for node, (ok, _) in zip(downloaders, results)
+        if ok and node.call("digest", "shared.bin") == expected
+    )
+    return {
+        "ok": bool(uploaded) and completed == len(downloaders),
+        "bytes": args.file_size,
+        "downloaders": len(downloaders),
+        "completed": completed,
+        "killed": churn,
+        "upload_mb_per_s": args.file_size / upload_seconds / 1e6,
+        "download_mb_per_s": args.file_size * completed / elapsed / 1e6,
+        "slowest_download_s": max(seconds for _, seconds in results),
+    }
+
+
+def run_scenario(name, args):
+    with tempfile.TemporaryDirectory() as directory:
+        swarm = Swarm(args, directory)
+        try:
+            requests_before = swarm.tracker.call("requests")
+            start = time.perf_counter()
+            if name == "large":
+                result = run_large(swarm, args)
+            elif name == "small":
+                result = run_small(swarm, args)
+            elif name == "concurrent":
+                result = run_concurrent(swarm, args)
+            else:
+                result = run_concurrent(swarm, args, churn=args.churn)
+            elapsed = time.perf_counter() - start
+            requests = swarm.tracker.call("requests") - requests_before
+            result.update(
+                {
+                    "scenario": name,
+                    "seconds": elapsed,
+                    "tracker_requests": requests,
+                    "tracker_requests_per_s": requests / elapsed,
+                    "piece_latency": swarm.latencies(),
+                    "peak_rss": swarm.peak_rss(),
+                }
+            )
+            return result
+        finally:
+            swarm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--nodes", type=int, default=6)
+    parser.add_argument("--threads", action="store_true", help="run in one process")
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--large-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--small-count", type=int, default=100)
+    parser.add_argument("--small-size", type=int, default=64 * 1024)
+    parser.add_argument(
+        "--bulk",
+        type=int,
+        default=0,
+        help="small files through upload_many/download_many, N at a time",
+    )
+    parser.add_argument("--file-size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--churn", type=int, default=1)
+    parser.add_argument("--churn-after", type=float, default=0.2)
+    parser.add_argument("--storage-backend", default="packed")
+    parser.add_argument("--placement", default="round_robin")
+    parser.add_argument("--replication-factor", type=int, default=2)
+    parser.add_argument("--compression", default=None)
+    parser.add_argument("--chunking", default=None)
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+    if args.nodes < 2 + args.churn:
+        parser.error("need at least --churn + 2 nodes")
+
+    stdout = sys.stdout
+    if args.threads:
+        # Nodes log every piece; keep that out of the report
+        sys.stdout = open(os.devnull, "w")
+    try:
+        results = [run_scenario(name, args) for name in args.scenarios]
+    finally:
+        sys.stdout = stdout
+
+    if args.json:
+        print(json.dumps({"args": vars(args), "results": results}, indent=2))
+        return
+    print(
+        f"{'scenario':>10} {'ok':>5} {'up MB/s':>8} {'down MB/s':>10} "
+        f"{'p50 ms':>7} {'p99 ms':>7} {'tracker req/s':>14} {'peak RSS MB':>12}"
+    )
+    for r in results:
+        latency = r["piece_latency"]["download"]
+        rss = r["peak_rss"]
+        peak = rss.get(
+            "process_mb", max(rss.get("tracker_mb", 0), rss.get("node_max_mb", 0))
+        )
+        print(
+            f"{r['scenario']:>10} {str(r['ok']):>5} {r['upload_mb_per_s']:>8.1f} "
+            f"{r['download_mb_per_s']:>10.1f} {latency.get('p50_ms', 0):>7.1f} "
+            f"{latency.get('p99_ms', 0):>7.1f} {r['tracker_requests_per_s']:>14.1f} "
+            f"{peak:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Load-test the threaded and asyncio tracker servers with get_nodes traffic.
+
+For each server mode and concurrency level a fresh tracker is started in its
+own process, pre-populated with registered nodes, and hammered by asyncio
+clients spread over several load-generator processes. Reports requests/sec
+and p50/p99 latency.
+
+    python bench_tracker.py --concurrency 100 1000 10000 --duration 5
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+from protocol import MESSAGE_HEADER, encode_message, recv_message, send_message
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_server(mode, port, directory):
+    raise_file_limit()
+    sys.stdout = open(os.devnull, "w")
+    from tracker import Tracker
+
+    tracker = Tracker("127.0.0.1", port, directory)
+    if mode == "async":
+        tracker.start_async()
+    else:
+        tracker.start()
+
+
+def wait_for_server(port, nodes):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port)) as s:
+                for i in range(nodes):
+                    send_message(
+                        s,
+                        {"command": "register", "ip_address": "127.0.0.1", "port": i},
+                    )
+                    recv_message(s)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Tracker did not start")
+
+
+async def client(port, deadline, reconnect, latencies, errors):
+    request = encode_message({"command": "get_nodes"})
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            await writer.drain()
+            (length,) = MESSAGE_HEADER.unpack(
+                await reader.readexactly(MESSAGE_HEADER.size)
+            )
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.IncompleteReadError):
+            errors[0] += 1
+            writer = None
+            await asyncio.sleep(0.01)
+            continue
+        if reconnect:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+def run_clients(port, clients, duration, reconnect, results):
+    raise_file_limit()
+
+    async def main():
+        latencies = []
+        errors = [0]
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(
+            *(
+                client(port, deadline, reconnect, latencies, errors)
+                for _ in range(clients)
+            )
+        )
+        return latencies, errors[0]
+
+    results.put(asyncio.run(main()))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(mode, concurrency, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = multiprocessing.Process(
+            target=run_server, args=(mode, port, directory), daemon=True
+        )
+        server.start()
+        try:
+            wait_for_server(port, args.nodes)
+            results = multiprocessing.Queue()
+            processes = min(args.processes, concurrency)
+            generators = [
+                multiprocessing.Process(
+                    target=run_clients,
+                    args=(
+                        port,
+                        concurrency // processes
+                        + (1 if i < concurrency % processes else 0),
+                        args.duration,
+                        args.reconnect,
+                        results,
+                    ),
+                )
+                for i in range(processes)
+            ]
+            for generator in generators:
+                generator.start()
+            latencies = []
+            errors = 0
+            for _ in generators:
+                part, part_errors = results.get()
+                latencies.extend(part)
+                errors += part_errors
+            for generator in generators:
+                generator.join()
+        finally:
+            server.kill()
+            server.join()
+
+    return {
+        "server": mode,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": len(latencies) / args.duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument(
+        "--servers",
+        nargs="+",
+        default=["threaded", "async"],
+        choices=["threaded", "async"],
+    )
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--nodes", type=int, default=50, help="registered nodes")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--reconnect",
+        action="store_true",
+        help="open a new connection per request, like older nodes",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args = parser.parse_args()
+
+    limit = raise_file_limit()
+    results = []
+    for concurrency in args.concurrency:
+        if concurrency + 100 > limit:
+            print(
+                f"Skipping concurrency {concurrency}: open file limit is {limit}",
+                file=sys.stderr,
+            )
+            continue
+        for mode in args.servers:
+            results.append(run(mode, concurrency, args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(
+        f"{'server':<9} {'clients':>8} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['server']:<9} {r['concurrency']:>8} {r['requests_per_sec']:>10.0f} "
+            f"{r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
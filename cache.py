@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+
+class PieceCache:
+    # Bounded LRU cache of piece bytes keyed by (file_hash, piece_index).
+    # Pieces served from disk are only admitted on their second request
+    # within the recent-miss window, so one-off reads keep going through
+    # zero-copy sendfile and do not flush hot pieces out.
+    def __init__(self, capacity_bytes, ghost_entries=4096):
+        self.capacity_bytes = capacity_bytes
+        self.ghost_entries = ghost_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.ghosts = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # Return cached bytes for a piece, or None
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        # Cache a piece, evicting least recently used pieces to make room
+        if len(data) > self.capacity_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.ghosts.pop(key, None)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.capacity_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def should_admit(self, key):
+        # Record a miss served from disk; True if the piece missed recently
+        # too and is worth caching now
+        if not self.capacity_bytes:
+            return False
+        with self.lock:
+            if key in self.ghosts:
+                del self.ghosts[key]
+                return True
+            self.ghosts[key] = None
+            if len(self.ghosts) > self.ghost_entries:
+                self.ghosts.popitem(last=False)
+            return False
+
+    def rename_file(self, old_hash, new_hash):
+        # Re-key cached pieces of a staged upload under the final file hash
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == old_hash]:
+                new_key = (new_hash, key[1])
+                replaced = self.entries.pop(new_key, None)
+                if replaced is not None:
+                    self.size -= len(replaced)
+                self.entries[new_key] = self.entries.pop(key)
+
+    def delete_file(self, file_hash):
+        # Drop cached pieces of an abandoned staged upload
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == file_hash]:
+                self.size -= len(self.entries.pop(key))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "capacity_bytes": self.capacity_bytes,
+            }
@@ -0,0 +1,117 @@
+import hashlib
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - content-defined chunking is optional
+    np = None
+
+# Content-defined chunking: a cut is made where a rolling hash of the last
+# WINDOW bytes has its low bits all zero, so boundaries move with the
+# content and an insertion only changes the chunks around it.
+WINDOW = 48
+MIN_CHUNK = 256 * 1024
+AVERAGE_CHUNK = 1024 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+
+def buzhash_table():
+    # Fixed pseudo-random value per byte; it must be identical on every node
+    return [
+        int.from_bytes(hashlib.sha1(bytes([b])).digest()[:4], "big") for b in range(256)
+    ]
+
+
+def rotate_left(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & 0xFFFFFFFF
+
+
+def rotated_tables():
+    # rotated_tables()[r * 256 + b] is the table value of byte b rotated
+    # left by r bits, so per-byte rotations become a single lookup
+    table = buzhash_table()
+    return np.array(
+        [rotate_left(value, r) for r in range(32) for value in table], dtype=np.uint32
+    )
+
+
+def rotation_patterns(limit, mask):
+    """Per-position lookup offsets into rotated_tables() and per-window-end
+    masks for buffers of up to `limit` bytes. Both only depend on the
+    position, so they are computed once per file."""
+    positions = np.arange(limit + 1, dtype=np.int64)
+    offsets = (((-positions[:limit]) & 31) << 8).astype(np.uint16)
+    # rotl(h, k) & mask == 0 exactly when h & rotr(mask, k) == 0
+    masks = np.array(
+        [rotate_left(mask, (32 - k) % 32) for k in range(32)], dtype=np.uint32
+    )
+    end_masks = masks[(positions[WINDOW:] - 1) & 31]
+    return offsets, end_masks
+
+
+def cut_candidates(data, tables, offsets, end_masks):
+    """Positions (chunk ends, exclusive) in `data` where the buzhash of the
+    preceding WINDOW bytes has all mask bits zero.
+
+    The hash of a window is the XOR of its bytes' table values, each rotated
+    by its distance from the window end. Pre-rotating every value by minus
+    its position turns that into a prefix-XOR difference followed by one
+    rotation, which is folded into the mask instead, so the whole buffer is
+    hashed with a few NumPy passes.
+    """
+    size = len(data)
+    if size < WINDOW:
+        return np.empty(0, dtype=np.int64)
+    spread = tables[offsets[:size] | np.frombuffer(data, dtype=np.uint8)]
+    prefix = np.zeros(size + 1, dtype=np.uint32)
+    np.bitwise_xor.accumulate(spread, out=prefix[1:])
+    window = prefix[WINDOW:] ^ prefix[:-WINDOW]
+    return np.flatnonzero((window & end_masks[: len(window)]) == 0) + WINDOW
+
+
+def content_defined_chunks(
+    file, min_size=MIN_CHUNK, average_size=AVERAGE_CHUNK, max_size=MAX_CHUNK
+):
+    # Yield the file's chunks, cut at content-defined boundaries
+    if np is None:
+        raise RuntimeError("Content-defined chunking requires numpy")
+    tables = rotated_tables()
+    mask = (1 << (average_size.bit_length() - 1)) - 1
+    # A buffer holds at most one unfinished chunk plus one read
+    offsets, end_masks = rotation_patterns(max_size + READ_SIZE, mask)
+    buffer = b""
+    candidates = np.empty(0, dtype=np.int64)
+    eof = False
+    while not eof:
+        block = file.read(READ_SIZE)
+        eof = not block
+        # Only windows ending in the new block need hashing; the carried
+        # part's candidates are kept from the previous pass
+        hashed = max(len(buffer) - WINDOW + 1, 0)
+        buffer += block
+        candidates = np.concatenate(
+            (
+                candidates,
+                cut_candidates(buffer[hashed:], tables, offsets, end_masks) + hashed,
+            )
+        )
+        start = 0
+        while start < len(buffer):
+            i = np.searchsorted(candidates, start + min_size)
+            if i < len(candidates) and candidates[i] <= start + max_size:
+                end = int(candidates[i])
+            elif start + max_size <= len(buffer):
+                end = start + max_size
+            elif eof:
+                end = len(buffer)
+            else:
+                break
+            yield buffer[start:end]
+            start = end
+        buffer = buffer[start:]
+        candidates = candidates[candidates > start] - start
+
+
+def fixed_chunks(file, size):
+    while chunk := file.read(size):
+        yield chunk
@@ -0,0 +1,80 @@
+import bz2
+import lzma
+import time
+import zlib
+
+# Codec ids carried in the first byte of a compressed payload
+CODEC_NONE = 0
+CODECS = {"zlib": 1, "lzma": 2, "bz2": 3}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODECS.items()}
+
+# Pieces kept compressed at rest start with this marker, followed by the
+# same codec byte and body that travel on the wire. Raw pieces that happen
+# to start with the marker are stored wrapped under CODEC_NONE.
+STORED_MAGIC = b"FSZ1"
+STORED_PREFIX_SIZE = len(STORED_MAGIC) + 1
+
+# A piece is only compressed if a sample of it shrinks below this ratio
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.9
+
+
+def compress(codec, data):
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    if codec == "lzma":
+        return lzma.compress(data, preset=1)
+    if codec == "bz2":
+        return bz2.compress(data, 6)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def decompress(codec_id, data):
+    if codec_id == CODEC_NONE:
+        return bytes(data)
+    codec = CODEC_NAMES.get(codec_id)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    if codec == "bz2":
+        return bz2.decompress(data)
+    raise ValueError(f"Unknown codec id: {codec_id}")
+
+
+def compress_piece(codec, piece):
+    """Compress a piece for the wire, skipping it if a cheap sample shows it
+    will not shrink. Runs in a worker process.
+
+    Returns (payload, cpu_seconds) where payload is the codec byte followed
+    by the compressed body, or None for pieces that are sent raw.
+    """
+    start = time.process_time()
+    payload = None
+    sample = piece[:SAMPLE_SIZE]
+    if sample and len(zlib.compress(sample, 1)) < len(sample) * SAMPLE_RATIO:
+        body = compress(codec, piece)
+        if len(body) < len(piece):
+            payload = bytes([CODECS[codec]]) + body
+    return payload, time.process_time() - start
+
+
+def decode_payload(payload):
+    # Raw piece bytes from a codec byte and compressed body
+    return decompress(payload[0], memoryview(payload)[1:])
+
+
+def wrap_stored(payload):
+    # At-rest form of a compressed wire payload
+    return STORED_MAGIC + payload
+
+
+def is_stored(prefix):
+    return prefix[: len(STORED_MAGIC)] == STORED_MAGIC
+
+
+def unwrap_stored(data):
+    # Raw piece bytes from data as read from the piece store
+    if is_stored(data):
+        return decode_payload(memoryview(data)[len(STORED_MAGIC) :])
+    return data
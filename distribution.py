@@ -0,0 +1,170 @@
+# Compact piece distributions. A distribution maps every piece index of a
+# file to its holders; placement makes it highly regular, so it is stored
+# and sent as a layout instead:
+#
+#   {"pieces": N,
+#    "pattern": [[holders], ...],   piece i is held by pattern[i % len]
+#    "extra": {node_id: [[start, stop], ...]},  also held by these nodes
+#    "exceptions": {"i": [holders]}}            replaces all of the above
+#
+# Round-robin placement over n nodes is a pattern of n entries, and a node
+# that downloaded the whole file is a single extra range. Holders are kept
+# as sets: their order within a piece is not preserved.
+
+# Periods tried when looking for the placement pattern
+MAX_CANDIDATES = 4
+MAX_PERIOD = 4096
+
+
+def holder_lists(distribution):
+    # Holders of pieces 0..N-1, from a distribution keyed by str or int
+    count = len(distribution)
+    for key in (str, int):
+        try:
+            return [distribution[key(i)] for i in range(count)]
+        except KeyError:
+            pass
+    # Indices with gaps; the missing pieces have no holders
+    count = 1 + max((int(i) for i in distribution), default=-1)
+    lists = [[] for _ in range(count)]
+    for piece_index, holders in distribution.items():
+        lists[int(piece_index)] = holders
+    return lists
+
+
+def holder_sets(lists):
+    # Holders of each piece as a set of str ids, one shared set per
+    # distinct holder list
+    sets = {}
+    return [
+        sets.get(key) or sets.setdefault(key, frozenset(map(str, key)))
+        for key in map(tuple, lists)
+    ]
+
+
+def encode_pattern(lists, sets, pattern, limit):
+    # (layout, size) of `lists` on top of `pattern`, or None once the size
+    # grows past `limit` entries
+    period = len(pattern)
+    pattern_sets = [frozenset(map(str, holders)) for holders in pattern]
+    exceptions = {}
+    extra = {}
+    size = sum(len(holders) + 1 for holders in pattern)
+    # node_id -> [start, stop] of its open range; pieces that are
+    # exceptions neither extend nor break a range
+    runs = {}
+    # End of the last piece that was not an exception
+    end = 0
+    empty = frozenset()
+    for i, held in enumerate(sets):
+        expected = pattern_sets[i % period] if period else empty
+        if held == expected and not runs:
+            end = i + 1
+            continue
+        if not expected <= held:
+            exceptions[str(i)] = list(lists[i])
+            size += len(held) + 1
+        else:
+            for key in list(runs):
+                if runs[key][1] == end and key not in held:
+                    extra.setdefault(key, []).append(runs.pop(key))
+            for key in held - expected:
+                run = runs.get(key)
+                if run is not None and run[1] == end:
+                    run[1] = i + 1
+                    continue
+                if run is not None:
+                    extra.setdefault(key, []).append(run)
+                runs[key] = [i, i + 1]
+                size += 2
+            end = i + 1
+        if size > limit:
+            return None
+    for key, run in runs.items():
+        extra.setdefault(key, []).append(run)
+    layout = {"pieces": len(lists), "pattern": pattern}
+    if extra:
+        layout["extra"] = extra
+    if exceptions:
+        layout["exceptions"] = exceptions
+    return layout, size
+
+
+def periods(sets, indices):
+    # Distances at which the holders of the first of `indices` repeat
+    first = next(indices)
+    found = []
+    for distance, i in enumerate(indices, 1):
+        if sets[i] == sets[first]:
+            found.append(distance)
+            if len(found) == MAX_CANDIDATES:
+                break
+    return found
+
+
+def candidate_patterns(lists, sets):
+    # Patterns to try: the first pieces, the last ones (in case a node
+    # holds a prefix of the file on top of the placement), the holders
+    # common to every piece of each residue, and no pattern
+    count = len(lists)
+    limit = min(count // 2, MAX_PERIOD)
+    head = periods(sets, iter(range(limit + 1)))
+    for period in head:
+        yield lists[:period]
+    for period in periods(sets, iter(range(count - 1, count - limit - 2, -1))):
+        offset = count - period
+        yield [lists[offset + (j - offset) % period] for j in range(period)]
+    if head:
+        period = head[0]
+        common = [set(sets[j]) for j in range(period)]
+        for i in range(period, count):
+            common[i % period] &= sets[i]
+        yield [[n for n in lists[j] if str(n) in common[j]] for j in range(period)]
+    yield []
+
+
+def encode_distribution(distribution):
+    # The smallest layout over the candidate patterns, stopping at one that
+    # needs no extras or exceptions
+    lists = holder_lists(distribution)
+    sets = holder_sets(lists)
+    best, best_size = None, float("inf")
+    tried = set()
+    for pattern in candidate_patterns(lists, sets):
+        key = tuple(map(tuple, pattern))
+        if key in tried:
+            continue
+        tried.add(key)
+        pattern = [list(holders) for holders in pattern]
+        result = encode_pattern(lists, sets, pattern, best_size)
+        if result is not None and result[1] < best_size:
+            best, best_size = result
+            if "extra" not in best and "exceptions" not in best:
+                break
+    return best
+
+
+def decode_distribution(layout):
+    # The distribution {"i": [holders]} a layout stands for
+    pattern = layout["pattern"]
+    exceptions = layout.get("exceptions", {})
+    distribution = {
+        str(i): list(pattern[i % len(pattern)]) if pattern else []
+        for i in range(layout["pieces"])
+    }
+    for node_id, ranges in layout.get("extra", {}).items():
+        for start, stop in ranges:
+            for i in range(start, stop):
+                if str(i) not in exceptions:
+                    distribution[str(i)].append(node_id)
+    for piece_index, holders in exceptions.items():
+        distribution[piece_index] = list(holders)
+    return distribution
+
+
+def response_distribution(response):
+    # The distribution in a tracker reply, sent as a layout when the
+    # request asked for a compact one
+    if "piece_layout" in response:
+        return decode_distribution(response["piece_layout"])
+    return response["piece_distribution"]
@@ -0,0 +1,550 @@
+import os
+import random
+import struct
+import threading
+import time
+from collections import deque
+
+from pool import CancelToken
+
+# Bitfield file header: magic, total pieces, raw file hash
+BITFIELD_HEADER = struct.Struct("!4sI20s")
+BITFIELD_MAGIC = b"FSBF"
+
+
+class DownloadSink:
+    def __init__(
+        self,
+        save_location,
+        file_hash,
+        total_pieces,
+        piece_size,
+        file_size=None,
+        piece_sizes=None,
+    ):
+        self.save_location = save_location
+        self.bitfield_path = save_location + ".bitfield"
+        self.total_pieces = total_pieces
+        self.piece_size = piece_size
+        self.file_size = file_size
+        # Offsets of variable-size pieces, such as content-defined chunks
+        self.offsets = None
+        if piece_sizes is not None:
+            self.offsets = [0]
+            for size in piece_sizes[:-1]:
+                self.offsets.append(self.offsets[-1] + size)
+        self.header = BITFIELD_HEADER.pack(
+            BITFIELD_MAGIC, total_pieces, bytes.fromhex(file_hash)
+        )
+        self.bitfield = bytearray((total_pieces + 7) // 8)
+        self.lock = threading.Lock()
+        self.unflushed = 0
+        # Bits are persisted in batches, after the piece data they cover
+        self.flush_every = 16
+
+        resuming = os.path.exists(save_location) and self.load_bitfield()
+        flags = os.O_RDWR | os.O_CREAT
+        if not resuming:
+            flags |= os.O_TRUNC
+        self.fd = os.open(save_location, flags, 0o644)
+        if file_size is not None and not resuming:
+            self.preallocate(file_size)
+        self.flush()
+
+    def load_bitfield(self):
+        # Load progress from a previous attempt at this same file
+        try:
+            with open(self.bitfield_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        header_size = BITFIELD_HEADER.size
+        if data[:header_size] != self.header or len(data) != header_size + len(
+            self.bitfield
+        ):
+            return False
+        self.bitfield[:] = data[header_size:]
+        return True
+
+    def preallocate(self, file_size):
+        # Reserve the whole file up front so pieces can land at any offset
+        os.ftruncate(self.fd, file_size)
+        if hasattr(os, "posix_fallocate") and file_size:
+            try:
+                os.posix_fallocate(self.fd, 0, file_size)
+            except OSError:
+                pass
+
+    def has(self, piece_index):
+        return bool(self.bitfield[piece_index // 8] & (0x80 >> (piece_index % 8)))
+
+    def missing(self):
+        # Indices of pieces that still need to be downloaded
+        return [i for i in range(self.total_pieces) if not self.has(i)]
+
+    def offset(self, piece_index):
+        if self.offsets is not None:
+            return self.offsets[piece_index]
+        return piece_index * self.piece_size
+
+    def read(self, piece_index, length):
+        # Read back a piece that was already written
+        return os.pread(self.fd, length, self.offset(piece_index))
+
+    def write(self, piece_index, piece_data):
+        # Write a piece at its offset and mark it done
+        os.pwrite(self.fd, piece_data, self.offset(piece_index))
+        with self.lock:
+            if piece_index == self.total_pieces - 1 and self.file_size is None:
+                self.file_size = piece_index * self.piece_size + len(piece_data)
+            self.bitfield[piece_index // 8] |= 0x80 >> (piece_index % 8)
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        # Make written pieces durable, then persist the bits that cover them
+        os.fsync(self.fd)
+        tmp_path = self.bitfield_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.header)
+            f.write(self.bitfield)
+        os.replace(tmp_path, self.bitfield_path)
+        self.unflushed = 0
+
+    def close(self, complete):
+        # Finish the file, or keep the bitfield so a later attempt can resume
+        with self.lock:
+            if complete:
+                if self.file_size is not None:
+                    os.ftruncate(self.fd, self.file_size)
+                os.fsync(self.fd)
+                os.close(self.fd)
+                if os.path.exists(self.bitfield_path):
+                    os.remove(self.bitfield_path)
+            else:
+                self.flush()
+                os.close(self.fd)
+
+
+class PeerStats:
+    """Moving estimates of each peer's piece throughput and request round
+    trip, shared by all downloads of a node.
+
+    Round trips are smoothed as in TCP (SRTT and RTTVAR), giving each peer
+    a request timeout of SRTT + 4 * RTTVAR that doubles after every timeout
+    until the peer answers again.
+    """
+
+    def __init__(self, alpha=0.25, beta=0.25, min_timeout=2.0, max_timeout=60):
+        self.alpha = alpha
+        self.beta = beta
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.lock = threading.Lock()
+        # node_id -> {"throughput", "srtt", "rttvar", "backoff"}
+        self.peers = {}
+
+    def observe(self, node_id, size, seconds):
+        # Record a piece of `size` bytes that took `seconds` to arrive
+        seconds = max(seconds, 1e-6)
+        with self.lock:
+            peer = self.peers.get(str(node_id))
+            if peer is None or peer["srtt"] is None:
+                self.peers[str(node_id)] = {
+                    "throughput": size / seconds,
+                    "srtt": seconds,
+                    "rttvar": seconds / 2,
+                    "backoff": 1,
+                }
+                return
+            peer["rttvar"] += self.beta * (abs(peer["srtt"] - seconds) - peer["rttvar"])
+            peer["srtt"] += self.alpha * (seconds - peer["srtt"])
+            peer["throughput"] += self.alpha * (size / seconds - peer["throughput"])
+            peer["backoff"] = 1
+
+    def failed(self, node_id, timed_out):
+        # A request that failed or timed out lowers the peer's estimate;
+        # timeouts also back its timeout off
+        with self.lock:
+            peer = self.peers.setdefault(
+                str(node_id),
+                {"throughput": 0.0, "srtt": None, "rttvar": None, "backoff": 1},
+            )
+            peer["throughput"] *= 1 - self.alpha
+            if timed_out:
+                peer["backoff"] = min(peer["backoff"] * 2, 64)
+
+    def throughput(self, node_id):
+        # Estimated bytes per second, or None for a peer not measured yet
+        with self.lock:
+            peer = self.peers.get(str(node_id))
+            if peer is None or peer["srtt"] is None:
+                return None
+            return peer["throughput"]
+
+    def timeout(self, node_id):
+        with self.lock:
+            peer = self.peers.get(str(node_id))
+            if peer is None:
+                return self.max_timeout
+            if peer["srtt"] is None:
+                timeout = self.max_timeout
+            else:
+                timeout = max(self.min_timeout, peer["srtt"] + 4 * peer["rttvar"])
+            return min(timeout * peer["backoff"], self.max_timeout)
+
+    def snapshot(self):
+        # node_id -> estimated bytes per second
+        with self.lock:
+            return {
+                node_id: peer["throughput"]
+                for node_id, peer in self.peers.items()
+                if peer["srtt"] is not None
+            }
+
+
+class PieceDownloader:
+    def __init__(
+        self,
+        node,
+        file_hash,
+        piece_indices,
+        piece_distribution,
+        active_nodes,
+        on_piece,
+        max_in_flight=8,
+        max_per_peer=4,
+        verifier=None,
+        piece_keys=None,
+        loads=None,
+        refresh=None,
+        refresh_interval=5,
+        exclude=None,
+        peer_stats=None,
+        endgame_pieces=4,
+        endgame_copies=3,
+        max_retries=2,
+    ):
+        self.node = node
+        self.file_hash = file_hash
+        # (hash, index) each piece is stored under, if not (file_hash, index)
+        self.piece_keys = piece_keys
+        self.piece_distribution = piece_distribution
+        self.active_nodes = active_nodes
+        self.on_piece = on_piece
+        self.max_in_flight = max_in_flight
+        self.max_per_peer = max_per_peer
+        self.verifier = verifier
+        # node_id -> active transfers from heartbeat load reports; among
+        # equally busy holders the least loaded is asked first
+        self.loads = loads or {}
+        # Returns (piece_distribution, active_nodes, loads) with the holders
+        # that joined since, e.g. other downloaders sharing their pieces
+        self.refresh = refresh
+        self.refresh_interval = refresh_interval
+        self.refreshed = time.monotonic()
+        self.refreshing = False
+        # This node's own id, never asked for pieces
+        self.exclude = None if exclude is None else str(exclude)
+        # Throughput and round-trip estimates: fast peers get more requests
+        # in flight, and slow requests time out after a few round trips
+        self.peer_stats = peer_stats or PeerStats()
+        # Once every remaining piece is requested and at most
+        # `endgame_pieces` are left, each is also requested from other
+        # holders, up to `endgame_copies` at once; the first reply wins and
+        # the others are cancelled
+        self.endgame_pieces = endgame_pieces
+        self.endgame_copies = endgame_copies
+        # A piece whose holders all timed out is tried again this often,
+        # with backed-off timeouts, before it counts as failed
+        self.max_retries = max_retries
+
+        self.condition = threading.Condition()
+        # Rarest pieces first, so scarce pieces spread before their few
+        # holders are swamped or leave
+        self.pending = deque(sorted(piece_indices, key=self.rarity))
+        self.remaining = len(self.pending)
+        self.in_flight = {}
+        self.tried = {}
+        self.failed = []
+        # piece_index -> {node_id: CancelToken} of its outstanding requests
+        self.requests = {}
+        self.timed_out = set()
+        self.retries = {}
+
+    def holders(self, piece_index):
+        # Active replicas of a piece, in the order the tracker listed them
+        return [
+            node_id
+            for node_id in self.piece_distribution.get(str(piece_index), [])
+            if str(node_id) in self.active_nodes and str(node_id) != self.exclude
+        ]
+
+    def rarity(self, piece_index):
+        return len(self.holders(piece_index))
+
+    def maybe_refresh(self):
+        # Pick up new holders every `refresh_interval` seconds, re-ordering
+        # the pending pieces by their new rarity
+        if self.refresh is None:
+            return
+        with self.condition:
+            if (
+                self.refreshing
+                or time.monotonic() - self.refreshed < self.refresh_interval
+            ):
+                return
+            self.refreshing = True
+        try:
+            result = self.refresh()
+        except Exception as e:
+            print(f"Error refreshing piece holders: {e}")
+            result = None
+        with self.condition:
+            self.refreshing = False
+            self.refreshed = time.monotonic()
+            if result is not None:
+                self.piece_distribution, self.active_nodes, self.loads = result
+                self.pending = deque(sorted(self.pending, key=self.rarity))
+                self.condition.notify_all()
+
+    def rates(self):
+        # Estimated throughput of every active peer, unmeasured ones at the
+        # mean of the rest so they are tried like an average peer
+        measured = {}
+        for node_id in self.active_nodes:
+            rate = self.peer_stats.throughput(node_id)
+            if rate is not None:
+                measured[node_id] = rate
+        mean = sum(measured.values()) / len(measured) if measured else 0.0
+        mean = mean or 1.0
+        rates = {node_id: measured.get(node_id, mean) for node_id in self.active_nodes}
+        return rates, mean
+
+    def best_source(self, candidates, rates, mean):
+        # The holder with a free slot expected to deliver soonest: slots
+        # scale with the peer's throughput relative to the mean, between 1
+        # and twice `max_per_peer`
+        def slots(node_id):
+            share = round(self.max_per_peer * rates.get(str(node_id), mean) / mean)
+            return max(1, min(share, 2 * self.max_per_peer))
+
+        free = [
+            node_id
+            for node_id in candidates
+            if self.in_flight.get(node_id, 0) < slots(node_id)
+        ]
+        if not free:
+            return None
+        return min(
+            free,
+            key=lambda n: (
+                (self.in_flight.get(n, 0) + 1) / (rates.get(str(n), mean) or 1e-9),
+                self.loads.get(str(n), 0),
+                random.random(),
+            ),
+        )
+
+    def assign(self, piece_index, node_id):
+        # Record a request and return it with the holder's address, read
+        # here under the lock since a refresh may replace active_nodes
+        self.tried[piece_index].add(node_id)
+        self.in_flight[node_id] = self.in_flight.get(node_id, 0) + 1
+        cancel = CancelToken()
+        self.requests.setdefault(piece_index, {})[node_id] = cancel
+        return piece_index, node_id, cancel, self.active_nodes.get(str(node_id))
+
+    def next_request(self):
+        # Pick a pending piece and its fastest untried holder with a free
+        # slot, or in the endgame another holder of an outstanding piece.
+        # Returns None when every piece is waiting on busy peers.
+        rates, mean = self.rates()
+        for _ in range(len(self.pending)):
+            piece_index = self.pending.popleft()
+            tried = self.tried.setdefault(piece_index, set())
+            candidates = [
+                node_id for node_id in self.holders(piece_index) if node_id not in tried
+            ]
+            if (
+                not candidates
+                and piece_index in self.timed_out
+                and self.retries.get(piece_index, 0) < self.max_retries
+            ):
+                # Only timeouts so far: go around again with longer timeouts
+                self.timed_out.discard(piece_index)
+                self.retries[piece_index] = self.retries.get(piece_index, 0) + 1
+                tried.clear()
+                candidates = self.holders(piece_index)
+            if not candidates:
+                self.failed.append(piece_index)
+                self.remaining -= 1
+                continue
+            node_id = self.best_source(candidates, rates, mean)
+            if node_id is not None:
+                return self.assign(piece_index, node_id)
+            self.pending.append(piece_index)
+        if self.pending or len(self.requests) > self.endgame_pieces:
+            return None
+        for piece_index in sorted(self.requests, key=lambda i: len(self.requests[i])):
+            if len(self.requests[piece_index]) >= self.endgame_copies:
+                break
+            tried = self.tried[piece_index]
+            candidates = [
+                node_id for node_id in self.holders(piece_index) if node_id not in tried
+            ]
+            node_id = self.best_source(candidates, rates, mean)
+            if node_id is not None:
+                return self.assign(piece_index, node_id)
+        return None
+
+    def worker(self):
+        # Keep requesting pieces until every piece is done or has failed
+        while True:
+            self.maybe_refresh()
+            with self.condition:
+                while True:
+                    if self.remaining == 0:
+                        self.condition.notify_all()
+                        return
+                    request = self.next_request()
+                    if request:
+                        break
+                    self.condition.wait()
+            piece_index, node_id, cancel, node_info = request
+
+            key_hash, key_index = self.file_hash, piece_index
+            if self.piece_keys is not None:
+                key_hash, key_index = self.piece_keys[piece_index]
+            timeout = self.peer_stats.timeout(node_id)
+            started = time.monotonic()
+            piece_data = None
+            if node_info is not None:
+                piece_data = self.node.request_piece(
+                    node_info["ip_address"],
+                    node_info["port"],
+                    key_hash,
+                    key_index,
+                    timeout=timeout,
+                    cancel=cancel,
+                )
+            elapsed = time.monotonic() - started
+            if piece_data:
+                self.peer_stats.observe(node_id, len(piece_data), elapsed)
+            elif node_info is not None and not cancel.cancelled:
+                self.peer_stats.failed(node_id, elapsed >= timeout)
+            with self.condition:
+                self.in_flight[node_id] -= 1
+                copies = self.requests.get(piece_index)
+                if copies is not None:
+                    copies.pop(node_id, None)
+                if copies is None:
+                    # Another holder answered first in the endgame
+                    piece_data = None
+                elif piece_data:
+                    del self.requests[piece_index]
+                    for loser in copies.values():
+                        loser.cancel()
+                elif not copies:
+                    # Retry against the other holders of this piece
+                    del self.requests[piece_index]
+                    if elapsed >= timeout:
+                        self.timed_out.add(piece_index)
+                    print(f"Piece {piece_index} failed from node {node_id}, retrying")
+                    self.pending.append(piece_index)
+                self.condition.notify_all()
+
+            if piece_data:
+                if self.verifier is None:
+                    self.finish(piece_index, node_id, piece_data, True)
+                else:
+                    # Hash on the worker pool while this thread moves on to
+                    # the next request
+                    self.verifier.submit(piece_index, piece_data).add_done_callback(
+                        lambda future, i=piece_index, n=node_id, d=piece_data: (
+                            self.finish(i, n, d, future)
+                        )
+                    )
+
+    def finish(self, piece_index, node_id, piece_data, valid):
+        # Keep a verified piece, or send a corrupt one back to be fetched
+        # from another holder. `valid` is a bool or the verifier's future.
+        # This may run in a future's done-callback, where exceptions are
+        # swallowed, so a piece that cannot be verified or stored (e.g. a
+        # full disk) is marked failed instead of being waited on forever.
+        try:
+            if hasattr(valid, "result"):
+                valid = valid.result()
+            if valid:
+                self.on_piece(piece_index, piece_data)
+        except Exception as e:
+            print(f"Error keeping piece {piece_index}: {e}")
+            with self.condition:
+                self.failed.append(piece_index)
+                self.remaining -= 1
+                self.condition.notify_all()
+            return
+        with self.condition:
+            if valid:
+                self.remaining -= 1
+            else:
+                print(
+                    f"Piece {piece_index} from node {node_id} is corrupt, re-fetching"
+                )
+                self.pending.append(piece_index)
+            self.condition.notify_all()
+
+    def run(self):
+        # Download every piece, returning the indices that could not be fetched
+        workers = [
+            threading.Thread(target=self.worker)
+            for _ in range(max(1, min(self.max_in_flight, self.remaining)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return sorted(self.failed)
+
+
+class PieceAnnouncer:
+    # Batches the pieces a downloader has stored and reports them to the
+    # tracker, so later downloaders can fetch them from this node
+    def __init__(self, announce, batch_size=32, interval=1.0):
+        # announce(piece_indices) sends one batch
+        self.announce = announce
+        self.batch_size = batch_size
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.pieces = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, piece_index):
+        with self.condition:
+            self.pieces.append(piece_index)
+            if len(self.pieces) >= self.batch_size:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.running and len(self.pieces) < self.batch_size:
+                    self.condition.wait(self.interval)
+                pieces, self.pieces = self.pieces, []
+                running = self.running
+            if pieces:
+                try:
+                    self.announce(pieces)
+                except Exception as e:
+                    print(f"Error announcing pieces: {e}")
+            if not running:
+                return
+
+    def close(self):
+        # Announce whatever is left and stop
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
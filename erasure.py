@@ -0,0 +1,196 @@
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - erasure coding is optional
+    np = None
+
+# GF(256) with the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+PRIMITIVE_POLYNOMIAL = 0x11D
+
+
+def build_tables():
+    exp = [0] * 512
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= PRIMITIVE_POLYNOMIAL
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+
+EXP, LOG = build_tables()
+MUL_TABLE = None
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    return EXP[255 - LOG[a]]
+
+
+def mul_table():
+    # 256 x 256 product table, built on first use
+    global MUL_TABLE
+    if MUL_TABLE is None:
+        MUL_TABLE = np.array(
+            [[gf_mul(a, b) for b in range(256)] for a in range(256)], dtype=np.uint8
+        )
+    return MUL_TABLE
+
+
+def gf_invert_matrix(matrix):
+    # Gauss-Jordan elimination over GF(256); the matrix is k x k and small
+    size = len(matrix)
+    rows = [
+        list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)
+    ]
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, v) for v in rows[col]]
+        for r in range(size):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+class ErasureCoder:
+    # Systematic Reed-Solomon code: k data shards plus m parity shards, any
+    # k of which rebuild the data. Parity rows form a Cauchy matrix, so
+    # every k x k submatrix of [identity; parity rows] is invertible.
+    # Shards are multiplied through a 256 x 256 product table, one NumPy
+    # gather and XOR per coefficient.
+    def __init__(self, k, m):
+        if np is None:
+            raise RuntimeError("Erasure coding requires numpy")
+        if not 0 < k or not 0 < m or k + m > 256:
+            raise ValueError(f"Invalid erasure coding parameters k={k}, m={m}")
+        self.k = k
+        self.m = m
+        self.parity_rows = [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+        self.mul_table = mul_table()
+
+    def row(self, shard_index):
+        # Coefficients that produce a shard from the data shards
+        if shard_index < self.k:
+            return [int(j == shard_index) for j in range(self.k)]
+        return self.parity_rows[shard_index - self.k]
+
+    def combine(self, coefficients, shards):
+        # Sum of coefficient * shard over GF(256)
+        out = np.zeros(len(shards[0]), dtype=np.uint8)
+        for coefficient, shard in zip(coefficients, shards):
+            if coefficient == 1:
+                out ^= shard
+            elif coefficient:
+                out ^= self.mul_table[coefficient][shard]
+        return out
+
+    def encode(self, data_shards):
+        # Return the m parity shards for k equally sized data shards
+        shards = [np.frombuffer(shard, dtype=np.uint8) for shard in data_shards]
+        return [self.combine(row, shards).tobytes() for row in self.parity_rows]
+
+    def decode(self, shards):
+        # Rebuild the k data shards from a dict of at least k shards keyed by
+        # shard index (0..k-1 data, k..k+m-1 parity)
+        if len(shards) < self.k:
+            raise ValueError(f"Need {self.k} shards, got {len(shards)}")
+        chosen = sorted(shards)[: self.k]
+        if chosen == list(range(self.k)):
+            return [shards[i] for i in chosen]
+        inverse = gf_invert_matrix([self.row(i) for i in chosen])
+        arrays = [np.frombuffer(shards[i], dtype=np.uint8) for i in chosen]
+        return [
+            shards[j] if j in shards else self.combine(inverse[j], arrays).tobytes()
+            for j in range(self.k)
+        ]
+
+
+class ErasureLayout:
+    # Where the shards of an erasure-coded file live. Data pieces keep their
+    # indices 0..data_pieces-1; each group of k data pieces gets m parity
+    # pieces, stored after all data pieces at data_pieces + group * m + j.
+    # Short pieces are zero-padded to piece_size for coding, and a final
+    # partial group is padded with zero pieces that are never stored.
+    def __init__(self, k, m, data_pieces, piece_size):
+        self.k = k
+        self.m = m
+        self.data_pieces = data_pieces
+        self.piece_size = piece_size
+
+    @classmethod
+    def from_metadata(cls, erasure):
+        return cls(
+            erasure["k"], erasure["m"], erasure["data_pieces"], erasure["piece_size"]
+        )
+
+    def to_metadata(self):
+        return {
+            "k": self.k,
+            "m": self.m,
+            "data_pieces": self.data_pieces,
+            "piece_size": self.piece_size,
+        }
+
+    @property
+    def groups(self):
+        return -(-self.data_pieces // self.k)
+
+    @property
+    def total_pieces(self):
+        return self.data_pieces + self.groups * self.m
+
+    def group_of(self, piece_index):
+        if piece_index < self.data_pieces:
+            return piece_index // self.k
+        return (piece_index - self.data_pieces) // self.m
+
+    def shard_index(self, piece_index):
+        # Position of a stored piece within its group's k + m shards
+        if piece_index < self.data_pieces:
+            return piece_index % self.k
+        return self.k + (piece_index - self.data_pieces) % self.m
+
+    def data_indices(self, group):
+        start = group * self.k
+        return list(range(start, min(start + self.k, self.data_pieces)))
+
+    def parity_indices(self, group):
+        start = self.data_pieces + group * self.m
+        return list(range(start, start + self.m))
+
+    def pad(self, piece):
+        return piece + bytes(self.piece_size - len(piece))
+
+
+class ErasureEncoder:
+    # Collects data pieces as they stream past and returns the parity
+    # pieces of each group once it is complete
+    def __init__(self, layout):
+        self.layout = layout
+        self.coder = ErasureCoder(layout.k, layout.m)
+        self.group = []
+
+    def add(self, piece_index, piece):
+        # Returns [(parity_index, parity)] when piece completes a group
+        self.group.append(self.layout.pad(piece))
+        last = piece_index == self.layout.data_pieces - 1
+        if len(self.group) < self.layout.k and not last:
+            return []
+        while len(self.group) < self.layout.k:
+            self.group.append(bytes(self.layout.piece_size))
+        parity = self.coder.encode(self.group)
+        self.group = []
+        indices = self.layout.parity_indices(self.layout.group_of(piece_index))
+        return list(zip(indices, parity))
@@ -17,3 +17,8 @@ def generate_file_hash(file_path):
 def create_magnet_link(file_hash, file_name):
     """Create a magnet link using the file hash and file name."""
     return f"magnet:?xt=urn:btih:{file_hash}&dn={file_name}"
+
+
+def generate_piece_hash(piece):
+    """Generate the SHA-1 hash of one piece."""
+    return hashlib.sha1(piece).hexdigest()
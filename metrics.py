@@ -0,0 +1,208 @@
+import bisect
+import os
+import threading
+import time
+
+# Latency histogram bucket upper bounds in seconds: 0.1 ms doubling to ~52 s
+LATENCY_BUCKETS = [0.0001 * 2**i for i in range(20)]
+
+
+def label_text(label, value):
+    if label is None:
+        return ""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'{{{label}="{escaped}"}}'
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, count in self.snapshot().items():
+            lines.append(f"{self.name}{label_text(self.label, value)} {count}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label value -> [bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, label_value, amount):
+        i = bisect.bisect_left(self.buckets, amount)
+        with self.lock:
+            value = self.values.get(label_value)
+            if value is None:
+                value = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0, 0]
+            value[0][i] += 1
+            value[1] += amount
+            value[2] += 1
+
+    def time(self, label_value=None):
+        return Timer(self, label_value)
+
+    def quantile(self, counts, total, q):
+        # Upper bound of the bucket holding the q-quantile
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        with self.lock:
+            values = {k: (list(v[0]), v[1], v[2]) for k, v in self.values.items()}
+        return {
+            label_value: {
+                "count": count,
+                "sum": total,
+                "p50": self.quantile(counts, count, 0.5),
+                "p99": self.quantile(counts, count, 0.99),
+            }
+            for label_value, (counts, total, count) in values.items()
+        }
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = {k: (list(v[0]), v[1], v[2]) for k, v in self.values.items()}
+        for label_value, (counts, total, count) in values.items():
+            prefix = "" if self.label is None else f'{self.label}="{label_value}",'
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            labels = label_text(self.label, label_value)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(self.label_value, time.perf_counter() - self.start)
+
+
+class Gauge:
+    # Read from `read` when stats are taken, so it costs nothing in between.
+    # With a label, `read` returns {label value: number}.
+    def __init__(self, name, help, read, label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def snapshot(self):
+        value = self.read()
+        if self.label is None:
+            return value
+        return {k: v for k, v in value.items() if isinstance(v, (int, float))}
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.snapshot()
+        if self.label is None:
+            lines.append(f"{self.name} {value}")
+        else:
+            for label_value, number in value.items():
+                lines.append(
+                    f"{self.name}{label_text(self.label, label_value)} {number}"
+                )
+        return lines
+
+
+class Metrics:
+    """Counters, latency histograms and gauges of one server.
+
+    Counters and histograms are updated in place on the request path, one
+    short lock each; gauges are only read when a snapshot is taken.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = {}
+        self.started = time.time()
+        self.gauge("uptime_seconds", "Seconds since start", self.uptime)
+        self.gauge("threads", "Live threads", threading.active_count)
+
+    def add(self, metric):
+        metric.name = f"{self.prefix}_{metric.name}"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.add(Counter(name, help, label))
+
+    def histogram(self, name, help, label=None):
+        return self.add(Histogram(name, help, label))
+
+    def gauge(self, name, help, read, label=None):
+        return self.add(Gauge(name, help, read, label))
+
+    def uptime(self):
+        return time.time() - self.started
+
+    def snapshot(self):
+        # JSON-ready values of every metric, for the stats command
+        stats = {}
+        for name, metric in self.metrics.items():
+            value = metric.snapshot()
+            if isinstance(value, dict):
+                value = {str(k) if k is not None else "": v for k, v in value.items()}
+            stats[name[len(self.prefix) + 1 :]] = value
+        return stats
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # Write the Prometheus text format atomically, e.g. for node_exporter
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def start_dump(self, path, interval, running):
+        # Rewrite the dump every `interval` seconds while running() is true
+        def dump_loop():
+            while running():
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    print(f"Error writing metrics to {path}: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=dump_loop, daemon=True).start()
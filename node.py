@@ -1,24 +1,230 @@
+import argparse
 import os
+import shutil
 import socket
 import threading
 import json
+import multiprocessing
 import time
+import uuid
+from concurrent.futures import (
+    CancelledError,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 
-from function import generate_file_hash, create_magnet_link
+from chunking import content_defined_chunks, fixed_chunks
+from distribution import encode_distribution, response_distribution
+from downloader import DownloadSink, PeerStats, PieceAnnouncer, PieceDownloader
+from erasure import ErasureCoder, ErasureEncoder, ErasureLayout
+from function import create_magnet_link
+from piece_store import open_piece_store
+from cache import PieceCache
+from compression import (
+    CODEC_NAMES,
+    CODEC_NONE,
+    CODECS,
+    STORED_MAGIC,
+    STORED_PREFIX_SIZE,
+    compress_piece,
+    decode_payload,
+    is_stored,
+    unwrap_stored,
+    wrap_stored,
+)
+from metrics import Metrics
+from placement import WeightedPlacement, create_placement
+from pool import ConnectionPool
+from protocol import (
+    CMD_DOWNLOAD_PIECE,
+    CMD_HELLO,
+    CMD_UPLOAD_PIECE,
+    CODEC_FLAG,
+    STATUS_ERROR,
+    STATUS_OK,
+    ProtocolError,
+    is_binary_request,
+    is_legacy_message,
+    recv_frame,
+    recv_json,
+    recv_message,
+    send_frame,
+    send_frame_file,
+    send_message,
+)
+from shards import shard_index
+from uploader import ChunkUploader, PieceUploader
+from verify import PieceVerifier, create_hash_executor
 
 FORMAT = "utf-8"
 SIZE = 1024 * 1024
 
+# Metric names of binary commands, matching their JSON counterparts
+BINARY_COMMANDS = {
+    CMD_UPLOAD_PIECE: "upload_piece",
+    CMD_DOWNLOAD_PIECE: "download_piece",
+}
+
 
 class Node:
-    def __init__(self, tracker_host, tracker_port):
+    def __init__(
+        self,
+        tracker_host,
+        tracker_port,
+        cache_size=64 * 1024 * 1024,
+        host=None,
+        port=None,
+        directory=None,
+    ):
         self.tracker_host = tracker_host
         self.tracker_port = tracker_port
-        self.ip_address = self.get_ip_address()
-        self.port = self.get_port()
+        self.ip_address = host or self.get_ip_address()
+        self.port = port or self.get_port()
         self.node_id = None
+        # Each node keeps its pieces in node<id> under this directory
+        self.directory = directory or os.path.dirname(__file__)
         self.file_directory = None
         self.running = True
+        # Piece storage: "packed" pack files or the "directory" layout
+        self.storage_backend = "packed"
+        self.piece_store = None
+        self.compact_interval = 600
+        # In-memory cache of hot pieces, `cache_size` bytes (0 disables it)
+        self.piece_cache = PieceCache(cache_size)
+        # Peers that only speak the JSON piece protocol
+        self.legacy_peers = set()
+        # Caps on concurrent piece requests, overall and per peer
+        self.max_in_flight = 8
+        self.max_per_peer = 4
+        # Endgame: the last few pieces are requested from several holders
+        self.endgame_pieces = 4
+        self.endgame_copies = 3
+        # Replica placement: "round_robin", "consistent_hash" or "weighted"
+        # (by free disk from heartbeat load reports)
+        self.placement_strategy = "round_robin"
+        self.replication_factor = 2
+        # replicas -> (strategy, weights, placement), kept across uploads so
+        # a consistent-hash ring is only rebuilt when the membership changes
+        self.placements = {}
+        self.placements_lock = threading.Lock()
+        # (k, m) to store files as k data plus m Reed-Solomon parity pieces
+        # per group, one piece per node, instead of replicating every piece
+        self.erasure_coding = None
+        # Codec ("zlib", "lzma" or "bz2") for compressing uploaded pieces on
+        # the wire and at rest, or None. Compression runs on a process pool.
+        self.compression = None
+        self.compression_executor = None
+        # A pool whose worker died is replaced this many times before
+        # compression is turned off
+        self.compression_restarts = 3
+        self.compression_stats = {
+            "pieces": 0,
+            "compressed": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "cpu_seconds": 0.0,
+        }
+        self.stats_lock = threading.Lock()
+        # Content-addressed deduplication: None uploads files as plain
+        # pieces; "fixed" or "cdc" (content-defined, needs numpy) uploads
+        # them as chunks stored once under their own hash and shared by
+        # every file that contains them
+        self.chunking = None
+        # Swarm mode: downloaded pieces are verified, kept in the piece store
+        # and announced to the tracker in batches, so every downloader also
+        # serves the file. Holder lists are refreshed during long downloads.
+        self.share_downloads = True
+        self.announce_batch = 32
+        self.announce_interval = 1.0
+        self.holder_refresh_interval = 5
+        # Upload sender threads and the number of piece sends buffered ahead
+        self.upload_workers = 4
+        self.upload_queue_size = 4
+        # Most requests sent to the tracker in one batch request
+        self.tracker_batch_size = 64
+        # File shards (host, port) of a sharded tracker, from the register
+        # reply: file commands go to the shard owning the file name, the
+        # rest to the tracker. Empty for a single tracker.
+        self.shards = []
+        # file_hash -> shard of the files resolved or uploaded through one
+        self.file_shards = {}
+        # Persistent connections to peers and the tracker
+        self.pool = ConnectionPool(idle_timeout=30)
+        self.request_timeout = 60
+        # Per-peer throughput and round-trip estimates from piece downloads;
+        # piece requests time out adaptively, at most after request_timeout
+        self.peer_stats = PeerStats(max_timeout=self.request_timeout)
+        # Binary requests from all connections are served on this pool
+        self.request_executor = ThreadPoolExecutor(max_workers=8)
+        self.server_idle_timeout = 120
+        # Cached tracker membership, refreshed incrementally after the TTL
+        self.membership = {}
+        self.membership_epoch = None
+        self.membership_version = None
+        self.membership_checked = float("-inf")
+        self.membership_ttl = 5
+        self.membership_lock = threading.Lock()
+        # Heartbeats keep the node registered; the tracker expires it after
+        # missing a few of them
+        self.heartbeat_interval = 10
+        self.active_transfers = 0
+        self.transfer_lock = threading.Lock()
+        # Worker pool for piece hashing and verification
+        self.hash_executor = create_hash_executor()
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        self.handlers = {
+            "upload_piece": self.receive_piece_upload,
+            "download_piece": self.send_piece,
+            "commit_upload": self.receive_commit_upload,
+            "abort_upload": self.receive_abort_upload,
+            "replicate_piece": self.replicate_piece,
+            "stats": self.stats,
+        }
+        # Served by the stats command, and dumped in Prometheus text format
+        # to `metrics_file` every `metrics_interval` seconds if set
+        self.metrics_file = None
+        self.metrics_interval = 10
+        self.metrics = Metrics("node")
+        self.requests = self.metrics.counter(
+            "requests_total", "Requests served", "command"
+        )
+        self.request_seconds = self.metrics.histogram(
+            "request_seconds", "Request handling time", "command"
+        )
+        self.tracker_seconds = self.metrics.histogram(
+            "tracker_request_seconds",
+            "Round trip of requests to the tracker",
+            "command",
+        )
+        # Peers are host:port for connections this node opened, host only
+        # for connections from others
+        self.bytes_sent = self.metrics.counter(
+            "sent_bytes_total", "Piece payload bytes sent", "peer"
+        )
+        self.bytes_received = self.metrics.counter(
+            "received_bytes_total", "Piece payload bytes received", "peer"
+        )
+        self.metrics.gauge(
+            "connections", "Open incoming connections", lambda: self.connections
+        )
+        self.metrics.gauge("piece_store_bytes", "Stored piece bytes", self.store_size)
+        self.metrics.gauge(
+            "piece_cache", "Piece cache statistics", self.piece_cache.stats, "stat"
+        )
+        self.metrics.gauge(
+            "pool", "Connection pool statistics", self.pool.stats, "stat"
+        )
+        self.metrics.gauge(
+            "compression", "Upload compression", self.compression_report, "stat"
+        )
+        self.metrics.gauge(
+            "peer_throughput_bytes",
+            "Estimated piece download throughput per second",
+            self.peer_stats.snapshot,
+            "peer",
+        )
 
     def get_ip_address(self):
         # Get the IP address of the current machine
@@ -32,53 +238,119 @@ class Node:
             port = s.getsockname()[1]
         return port
 
-    def send_request(self, data):
-        # Send a JSON request to the tracker and return the response
+    def send_request(self, data, address=None):
+        # Send a JSON request to the tracker, or the shard it belongs to,
+        # and return the response
+        if address is None:
+            address = self.tracker_address(data)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.tracker_host, self.tracker_port))
-                s.sendall(json.dumps(data).encode(FORMAT))
-                response = s.recv(SIZE)
-                return json.loads(response.decode(FORMAT))
+            with self.tracker_seconds.time(data.get("command")):
+                return self.send_control(address, data)
         except Exception as e:
             print(f"Error sending request: {e}")
             return {"status": "error", "message": str(e)}
 
+    def tracker_address(self, data):
+        # Where a tracker request goes: uploads and downloads to the shard
+        # owning the file name, requests about a known file to its shard,
+        # and everything else to the tracker
+        if self.shards:
+            command = data.get("command")
+            if command in ("upload", "download", "resolve"):
+                return self.shard_for(data["file_name"])
+            if command in ("announce", "get_holders"):
+                address = self.file_shards.get(data["file_hash"])
+                if address is not None:
+                    return address
+        return (self.tracker_host, self.tracker_port)
+
+    def shard_for(self, file_name):
+        return self.shards[shard_index(file_name, len(self.shards))]
+
+    def send_batch(self, requests):
+        # Send several tracker requests in batch requests of up to
+        # `tracker_batch_size` per tracker or shard, returning their
+        # responses in order. Trackers without batch support get them one
+        # at a time.
+        groups = {}
+        for i, request in enumerate(requests):
+            groups.setdefault(self.tracker_address(request), []).append(i)
+        responses = [None] * len(requests)
+        for address, indices in groups.items():
+            for start in range(0, len(indices), self.tracker_batch_size):
+                batch_indices = indices[start : start + self.tracker_batch_size]
+                requests_batch = [requests[i] for i in batch_indices]
+                response = self.send_request(
+                    {"command": "batch", "requests": requests_batch}, address
+                )
+                if response["status"] == "success":
+                    batch_responses = response["responses"]
+                elif response.get("message") == "Unknown command":
+                    batch_responses = [self.send_request(r) for r in requests_batch]
+                else:
+                    batch_responses = [response] * len(requests_batch)
+                for i, batch_response in zip(batch_indices, batch_responses):
+                    responses[i] = batch_response
+        return responses
+
     def send_node_request(self, data):
         # Send a JSON request to another node and return the response
         source_node_ip_address = data["source_node_ip_address"]
         source_node_port = data["source_node_port"]
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((source_node_ip_address, source_node_port))
-                s.sendall(json.dumps(data).encode(FORMAT))
-                response = s.recv(SIZE)
-                return json.loads(response.decode(FORMAT))
+            return self.send_control((source_node_ip_address, source_node_port), data)
         except Exception as e:
             print(f"Error sending request: {e}")
             return {"status": "error", "message": str(e)}
 
+    def send_control(self, address, data):
+        # Send one length-prefixed JSON request over a pooled connection,
+        # falling back to bare JSON for peers that close on framed input
+        if address not in self.legacy_peers:
+            response = self.pool.request_message(address, data)
+            if response is not None:
+                return response
+            self.legacy_peers.add(address)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect(address)
+            s.sendall(json.dumps(data).encode(FORMAT))
+            return recv_json(s)
+
     def register_with_tracker(self):
         # Register the node with the tracker
         data = {
             "command": "register",
             "ip_address": self.ip_address,
             "port": self.port,
+            "heartbeat_interval": self.heartbeat_interval,
         }
         response = self.send_request(data)
         if response["status"] == "registered":
             self.node_id = response["node_id"]
-            self.file_directory = os.path.join(
-                os.path.dirname(__file__),
-                f"node{self.node_id}",
-            )
+            self.shards = [
+                (shard["ip_address"], shard["port"])
+                for shard in response.get("shards", [])
+            ]
+            self.file_directory = os.path.join(self.directory, f"node{self.node_id}")
             os.makedirs(self.file_directory, exist_ok=True)
+            self.piece_store = open_piece_store(
+                self.storage_backend, self.file_directory
+            )
+            if self.compression:
+                self.pool.codecs = tuple(CODECS)
+                self.compression_executor = self.create_compression_executor()
             print(f"\033[1;31mRegistered with tracker, node ID: {self.node_id}\033[0m")
         else:
             print("Failed to register with tracker:", response["message"])
 
     def node_start(self):
         # Start the node server to listen for incoming connections
+        threading.Thread(target=self.maintenance_loop, daemon=True).start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+        if self.metrics_file:
+            self.metrics.start_dump(
+                self.metrics_file, self.metrics_interval, lambda: self.running
+            )
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind((self.ip_address, self.port))
             s.listen()
@@ -97,110 +369,722 @@ class Node:
                 except Exception as e:
                     print(f"Error accepting connection: {e}")
 
+    def maintenance_loop(self):
+        # Periodically reclaim space left behind by deleted pieces
+        while self.running:
+            time.sleep(self.compact_interval)
+            if self.piece_store is not None:
+                try:
+                    self.piece_store.compact()
+                except Exception as e:
+                    print(f"Error compacting piece store: {e}")
+
+    def heartbeat_loop(self):
+        # Tell the tracker this node is alive, with a small load report
+        while self.running:
+            time.sleep(self.heartbeat_interval)
+            if not self.running:
+                # A heartbeat after disconnecting would re-admit the node
+                return
+            if self.node_id is None:
+                continue
+            data = {
+                "command": "heartbeat",
+                "node_id": self.node_id,
+                "ip_address": self.ip_address,
+                "port": self.port,
+                "heartbeat_interval": self.heartbeat_interval,
+                "load": self.load_report(),
+            }
+            response = self.send_request(data)
+            if response["status"] != "alive":
+                print("Heartbeat failed:", response.get("message"))
+
+    def load_report(self):
+        return {
+            "free_disk": shutil.disk_usage(self.file_directory).free,
+            "active_transfers": self.active_transfers,
+        }
+
     def handle_node_request(self, client_socket):
         # Handle incoming requests from other nodes
+        with self.connections_lock:
+            self.connections += 1
         try:
-            data = client_socket.recv(SIZE).decode(FORMAT)
-            if not data:
-                print("Received empty data. Closing connection.")
+            if is_binary_request(client_socket):
+                self.handle_binary_requests(client_socket)
                 return
 
-            request = json.loads(data)
-            command = request.get("command")
-            print(f"\033[1;33mReceived command: {command}\033[0m")
+            if is_legacy_message(client_socket):
+                request = recv_json(client_socket)
+                if not request:
+                    print("Received empty data. Closing connection.")
+                    return
+                response = self.dispatch(request)
+                client_socket.sendall(json.dumps(response).encode(FORMAT))
+                return
 
-            if command == "upload_piece":
-                self.receive_piece_upload(request, client_socket)
-            elif command == "download_piece":
-                self.send_piece(request, client_socket)
-            else:
-                response = {"status": "error", "message": "Unknown command"}
-                client_socket.send(json.dumps(response).encode(FORMAT))
+            while self.running:
+                request = recv_message(client_socket)
+                if request is None:
+                    return
+                send_message(client_socket, self.dispatch(request))
         except Exception as e:
             print(f"Error handling request: {e}")
         finally:
+            with self.connections_lock:
+                self.connections -= 1
             self.display_interface()
             client_socket.close()
 
+    def dispatch(self, request):
+        # Run one JSON command from another node and return its response
+        command = request.get("command")
+        if command != "stats":
+            print(f"\033[1;33mReceived command: {command}\033[0m")
+        handler = self.handlers.get(command)
+        if handler is None:
+            self.requests.inc("unknown")
+            return {"status": "error", "message": "Unknown command"}
+        self.requests.inc(command)
+        with self.request_seconds.time(command):
+            return handler(request)
+
+    def stats(self, request):
+        # Report request counts and latencies, traffic per peer, connections,
+        # storage, cache, pool and compression statistics
+        return {"status": "success", "stats": self.metrics.snapshot()}
+
+    def store_size(self):
+        return self.piece_store.size() if self.piece_store is not None else 0
+
+    def handle_binary_requests(self, client_socket):
+        # Serve binary requests on one connection until the peer closes it.
+        # Requests run on the worker pool, so replies can go out in any
+        # order; the request id in each reply tells the peer which is which.
+        send_lock = threading.Lock()
+        in_flight = [0]
+        # Codecs the peer can decode, from its hello
+        codecs = set()
+        peer = client_socket.getpeername()[0]
+        client_socket.settimeout(self.server_idle_timeout)
+        while self.running:
+            # The connection is idle until the first byte of the next frame;
+            # a timeout after that leaves the stream misaligned
+            try:
+                if not client_socket.recv(1, socket.MSG_PEEK):
+                    return
+            except socket.timeout:
+                if in_flight[0]:
+                    continue
+                return
+            except ConnectionError:
+                return
+            try:
+                frame = recv_frame(client_socket)
+            except (socket.timeout, ConnectionError, ProtocolError):
+                return
+            if frame.command == CMD_HELLO:
+                # Handled before reading on, so later frames see the codecs
+                offered = bytes(frame.payload).decode(FORMAT).split(",")
+                accepted = [codec for codec in offered if codec in CODECS]
+                codecs.update(accepted)
+                with send_lock:
+                    send_frame(
+                        client_socket,
+                        CMD_HELLO,
+                        frame.file_hash,
+                        0,
+                        ",".join(accepted).encode(FORMAT),
+                        request_id=frame.request_id,
+                    )
+                continue
+            with send_lock:
+                in_flight[0] += 1
+            with self.transfer_lock:
+                self.active_transfers += 1
+            self.request_executor.submit(
+                self.handle_binary_request,
+                client_socket,
+                send_lock,
+                in_flight,
+                codecs,
+                peer,
+                frame,
+            )
+
+    def handle_binary_request(
+        self, client_socket, send_lock, in_flight, codecs, peer, frame
+    ):
+        # Handle one binary-framed piece request from another node
+        start = time.perf_counter()
+        command = frame.command & ~CODEC_FLAG
+        file_hash = frame.file_hash
+        piece_index = frame.piece_index
+        print(f"\033[1;33mReceived binary command: {command}\033[0m")
+
+        payload = b""
+        status = STATUS_OK
+        piece_file = None
+        reply_command = command
+        try:
+            if command == CMD_UPLOAD_PIECE:
+                if frame.command & CODEC_FLAG:
+                    # Kept compressed at rest, exactly as it arrived
+                    self.piece_store.put(
+                        file_hash, piece_index, wrap_stored(frame.payload)
+                    )
+                else:
+                    self.store_piece(file_hash, piece_index, frame.payload)
+                print(f"Piece {piece_index} saved successfully!")
+            elif command == CMD_DOWNLOAD_PIECE:
+                key = (file_hash, piece_index)
+                payload = self.piece_cache.get(key)
+                if payload is None:
+                    piece_file = self.open_piece(file_hash, piece_index)
+                    stored_codec = None
+                    if piece_file is not None:
+                        stored_codec = self.stored_codec(piece_file)
+                    if piece_file is None:
+                        payload = b"Piece not found"
+                        status = STATUS_ERROR
+                    elif stored_codec in codecs:
+                        # The peer decodes this codec: send the stored bytes
+                        # as they are, codec byte first
+                        reply_command = command | CODEC_FLAG
+                        piece_file.offset += len(STORED_MAGIC)
+                        piece_file.length -= len(STORED_MAGIC)
+                    elif stored_codec is not None:
+                        payload = unwrap_stored(piece_file.read())
+                        piece_file.close()
+                        piece_file = None
+                        if self.piece_cache.should_admit(key):
+                            self.piece_cache.put(key, payload)
+                    elif self.piece_cache.should_admit(key):
+                        # Requested again soon after a miss: keep it in memory
+                        payload = piece_file.read()
+                        self.piece_cache.put(key, payload)
+                        piece_file.close()
+                        piece_file = None
+            else:
+                payload = b"Unknown command"
+                status = STATUS_ERROR
+        except Exception as e:
+            payload = str(e).encode(FORMAT)
+            status = STATUS_ERROR
+
+        try:
+            with send_lock:
+                if piece_file is not None:
+                    # Zero-copy: the kernel moves the piece from the page
+                    # cache to the socket
+                    send_frame_file(
+                        client_socket,
+                        reply_command,
+                        file_hash,
+                        piece_index,
+                        piece_file.file,
+                        piece_file.offset,
+                        piece_file.length,
+                        request_id=frame.request_id,
+                    )
+                else:
+                    send_frame(
+                        client_socket,
+                        command,
+                        file_hash,
+                        piece_index,
+                        payload,
+                        status,
+                        request_id=frame.request_id,
+                    )
+        except OSError as e:
+            print(f"Error replying to request {frame.request_id}: {e}")
+        finally:
+            name = BINARY_COMMANDS.get(command, "unknown")
+            self.requests.inc(name)
+            self.request_seconds.observe(name, time.perf_counter() - start)
+            self.bytes_received.inc(peer, len(frame.payload))
+            sent = piece_file.length if piece_file is not None else len(payload)
+            self.bytes_sent.inc(peer, sent)
+            if piece_file is not None:
+                piece_file.close()
+            with send_lock:
+                in_flight[0] -= 1
+            with self.transfer_lock:
+                self.active_transfers -= 1
+
     def upload_file(self, file_path, file_name):
-        # Upload a file by dividing it into pieces and sending to active nodes
+        # Upload a file by streaming its pieces to active nodes, returning
+        # whether the tracker recorded it
+        data = self.prepare_upload(file_path, file_name)
+        if data is None:
+            return False
+        return self.record_upload(data, self.send_request(data))
+
+    def upload_many(self, files, max_concurrent=4):
+        # Upload (file_path, file_name) pairs, returning {file_name: uploaded}.
+        # Up to `max_concurrent` files are sent at once, and finished ones
+        # are recorded with the tracker in batches.
+        active_nodes = self.get_active_nodes()
+        results = {}
+        ready = []
+        with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+            futures = {
+                executor.submit(self.prepare_upload, path, name, active_nodes): name
+                for path, name in files
+            }
+            for future in as_completed(futures):
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print(f"Failed to upload file {futures[future]}: {e}")
+                    data = None
+                if data is None:
+                    results[futures[future]] = False
+                    continue
+                ready.append(data)
+                if len(ready) >= self.tracker_batch_size:
+                    self.record_uploads(ready, results)
+                    ready = []
+        self.record_uploads(ready, results)
+        return results
+
+    def record_uploads(self, requests, results):
+        responses = self.send_batch(requests)
+        for data, response in zip(requests, responses):
+            results[data["file_name"]] = self.record_upload(data, response)
+
+    def record_upload(self, data, response):
+        # Report the tracker's reply to an upload request
+        file_name = data["file_name"]
+        if response["status"] == "uploaded":
+            print(f"File {file_name} uploaded successfully.")
+            if self.shards:
+                self.file_shards[data["file_hash"]] = self.shard_for(file_name)
+            if self.compression:
+                report = self.compression_report()
+                print(
+                    f"Compression: {report['compressed']}/{report['pieces']} pieces, "
+                    f"ratio {report['ratio']:.2f}, "
+                    f"{report['cpu_ms_per_piece']:.1f} ms CPU per piece"
+                )
+            return True
+        print(f"Failed to upload file {file_name}: {response['message']}")
+        return False
+
+    def prepare_upload(self, file_path, file_name, active_nodes=None):
+        # Stream a file's pieces to active nodes and return the tracker
+        # request that records it, or None if it could not be stored
         if not os.path.exists(file_path):
             print("File does not exist!")
-            return
+            return None
         if not os.path.isfile(file_path):
             print("File type is not valid!")
-            return
+            return None
 
         print(f"Node: {self.node_id}, port: {self.port}")
         print(f"Uploading file: {file_path}")
 
-        file_hash = generate_file_hash(file_path)
-        magnet_link = create_magnet_link(file_hash, file_name)
-        pieces = self.divide_file(file_path)
-        active_nodes = self.get_active_nodes()
+        if active_nodes is None:
+            active_nodes = self.get_active_nodes()
         if not active_nodes:
             print("No active nodes available for file distribution.")
-            return
+            return None
+
+        if self.chunking:
+            return self.upload_chunks(file_path, file_name, active_nodes)
 
         node_ids = list(active_nodes.keys())
-        piece_distribution = {}
 
-        for index, piece in enumerate(pieces):
-            piece_distribution[index] = []
+        # The file hash is only known after the single read pass, so pieces
+        # are staged under a random id and renamed once the hash is final
+        staging_id = uuid.uuid4().hex + os.urandom(4).hex()
+
+        layout = None
+        encoder = None
+        if self.erasure_coding:
+            k, m = self.erasure_coding
+            data_pieces = -(-os.path.getsize(file_path) // SIZE)
+            layout = ErasureLayout(k, m, data_pieces, SIZE)
+            encoder = ErasureEncoder(layout)
+            # Spread the k + m shards of each group over distinct nodes
+            placement = self.placement_for(k + m)
+
+            def targets_for(index):
+                group_nodes = placement.place(
+                    staging_id, layout.group_of(index), node_ids
+                )
+                return [group_nodes[layout.shard_index(index) % len(group_nodes)]]
+
+        else:
+            placement = self.placement_for(self.replication_factor)
+
+            def targets_for(index):
+                return placement.place(staging_id, index, node_ids)
+
+        uploader = PieceUploader(
+            self,
+            staging_id,
+            active_nodes,
+            targets_for,
+            max_workers=self.upload_workers,
+            queue_size=self.upload_queue_size,
+            hash_executor=self.hash_executor,
+            compress=self.compress_piece,
+        )
+        try:
+            file_hash = uploader.run(self.divide_file(file_path), encoder)
+        except Exception:
+            self.abort_upload(uploader.targets, active_nodes, staging_id)
+            raise
+        piece_distribution = uploader.piece_distribution
+        if layout is not None and uploader.data_pieces != layout.data_pieces:
+            print(f"Failed to upload file {file_name}: file changed while reading")
+            self.abort_upload(uploader.targets, active_nodes, staging_id)
+            return None
 
-            target_node_id_1 = node_ids[index % len(node_ids)]
-            target_node_1 = active_nodes[target_node_id_1]
-            self.send_piece_upload(
-                target_node_id_1, target_node_1, file_hash, index, piece
+        missing = [i for i, holders in piece_distribution.items() if not holders]
+        if missing:
+            print(
+                f"Failed to upload file {file_name}: pieces {missing} were not stored"
             )
-            piece_distribution[index].append(target_node_id_1)
+            self.abort_upload(uploader.targets, active_nodes, staging_id)
+            return None
 
-            target_node_id_2 = node_ids[(index + 1) % len(node_ids)]
-            target_node_2 = active_nodes[target_node_id_2]
-            self.send_piece_upload(
-                target_node_id_2, target_node_2, file_hash, index, piece
+        holders = {node_id for ids in piece_distribution.values() for node_id in ids}
+        failed = {
+            node_id
+            for node_id in holders
+            if not self.commit_upload(
+                node_id, active_nodes[node_id], staging_id, file_hash
             )
-            piece_distribution[index].append(target_node_id_2)
+        }
+        if failed:
+            for index in piece_distribution:
+                piece_distribution[index] = [
+                    node_id
+                    for node_id in piece_distribution[index]
+                    if node_id not in failed
+                ]
+            missing = [i for i, ids in piece_distribution.items() if not ids]
+            if missing:
+                print(
+                    f"Failed to upload file {file_name}: pieces {missing} were not committed"
+                )
+                # Nodes that did commit hold the pieces under the file hash,
+                # where they may also belong to an earlier upload of the
+                # same file, so only the failed nodes' staging is discarded
+                self.abort_upload(failed, active_nodes, staging_id)
+                return None
 
+        magnet_link = create_magnet_link(file_hash, file_name)
         data = {
             "command": "upload",
             "node_id": self.node_id,
             "file_name": file_name,
             "file_hash": file_hash,
             "magnet_link": magnet_link,
-            "total_pieces": len(pieces),
-            "piece_distribution": piece_distribution,
+            "total_pieces": uploader.data_pieces,
+            "file_size": uploader.file_size,
+            "piece_hashes": uploader.piece_hashes,
+            "replication_factor": self.replication_factor,
+            "piece_layout": encode_distribution(piece_distribution),
         }
-        response = self.send_request(data)
-        if response["status"] == "uploaded":
-            print(f"File {file_name} uploaded successfully.")
+        if layout is not None:
+            # Each shard is stored once; redundancy comes from the parity
+            data["erasure"] = layout.to_metadata()
+            data["replication_factor"] = 1
+        return data
+
+    def upload_chunks(self, file_path, file_name, active_nodes):
+        # Upload a file as content-addressed chunks, sending only the chunks
+        # no node stores yet, and return the tracker request that records it
+        node_ids = list(active_nodes.keys())
+        # Chunks are placed by their hash, the only thing that identifies
+        # them; round-robin would put every chunk on the same first nodes
+        if self.placement_strategy == "round_robin":
+            placement = WeightedPlacement(self.replication_factor)
         else:
-            print(f"Failed to upload file {file_name}: {response['message']}")
+            placement = self.placement_for(self.replication_factor)
+
+        def targets_for(chunk_hash):
+            return placement.place(chunk_hash, 0, node_ids)
+
+        uploader = ChunkUploader(
+            self,
+            active_nodes,
+            targets_for,
+            self.find_chunks,
+            max_workers=self.upload_workers,
+            queue_size=self.upload_queue_size,
+            hash_executor=self.hash_executor,
+            compress=self.compress_piece,
+        )
+        with open(file_path, "rb") as f:
+            if self.chunking == "cdc":
+                chunks = content_defined_chunks(f)
+            else:
+                chunks = fixed_chunks(f, SIZE)
+            file_hash = uploader.run(chunks)
+
+        chunk_holders = uploader.piece_distribution
+        missing = [h for h, holders in chunk_holders.items() if not holders]
+        if missing:
+            print(
+                f"Failed to upload file {file_name}: {len(missing)} chunks were not stored"
+            )
+            return None
+
+        piece_distribution = {
+            str(i): chunk_holders[chunk_hash]
+            for i, chunk_hash in enumerate(uploader.piece_hashes)
+        }
+        magnet_link = create_magnet_link(file_hash, file_name)
+        data = {
+            "command": "upload",
+            "node_id": self.node_id,
+            "file_name": file_name,
+            "file_hash": file_hash,
+            "magnet_link": magnet_link,
+            "total_pieces": uploader.data_pieces,
+            "file_size": uploader.file_size,
+            "piece_hashes": uploader.piece_hashes,
+            "chunks": uploader.piece_hashes,
+            "chunk_sizes": uploader.chunk_sizes,
+            "replication_factor": self.replication_factor,
+            "piece_layout": encode_distribution(piece_distribution),
+        }
+        print(
+            f"Chunks of {file_name} stored: {uploader.sent_bytes} bytes sent, "
+            f"{uploader.reused_bytes} bytes deduplicated"
+        )
+        return data
+
+    def find_chunks(self, chunk_hashes):
+        # Ask the tracker which chunks are already stored, and where. Chunks
+        # are indexed by the shard of each file that uses them, so a sharded
+        # tracker is asked on every shard.
+        if not chunk_hashes:
+            return {}
+        request = {"command": "find_chunks", "chunks": chunk_hashes}
+        found = {}
+        for address in self.shards or [None]:
+            response = self.send_request(request, address)
+            if response["status"] != "success":
+                # Without an answer those chunks are sent again
+                continue
+            for chunk_hash, holders in response["chunks"].items():
+                known = found.setdefault(chunk_hash, [])
+                known.extend(n for n in holders if n not in known)
+        return found
+
+    def placement_for(self, replicas):
+        # The configured placement strategy for `replicas` copies, rebuilt
+        # only when the strategy or the weights it was built with change
+        options = {}
+        if self.placement_strategy == "weighted":
+            response = self.send_request({"command": "get_loads"})
+            loads = response.get("loads", {})
+            options["weights"] = {
+                node_id: load["free_disk"]
+                for node_id, load in loads.items()
+                if load.get("free_disk")
+            }
+        config = (self.placement_strategy, options.get("weights"))
+        with self.placements_lock:
+            cached = self.placements.get(replicas)
+            if cached is None or cached[:2] != config:
+                placement = create_placement(
+                    self.placement_strategy, replicas, **options
+                )
+                cached = self.placements[replicas] = config + (placement,)
+            return cached[2]
 
     def divide_file(self, file_path):
-        # Divide the file into pieces of size SIZE
-        file_size = os.path.getsize(file_path)
-        num_pieces = (file_size + SIZE - 1) // SIZE
-        pieces = [None] * num_pieces
+        # Yield the file in pieces of size SIZE, reading each piece once
         with open(file_path, "rb") as f:
-            for i in range(num_pieces):
-                pieces[i] = f.read(SIZE)
-        return pieces
+            while piece := f.read(SIZE):
+                yield piece
 
-    def get_active_nodes(self):
-        # Request the list of active nodes from the tracker
-        data = {"command": "get_nodes"}
-        response = self.send_request(data)
+    def commit_upload(self, target_node_id, target_node, staging_id, file_hash):
+        # Tell a node to move staged pieces under the final file hash,
+        # returning whether it did
+        data = {
+            "command": "commit_upload",
+            "staging_id": staging_id,
+            "file_hash": file_hash,
+            "source_node_ip_address": target_node["ip_address"],
+            "source_node_port": target_node["port"],
+        }
+        response = self.send_node_request(data)
         if response["status"] == "success":
-            return response["nodes"]
+            return True
+        print(
+            f"Failed to commit upload on node {target_node_id}: {response['message']}"
+        )
+        return False
+
+    def abort_upload(self, node_ids, active_nodes, staging_id):
+        # Tell nodes to delete pieces staged for an upload that failed. A
+        # node that cannot be reached keeps them; nothing else refers to
+        # the staging id.
+        for node_id in node_ids:
+            target_node = active_nodes[node_id]
+            data = {
+                "command": "abort_upload",
+                "staging_id": staging_id,
+                "source_node_ip_address": target_node["ip_address"],
+                "source_node_port": target_node["port"],
+            }
+            response = self.send_node_request(data)
+            if response["status"] != "success":
+                print(
+                    f"Failed to discard staged pieces on node {node_id}: "
+                    f"{response['message']}"
+                )
+
+    def receive_commit_upload(self, request):
+        # Rename a staged upload to its final file hash
+        self.piece_cache.rename_file(request["staging_id"], request["file_hash"])
+        if self.piece_store.rename_file(request["staging_id"], request["file_hash"]):
+            response = {"status": "success"}
         else:
-            print("Failed to get list of active nodes:", response["message"])
-            return {}
+            response = {"status": "error", "message": "Staged upload not found"}
+        return response
+
+    def receive_abort_upload(self, request):
+        # Delete the pieces of a staged upload that will not be committed
+        self.piece_cache.delete_file(request["staging_id"])
+        self.piece_store.delete_file(request["staging_id"])
+        return {"status": "success"}
+
+    def replicate_piece(self, request):
+        # Copy a stored piece to the nodes the tracker chose for repair
+        file_hash = request["file_hash"]
+        piece_index = request["piece_index"]
+        piece_data = self.load_piece(file_hash, piece_index)
+        if piece_data is None:
+            return {"status": "error", "message": "Piece not found"}
+        node_ids = [
+            node_id
+            for node_id, target_node in request["targets"].items()
+            if self.send_piece_upload(
+                node_id, target_node, file_hash, piece_index, piece_data
+            )
+        ]
+        return {"status": "replicated", "node_ids": node_ids}
+
+    def get_active_nodes(self):
+        # Return the active nodes from the local membership cache, asking the
+        # tracker only for changes once the cache is older than its TTL. The
+        # request is sent without holding the lock, so a slow tracker does
+        # not block readers of the cache.
+        with self.membership_lock:
+            if time.monotonic() - self.membership_checked < self.membership_ttl:
+                return dict(self.membership)
+            epoch = self.membership_epoch
+            version = self.membership_version
+
+        data = {"command": "get_nodes", "epoch": epoch, "since": version}
+        response = self.send_request(data)
+        status = response["status"]
+        with self.membership_lock:
+            if status not in ("success", "delta", "not_modified"):
+                print("Failed to get list of active nodes:", response["message"])
+                return dict(self.membership)
+            if (self.membership_epoch, self.membership_version) != (epoch, version):
+                # Another thread applied a newer reply meanwhile
+                return dict(self.membership)
+            if status == "success":
+                self.membership = response["nodes"]
+            elif status == "delta":
+                for node_id in response["left"]:
+                    self.membership.pop(node_id, None)
+                self.membership.update(response["joined"])
+
+            self.membership_epoch = response.get("epoch")
+            self.membership_version = response.get("version")
+            self.membership_checked = time.monotonic()
+            return dict(self.membership)
+
+    def exchange_frame(
+        self,
+        address,
+        command,
+        file_hash,
+        piece_index,
+        payload=b"",
+        compressed=None,
+        timeout=None,
+        cancel=None,
+    ):
+        # Send one binary frame to a peer over the pooled connection and
+        # return (status, payload) of its reply, or None if the peer dropped
+        # the frame because it only speaks JSON. Compressed replies are
+        # decompressed here.
+        frame = self.pool.request_frame(
+            address,
+            command,
+            file_hash,
+            piece_index,
+            payload,
+            timeout=timeout or self.request_timeout,
+            compressed=compressed,
+            cancel=cancel,
+        )
+        if frame is None:
+            self.legacy_peers.add(address)
+            return None
+        peer = f"{address[0]}:{address[1]}"
+        self.bytes_sent.inc(peer, len(payload))
+        self.bytes_received.inc(peer, len(frame.payload))
+        if frame.command & CODEC_FLAG:
+            return frame.status, decode_payload(frame.payload)
+        return frame.status, frame.payload
 
     def send_piece_upload(
+        self,
+        target_node_id,
+        target_node,
+        file_hash,
+        piece_index,
+        piece,
+        compressed=None,
+    ):
+        # Send a file piece to another node, returning whether it was stored.
+        # `compressed` is sent instead to peers that accepted its codec.
+        address = (target_node["ip_address"], target_node["port"])
+        try:
+            result = None
+            if address not in self.legacy_peers:
+                result = self.exchange_frame(
+                    address,
+                    CMD_UPLOAD_PIECE,
+                    file_hash,
+                    piece_index,
+                    piece,
+                    compressed=compressed,
+                )
+            if result is None:
+                return self.send_piece_upload_json(
+                    target_node_id, target_node, file_hash, piece_index, piece
+                )
+            status, message = result
+            if status == STATUS_OK:
+                print(f"Piece {piece_index} sent to node {target_node_id}")
+                return True
+            print(
+                f"Failed to send piece {piece_index} to node {target_node_id}: {message.decode(FORMAT)}"
+            )
+        except Exception as e:
+            print(f"Error sending piece {piece_index} to node {target_node_id}: {e}")
+        return False
+
+    def send_piece_upload_json(
         self, target_node_id, target_node, file_hash, piece_index, piece
     ):
-        # Send a file piece to another node
+        # Send a file piece to another node using the legacy JSON protocol
         data = {
             "command": "upload_piece",
             "node_id": target_node_id,
@@ -213,94 +1097,448 @@ class Node:
                 s.connect((target_node["ip_address"], target_node["port"]))
                 s.sendall(json.dumps(data).encode(FORMAT))
 
-                response = b""
-                while True:
-                    chunk = s.recv(SIZE)
-                    if not chunk:
-                        break
-                    response += chunk
-
-                response_data = json.loads(response.decode(FORMAT))
+                response_data = recv_json(s)
                 if response_data["status"] == "success":
                     print(f"Piece {piece_index} sent to node {target_node_id}")
-                else:
-                    print(
-                        f"Failed to send piece {piece_index} to node {target_node_id}: {response_data['message']}"
-                    )
+                    return True
+                print(
+                    f"Failed to send piece {piece_index} to node {target_node_id}: {response_data['message']}"
+                )
         except Exception as e:
             print(f"Error sending piece {piece_index} to node {target_node_id}: {e}")
+        return False
 
-    def receive_piece_upload(self, request, client_socket):
+    def receive_piece_upload(self, request):
         # Receive a file piece from another node and save it
         node_id = request["node_id"]
         file_hash = request["file_hash"]
         piece_index = request["piece_index"]
         piece_data = bytes.fromhex(request["piece_data"])
 
-        pieces_directory = os.path.join(self.file_directory, file_hash)
-        os.makedirs(pieces_directory, exist_ok=True)
+        self.store_piece(file_hash, piece_index, piece_data)
+        print(f"Node {node_id}: piece {piece_index} saved successfully!")
 
-        piece_path = os.path.join(pieces_directory, f"piece_{piece_index}")
-        with open(piece_path, "wb") as piece_file:
-            piece_file.write(piece_data)
-        print(
-            f"Node {node_id}: piece {piece_index} saved successfully in {pieces_directory}!"
+        return {"status": "success"}
+
+    def store_piece(self, file_hash, piece_index, piece_data):
+        # Save a piece in this node's piece store; freshly uploaded pieces
+        # are likely to be requested soon, so cache them too
+        stored = piece_data
+        if is_stored(piece_data):
+            # Raw data that looks like a compressed piece is wrapped
+            stored = wrap_stored(bytes([CODEC_NONE]) + piece_data)
+        self.piece_store.put(file_hash, piece_index, stored)
+        self.piece_cache.put((file_hash, piece_index), piece_data)
+
+    def stored_codec(self, piece_file):
+        # Name of the codec a stored piece is compressed with, or None
+        prefix = os.pread(
+            piece_file.file.fileno(),
+            min(STORED_PREFIX_SIZE, piece_file.length),
+            piece_file.offset,
+        )
+        if len(prefix) < STORED_PREFIX_SIZE or not is_stored(prefix):
+            return None
+        return CODEC_NAMES.get(prefix[-1], "none")
+
+    def create_compression_executor(self):
+        # Workers come from a fork server, so they do not inherit this
+        # node's threads and sockets
+        return ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+
+    def compress_piece(self, piece):
+        # Start compressing a piece for upload; the future resolves to
+        # (payload, cpu_seconds) with payload None if it is sent raw. Returns
+        # None, sending the piece raw, if the pool cannot take it.
+        executor = self.compression_executor
+        if executor is None:
+            return None
+        try:
+            future = executor.submit(compress_piece, self.compression, piece)
+        except RuntimeError as e:
+            # BrokenProcessPool once a worker died, or the pool was shut down
+            self.replace_compression_executor(executor, e)
+            return None
+        future.add_done_callback(
+            lambda f, size=len(piece): self.record_compression(size, f)
+        )
+        return future
+
+    def replace_compression_executor(self, broken, error):
+        # Swap a broken compression pool for a new one, or turn compression
+        # off after too many failures
+        with self.stats_lock:
+            if self.compression_executor is not broken:
+                return
+            broken.shutdown(wait=False)
+            if self.compression_restarts <= 0:
+                print(f"Compression pool failed, sending pieces raw: {error}")
+                self.compression_executor = None
+                return
+            self.compression_restarts -= 1
+            print(f"Compression pool failed, starting a new one: {error}")
+            self.compression_executor = self.create_compression_executor()
+
+    def record_compression(self, size, future):
+        if future.exception() is not None:
+            return
+        payload, cpu_seconds = future.result()
+        with self.stats_lock:
+            stats = self.compression_stats
+            stats["pieces"] += 1
+            stats["bytes_in"] += size
+            stats["cpu_seconds"] += cpu_seconds
+            if payload is None:
+                stats["bytes_out"] += size
+            else:
+                stats["compressed"] += 1
+                stats["bytes_out"] += len(payload)
+
+    def compression_report(self):
+        # Compression ratio and CPU time per piece of uploads so far
+        with self.stats_lock:
+            stats = dict(self.compression_stats)
+        pieces = stats["pieces"]
+        stats["ratio"] = stats["bytes_in"] / stats["bytes_out"] if pieces else 1.0
+        stats["cpu_ms_per_piece"] = (
+            stats["cpu_seconds"] * 1000 / pieces if pieces else 0.0
         )
+        return stats
 
-        response = {"status": "success"}
-        client_socket.send(json.dumps(response).encode(FORMAT))
+    def open_piece(self, file_hash, piece_index):
+        # Return a handle on a stored piece, or None if this node does not
+        # hold it. The caller must close the handle.
+        return self.piece_store.open(file_hash, piece_index)
+
+    def load_piece(self, file_hash, piece_index):
+        # Read a stored piece, or return None if this node does not hold it
+        key = (file_hash, piece_index)
+        piece_data = self.piece_cache.get(key)
+        if piece_data is None:
+            piece_data = self.piece_store.get(file_hash, piece_index)
+            if piece_data is not None:
+                piece_data = unwrap_stored(piece_data)
+            if piece_data is not None and self.piece_cache.should_admit(key):
+                self.piece_cache.put(key, piece_data)
+        return piece_data
 
     def download_file(self, file_name):
-        # Request to download a file
-        data = {
-            "command": "download",
+        # Request to download a file, returning whether it completed
+        return self.download_resolved(file_name, self.resolve_file(file_name))
+
+    def download_many(self, file_names, max_concurrent=4):
+        # Download several files, returning {file_name: completed}. All of
+        # them are resolved in batched tracker requests, then downloaded up
+        # to `max_concurrent` at a time.
+        file_names = list(file_names)
+        responses = self.send_batch([self.resolve_request(n) for n in file_names])
+        with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+            futures = {
+                executor.submit(
+                    self.download_resolved, name, self.resolve_file(name, response)
+                ): name
+                for name, response in zip(file_names, responses)
+            }
+            results = {}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Failed to download file {futures[future]}: {e}")
+                    results[futures[future]] = False
+        return results
+
+    def resolve_request(self, file_name):
+        return {
+            "command": "resolve",
             "file_name": file_name,
             "requester_id": self.node_id,
+            "compact": True,
         }
-        response = self.send_request(data)
+
+    def resolve_file(self, file_name, response=None):
+        # A file's download metadata with the addresses ("nodes") and loads
+        # of its holders, in one round trip. `response` is a resolve reply
+        # that was already fetched in a batch.
+        if response is None:
+            response = self.send_request(self.resolve_request(file_name))
+        if response["status"] == "success" and self.shards:
+            self.file_shards[response["file_hash"]] = self.shard_for(file_name)
+        if response.get("message") != "Unknown command":
+            return response
+        # Trackers without resolve take three requests
+        response = self.send_request(
+            dict(self.resolve_request(file_name), command="download")
+        )
+        if response["status"] == "success":
+            response["nodes"] = self.get_active_nodes()
+            response["loads"] = self.get_transfer_loads()
+        return response
+
+    def download_resolved(self, file_name, response):
+        # Download a file described by a resolve reply
         if response["status"] == "success":
             file_hash = response["file_hash"]
             total_pieces = response["total_pieces"]
-            piece_distribution = response["piece_distribution"]
-            active_nodes = self.get_active_nodes()
+            piece_distribution = response_distribution(response)
+            active_nodes = response["nodes"]
             print(f"Downloading file: {file_name}")
 
             save_location = os.path.join(self.file_directory, file_name)
-            self.download_pieces(
-                file_hash, total_pieces, piece_distribution, save_location, active_nodes
+            return self.download_pieces(
+                file_hash,
+                total_pieces,
+                piece_distribution,
+                save_location,
+                active_nodes,
+                file_size=response.get("file_size"),
+                piece_hashes=response.get("piece_hashes"),
+                erasure=response.get("erasure"),
+                chunks=response.get("chunks"),
+                chunk_sizes=response.get("chunk_sizes"),
+                loads=response.get("loads"),
             )
-        else:
-            print(f"Failed to download file {file_name}: {response['message']}")
+        print(f"Failed to download file {file_name}: {response['message']}")
+        return False
 
     def download_pieces(
-        self, file_hash, total_pieces, piece_distribution, save_location, active_nodes
+        self,
+        file_hash,
+        total_pieces,
+        piece_distribution,
+        save_location,
+        active_nodes,
+        file_size=None,
+        piece_hashes=None,
+        erasure=None,
+        chunks=None,
+        chunk_sizes=None,
+        loads=None,
     ):
-        # Download all pieces of a file from active nodes
-        pieces = [None] * total_pieces
-        for i in range(total_pieces):
-            piece_data = None
-            for node_id in piece_distribution[str(i)]:
-                if node_id in active_nodes:
-                    node_info = active_nodes[node_id]
-                    piece_data = self.request_piece(
-                        node_info["ip_address"], node_info["port"], file_hash, i
-                    )
-                    if piece_data:
-                        break
-            if piece_data:
-                pieces[i] = piece_data
-            else:
-                print(f"Piece {i} not found or failed to download.")
-                return
+        # Download the missing pieces of a file straight to their offsets,
+        # several at a time, resuming from an earlier partial download.
+        # `loads` are the holders' transfer loads, if already known.
+        sink = DownloadSink(
+            save_location, file_hash, total_pieces, SIZE, file_size, chunk_sizes
+        )
+        missing = sink.missing()
+        if len(missing) < total_pieces:
+            print(f"Resuming download: {len(missing)} of {total_pieces} pieces left")
+
+        # Chunks are fetched by content hash. Pieces this node already stores,
+        # as a holder or from an earlier download, are copied locally.
+        if chunks:
+            piece_keys = [(chunk_hash, 0) for chunk_hash in chunks]
+        else:
+            piece_keys = [(file_hash, i) for i in range(total_pieces)]
+        for i in missing:
+            piece_data = self.load_piece(*piece_keys[i])
+            if piece_data is not None:
+                sink.write(i, piece_data)
+        missing = sink.missing()
+
+        # Files uploaded before per-piece hashes existed cannot be verified
+        verifier = None
+        if piece_hashes:
+            verifier = PieceVerifier(piece_hashes, self.hash_executor)
+
+        on_piece = sink.write
+        announcer = None
+        if self.share_downloads and verifier is not None:
+            # Keep verified pieces and serve them to later downloaders
+            announcer = PieceAnnouncer(
+                lambda pieces: self.announce_pieces(file_hash, pieces),
+                self.announce_batch,
+                self.announce_interval,
+            )
 
-        with open(save_location, "wb") as output_file:
-            for piece in pieces:
-                output_file.write(piece)
+            def on_piece(piece_index, piece_data):
+                sink.write(piece_index, piece_data)
+                self.store_piece(*piece_keys[piece_index], piece_data)
+                announcer.add(piece_index)
+
+        def refresh():
+            response = self.send_request(
+                {"command": "get_holders", "file_hash": file_hash, "compact": True}
+            )
+            if response["status"] != "success":
+                return None
+            return (
+                response_distribution(response),
+                self.get_active_nodes(),
+                self.get_transfer_loads(),
+            )
+
+        downloader = PieceDownloader(
+            self,
+            file_hash,
+            missing,
+            piece_distribution,
+            active_nodes,
+            on_piece,
+            max_in_flight=self.max_in_flight,
+            max_per_peer=self.max_per_peer,
+            verifier=verifier,
+            piece_keys=piece_keys,
+            loads=self.get_transfer_loads() if loads is None else loads,
+            refresh=refresh,
+            refresh_interval=self.holder_refresh_interval,
+            exclude=self.node_id,
+            peer_stats=self.peer_stats,
+            endgame_pieces=self.endgame_pieces,
+            endgame_copies=self.endgame_copies,
+        )
+        try:
+            failed = downloader.run()
+        finally:
+            if announcer is not None:
+                announcer.close()
+        if failed and erasure:
+            failed = self.reconstruct_pieces(
+                file_hash,
+                ErasureLayout.from_metadata(erasure),
+                failed,
+                sink,
+                piece_distribution,
+                active_nodes,
+                verifier,
+            )
+        sink.close(complete=not failed)
+        if failed:
+            print(
+                f"Pieces {failed} not found or failed to download. "
+                f"Progress kept in {sink.bitfield_path}"
+            )
+            return False
 
         print(f"File downloaded successfully to {save_location}")
+        return True
+
+    def announce_pieces(self, file_hash, piece_indices):
+        # Tell the tracker this node now serves these pieces of a file
+        response = self.send_request(
+            {
+                "command": "announce",
+                "node_id": self.node_id,
+                "file_hash": file_hash,
+                "pieces": piece_indices,
+            }
+        )
+        if response["status"] != "success":
+            print(f"Failed to announce pieces of {file_hash}: {response['message']}")
+
+    def get_transfer_loads(self):
+        # node_id -> active transfers, from the tracker's load reports
+        response = self.send_request({"command": "get_loads"})
+        return {
+            node_id: load.get("active_transfers", 0)
+            for node_id, load in response.get("loads", {}).items()
+        }
+
+    def reconstruct_pieces(
+        self,
+        file_hash,
+        layout,
+        failed,
+        sink,
+        piece_distribution,
+        active_nodes,
+        verifier,
+    ):
+        # Rebuild data pieces that could not be fetched from the parity of
+        # their groups, returning the ones that still could not be recovered
+        groups = sorted({layout.group_of(i) for i in failed})
+        print(f"Reconstructing pieces {failed} from parity")
+        parity = {}
+        downloader = PieceDownloader(
+            self,
+            file_hash,
+            [i for group in groups for i in layout.parity_indices(group)],
+            piece_distribution,
+            active_nodes,
+            parity.__setitem__,
+            max_in_flight=self.max_in_flight,
+            max_per_peer=self.max_per_peer,
+            verifier=verifier,
+            peer_stats=self.peer_stats,
+            endgame_pieces=self.endgame_pieces,
+            endgame_copies=self.endgame_copies,
+        )
+        downloader.run()
+
+        def piece_length(index):
+            return min(layout.piece_size, sink.file_size - index * layout.piece_size)
+
+        coder = ErasureCoder(layout.k, layout.m)
+        unrecovered = []
+        for group in groups:
+            lost = [i for i in failed if layout.group_of(i) == group]
+            shards = {}
+            for j in range(layout.k):
+                index = group * layout.k + j
+                if index >= layout.data_pieces:
+                    # Padding of a partial last group
+                    shards[j] = bytes(layout.piece_size)
+                elif sink.has(index):
+                    shards[j] = layout.pad(sink.read(index, piece_length(index)))
+            for index in layout.parity_indices(group):
+                if index in parity:
+                    shards[layout.shard_index(index)] = parity[index]
+            if len(shards) < layout.k:
+                unrecovered.extend(lost)
+                continue
+
+            data = coder.decode(shards)
+            for index in lost:
+                piece = data[layout.shard_index(index)][: piece_length(index)]
+                if verifier is not None and not verifier.check(index, piece):
+                    unrecovered.append(index)
+                    continue
+                sink.write(index, piece)
+        return sorted(unrecovered)
 
-    def request_piece(self, target_ip, target_port, file_hash, piece_index):
-        # Request a specific piece of a file from another node
+    def request_piece(
+        self, target_ip, target_port, file_hash, piece_index, timeout=None, cancel=None
+    ):
+        # Request a specific piece of a file from another node, giving up
+        # after `timeout` seconds or when `cancel` is cancelled
+        address = (target_ip, target_port)
+        try:
+            result = None
+            if address not in self.legacy_peers:
+                result = self.exchange_frame(
+                    address,
+                    CMD_DOWNLOAD_PIECE,
+                    file_hash,
+                    piece_index,
+                    timeout=timeout,
+                    cancel=cancel,
+                )
+            if result is None:
+                return self.request_piece_json(
+                    target_ip, target_port, file_hash, piece_index
+                )
+            status, payload = result
+            if status == STATUS_OK:
+                return payload
+            print(f"Error: {payload.decode(FORMAT)}")
+            return None
+        except CancelledError:
+            return None
+        except TimeoutError:
+            print(
+                f"Piece {piece_index} from {target_ip}:{target_port} timed out "
+                f"after {timeout or self.request_timeout:.1f}s"
+            )
+            return None
+        except Exception as e:
+            print(
+                f"Error requesting piece {piece_index} from {target_ip}:{target_port} - {e}"
+            )
+            return None
+
+    def request_piece_json(self, target_ip, target_port, file_hash, piece_index):
+        # Request a specific piece of a file using the legacy JSON protocol
         data = {
             "command": "download_piece",
             "file_hash": file_hash,
@@ -311,14 +1549,7 @@ class Node:
                 s.connect((target_ip, target_port))
                 s.sendall(json.dumps(data).encode(FORMAT))
 
-                response = b""
-                while True:
-                    chunk = s.recv(SIZE)
-                    if not chunk:
-                        break
-                    response += chunk
-
-                response_data = json.loads(response.decode(FORMAT))
+                response_data = recv_json(s)
                 if response_data["status"] == "success":
                     piece_data = bytes.fromhex(response_data["piece_data"])
                     return piece_data
@@ -331,23 +1562,19 @@ class Node:
             )
             return None
 
-    def send_piece(self, request, client_socket):
+    def send_piece(self, request):
         # Send a specific piece of a file to another node
         file_hash = request["file_hash"]
         piece_index = request["piece_index"]
-        piece_path = os.path.join(
-            self.file_directory, file_hash, f"piece_{piece_index}"
-        )
-        if os.path.exists(piece_path):
-            with open(piece_path, "rb") as piece_file:
-                piece_data = piece_file.read()
+        piece_data = self.load_piece(file_hash, piece_index)
+        if piece_data is not None:
             response = {
                 "status": "success",
                 "piece_data": piece_data.hex(),
             }
         else:
             response = {"status": "error", "message": "Piece not found"}
-        client_socket.send(json.dumps(response).encode(FORMAT))
+        return response
 
     def disconnect(self):
         # Disconnect the node from the tracker
@@ -404,6 +1631,11 @@ class Node:
                     print("\033[1;31mExiting...\033[0m")
                     self.running = False
                     self.disconnect()
+                    self.pool.close()
+                    if self.compression_executor is not None:
+                        self.compression_executor.shutdown()
+                    if self.piece_store is not None:
+                        self.piece_store.close()
                     break
                 else:
                     print(
@@ -416,8 +1648,20 @@ class Node:
 
 
 if __name__ == "__main__":
-    # print("192.168.2.5")
-    # ip_address = input("Enter node ip address: ")
-    # port = int(input("Enter node port: "))
-    node = Node("192.168.2.5", 4000)
+    parser = argparse.ArgumentParser(description="Run a file-sharing node")
+    parser.add_argument("--tracker-host", default="192.168.2.5")
+    parser.add_argument("--tracker-port", type=int, default=4000)
+    parser.add_argument("--host", help="address to listen on (default: hostname)")
+    parser.add_argument("--port", type=int, help="port to listen on (default: any)")
+    parser.add_argument("--directory", help="where node<id> directories go")
+    parser.add_argument("--metrics-file", help="dump Prometheus metrics here")
+    args = parser.parse_args()
+    node = Node(
+        args.tracker_host,
+        args.tracker_port,
+        host=args.host,
+        port=args.port,
+        directory=args.directory,
+    )
+    node.metrics_file = args.metrics_file
     node.run()
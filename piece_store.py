@@ -0,0 +1,371 @@
+import os
+import shutil
+import struct
+import threading
+
+# Index record: op, raw file hash, piece index, pack id, offset, length
+INDEX_RECORD = struct.Struct("!B20sIIQI")
+OP_PUT = 1
+OP_DELETE = 2
+
+INDEX_FILE = "index.log"
+PACK_SIZE = 1024 * 1024 * 1024
+
+
+class PieceHandle:
+    # A readable region holding one piece: `length` bytes of `file` at
+    # `offset`. Only handles that own their file close it; shared files are
+    # handed back through `release` instead.
+    def __init__(self, file, offset, length, owned, release=None):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.owned = owned
+        self.release = release
+
+    def read(self):
+        return os.pread(self.file.fileno(), self.length, self.offset)
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        elif self.release is not None:
+            release, self.release = self.release, None
+            release(self.file)
+
+
+class DirectoryPieceStore:
+    # One file per piece under <root>/<file_hash>/piece_<index>
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def piece_path(self, file_hash, piece_index):
+        return os.path.join(self.root, file_hash, f"piece_{piece_index}")
+
+    def put(self, file_hash, piece_index, data):
+        os.makedirs(os.path.join(self.root, file_hash), exist_ok=True)
+        with open(self.piece_path(file_hash, piece_index), "wb") as piece_file:
+            piece_file.write(data)
+
+    def open(self, file_hash, piece_index):
+        try:
+            piece_file = open(self.piece_path(file_hash, piece_index), "rb")
+        except FileNotFoundError:
+            return None
+        return PieceHandle(piece_file, 0, os.fstat(piece_file.fileno()).st_size, True)
+
+    def get(self, file_hash, piece_index):
+        handle = self.open(file_hash, piece_index)
+        if handle is None:
+            return None
+        try:
+            return handle.read()
+        finally:
+            handle.close()
+
+    def delete(self, file_hash, piece_index):
+        try:
+            os.remove(self.piece_path(file_hash, piece_index))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def rename_file(self, old_hash, new_hash):
+        # Move every piece stored under one hash to another, returning
+        # whether there was anything to move
+        old_directory = os.path.join(self.root, old_hash)
+        if not os.path.isdir(old_directory):
+            return False
+        new_directory = os.path.join(self.root, new_hash)
+        os.makedirs(new_directory, exist_ok=True)
+        for piece_name in os.listdir(old_directory):
+            os.replace(
+                os.path.join(old_directory, piece_name),
+                os.path.join(new_directory, piece_name),
+            )
+        os.rmdir(old_directory)
+        return True
+
+    def delete_file(self, file_hash):
+        # Delete every piece stored under one hash, returning whether there
+        # was anything to delete
+        directory = os.path.join(self.root, file_hash)
+        if not os.path.isdir(directory):
+            return False
+        shutil.rmtree(directory)
+        return True
+
+    def keys(self):
+        for file_hash in os.listdir(self.root):
+            directory = os.path.join(self.root, file_hash)
+            if len(file_hash) != 40 or not os.path.isdir(directory):
+                continue
+            for piece_name in os.listdir(directory):
+                if piece_name.startswith("piece_"):
+                    yield file_hash, int(piece_name[len("piece_") :])
+
+    def size(self):
+        return sum(
+            os.path.getsize(self.piece_path(file_hash, piece_index))
+            for file_hash, piece_index in self.keys()
+        )
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PackedPieceStore:
+    # Pieces appended to large pack files, located through an in-memory
+    # index that is rebuilt at startup from an append-only index log
+    def __init__(self, root, pack_size=PACK_SIZE, compact_ratio=0.5):
+        self.root = root
+        self.pack_size = pack_size
+        self.compact_ratio = compact_ratio
+        self.lock = threading.Lock()
+        # (file_hash, piece_index) -> (pack id, offset, length)
+        self.index = {}
+        self.pack_bytes = {}
+        self.dead_bytes = {}
+        self.readers = {}
+        # Open handles per shared reader; readers of compacted packs are
+        # retired and closed once their last handle is
+        self.reader_users = {}
+        self.retired = set()
+        os.makedirs(root, exist_ok=True)
+
+        self.load_index()
+        self.current_pack = max(self.pack_bytes, default=0)
+        self.writer = open(self.pack_path(self.current_pack), "ab")
+        self.index_log = open(os.path.join(root, INDEX_FILE), "ab")
+
+    def pack_path(self, pack_id):
+        return os.path.join(self.root, f"pack_{pack_id:06d}.dat")
+
+    def load_index(self):
+        # Replay the index log; a torn final record is ignored. Pack writes
+        # are not fsynced, so after a crash a record may point past the end
+        # of its pack: such records are dropped and the piece is lost.
+        for name in os.listdir(self.root):
+            if name.startswith("pack_") and name.endswith(".dat"):
+                pack_id = int(name[len("pack_") : -len(".dat")])
+                self.pack_bytes[pack_id] = os.path.getsize(
+                    os.path.join(self.root, name)
+                )
+                self.dead_bytes[pack_id] = self.pack_bytes[pack_id]
+        index_path = os.path.join(self.root, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        for (
+            op,
+            raw_hash,
+            piece_index,
+            pack_id,
+            offset,
+            length,
+        ) in INDEX_RECORD.iter_unpack(data[:usable]):
+            key = (raw_hash.hex(), piece_index)
+            if op == OP_PUT:
+                if offset + length > self.pack_bytes.get(pack_id, 0):
+                    continue
+                self.forget(key)
+                self.index[key] = (pack_id, offset, length)
+                self.dead_bytes[pack_id] = self.dead_bytes.get(pack_id, 0) - length
+            elif op == OP_DELETE:
+                self.forget(key)
+
+    def forget(self, key):
+        # Drop a key from the index, counting its bytes as reclaimable
+        location = self.index.pop(key, None)
+        if location is not None:
+            pack_id, _, length = location
+            self.dead_bytes[pack_id] = self.dead_bytes.get(pack_id, 0) + length
+        return location
+
+    def log(self, op, key, location):
+        pack_id, offset, length = location
+        self.index_log.write(
+            INDEX_RECORD.pack(
+                op, bytes.fromhex(key[0]), key[1], pack_id, offset, length
+            )
+        )
+
+    def append(self, data):
+        # Append data to the current pack, rolling over to a new pack when
+        # it is full, and return its location
+        offset = self.pack_bytes.get(self.current_pack, 0)
+        if offset and offset + len(data) > self.pack_size:
+            self.writer.close()
+            self.current_pack = max(self.pack_bytes) + 1
+            self.writer = open(self.pack_path(self.current_pack), "ab")
+            offset = 0
+        self.writer.write(data)
+        self.writer.flush()
+        self.pack_bytes[self.current_pack] = offset + len(data)
+        self.dead_bytes.setdefault(self.current_pack, 0)
+        return self.current_pack, offset, len(data)
+
+    def put(self, file_hash, piece_index, data):
+        key = (file_hash, piece_index)
+        with self.lock:
+            location = self.append(data)
+            # Data is written to the pack before the index record that
+            # points at it; load_index drops records the pack lost in a crash
+            self.log(OP_PUT, key, location)
+            self.index_log.flush()
+            self.forget(key)
+            self.index[key] = location
+
+    def reader(self, pack_id):
+        # Shared read-only file per pack; callers read at explicit offsets
+        reader = self.readers.get(pack_id)
+        if reader is None:
+            reader = open(self.pack_path(pack_id), "rb")
+            self.readers[pack_id] = reader
+        return reader
+
+    def open(self, file_hash, piece_index):
+        with self.lock:
+            location = self.index.get((file_hash, piece_index))
+            if location is None:
+                return None
+            pack_id, offset, length = location
+            reader = self.reader(pack_id)
+            self.reader_users[reader] = self.reader_users.get(reader, 0) + 1
+            return PieceHandle(reader, offset, length, False, self.release)
+
+    def release(self, reader):
+        with self.lock:
+            users = self.reader_users.pop(reader, 1) - 1
+            if users:
+                self.reader_users[reader] = users
+            elif reader in self.retired:
+                self.retired.discard(reader)
+                reader.close()
+
+    def get(self, file_hash, piece_index):
+        handle = self.open(file_hash, piece_index)
+        if handle is None:
+            return None
+        try:
+            return handle.read()
+        finally:
+            handle.close()
+
+    def delete(self, file_hash, piece_index):
+        key = (file_hash, piece_index)
+        with self.lock:
+            location = self.forget(key)
+            if location is None:
+                return False
+            self.log(OP_DELETE, key, location)
+            self.index_log.flush()
+            return True
+
+    def rename_file(self, old_hash, new_hash):
+        # Re-point every piece of one hash at another without moving data
+        with self.lock:
+            keys = [key for key in self.index if key[0] == old_hash]
+            for key in keys:
+                location = self.index.pop(key)
+                new_key = (new_hash, key[1])
+                self.log(OP_PUT, new_key, location)
+                self.log(OP_DELETE, key, location)
+                self.forget(new_key)
+                self.index[new_key] = location
+            self.index_log.flush()
+            return bool(keys)
+
+    def delete_file(self, file_hash):
+        with self.lock:
+            keys = [key for key in self.index if key[0] == file_hash]
+            for key in keys:
+                self.log(OP_DELETE, key, self.forget(key))
+            self.index_log.flush()
+            return bool(keys)
+
+    def keys(self):
+        with self.lock:
+            return list(self.index)
+
+    def size(self):
+        with self.lock:
+            return sum(length for _, _, length in self.index.values())
+
+    def compact(self):
+        # Copy live pieces out of packs that are mostly dead, then rewrite
+        # the index log from the in-memory index and delete those packs
+        with self.lock:
+            victims = {
+                pack_id
+                for pack_id, total in self.pack_bytes.items()
+                if pack_id != self.current_pack
+                and total
+                and self.dead_bytes.get(pack_id, 0) / total >= self.compact_ratio
+            }
+            if not victims:
+                return 0
+            for key, (pack_id, offset, length) in list(self.index.items()):
+                if pack_id in victims:
+                    data = os.pread(self.reader(pack_id).fileno(), length, offset)
+                    self.index[key] = self.append(data)
+            os.fsync(self.writer.fileno())
+
+            index_path = os.path.join(self.root, INDEX_FILE)
+            tmp_path = index_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for key, location in self.index.items():
+                    pack_id, offset, length = location
+                    f.write(
+                        INDEX_RECORD.pack(
+                            OP_PUT,
+                            bytes.fromhex(key[0]),
+                            key[1],
+                            pack_id,
+                            offset,
+                            length,
+                        )
+                    )
+                f.flush()
+                os.fsync(f.fileno())
+            self.index_log.close()
+            os.replace(tmp_path, index_path)
+            self.index_log = open(index_path, "ab")
+
+            for pack_id in victims:
+                # Readers may still be serving from the old pack; keep the
+                # open file until their handles are closed
+                reader = self.readers.pop(pack_id, None)
+                if reader is not None:
+                    if self.reader_users.get(reader):
+                        self.retired.add(reader)
+                    else:
+                        reader.close()
+                os.remove(self.pack_path(pack_id))
+                del self.pack_bytes[pack_id]
+                self.dead_bytes.pop(pack_id, None)
+            return len(victims)
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            self.index_log.close()
+            for reader in list(self.readers.values()) + list(self.retired):
+                reader.close()
+            self.readers = {}
+            self.retired = set()
+
+
+def open_piece_store(backend, root):
+    # Create the piece store selected by name
+    if backend == "directory":
+        return DirectoryPieceStore(root)
+    if backend == "packed":
+        return PackedPieceStore(os.path.join(root, "packs"))
+    raise ValueError(f"Unknown piece store backend: {backend}")
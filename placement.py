@@ -0,0 +1,99 @@
+import bisect
+import hashlib
+import math
+import threading
+
+
+def hash_key(key):
+    # Stable 64-bit position for a string, the same on every node
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+class RoundRobinPlacement:
+    # Piece i goes to `replicas` consecutive nodes starting at node i mod n
+    def __init__(self, replicas=2):
+        self.replicas = replicas
+
+    def place(self, key, piece_index, node_ids):
+        node_ids = list(node_ids)
+        count = min(self.replicas, len(node_ids))
+        return [node_ids[(piece_index + i) % len(node_ids)] for i in range(count)]
+
+
+class ConsistentHashPlacement:
+    # Each node owns `vnodes` points on a hash ring, and a piece goes to the
+    # first distinct nodes clockwise from its own point. A node joining or
+    # leaving only moves the pieces next to its points.
+    def __init__(self, replicas=2, vnodes=100):
+        self.replicas = replicas
+        self.vnodes = vnodes
+        self.lock = threading.Lock()
+        self.ring_nodes = None
+        self.points = []
+        self.owners = []
+
+    def ring(self, node_ids):
+        # Build the ring for a membership, reusing it while it is unchanged
+        members = frozenset(node_ids)
+        with self.lock:
+            if members != self.ring_nodes:
+                ring = sorted(
+                    (hash_key(f"{node_id}#{v}"), node_id)
+                    for node_id in members
+                    for v in range(self.vnodes)
+                )
+                self.points = [point for point, _ in ring]
+                self.owners = [node_id for _, node_id in ring]
+                self.ring_nodes = members
+            return self.points, self.owners, len(members)
+
+    def place(self, key, piece_index, node_ids):
+        points, owners, node_count = self.ring(node_ids)
+        count = min(self.replicas, node_count)
+        targets = []
+        start = bisect.bisect(points, hash_key(f"{key}:{piece_index}"))
+        for i in range(len(owners)):
+            node_id = owners[(start + i) % len(owners)]
+            if node_id not in targets:
+                targets.append(node_id)
+                if len(targets) == count:
+                    break
+        return targets
+
+
+class WeightedPlacement:
+    # Weighted rendezvous hashing: every node scores each piece and the
+    # highest scores win, so a node's share of pieces follows its weight
+    # (free disk by default) and membership changes move few pieces.
+    # Scoring is linear in the number of nodes.
+    def __init__(self, replicas=2, weights=None):
+        self.replicas = replicas
+        self.weights = weights or {}
+        # Nodes without a reported weight count as average ones
+        self.default_weight = (
+            sum(self.weights.values()) / len(self.weights) if self.weights else 1
+        )
+
+    def score(self, key, piece_index, node_id):
+        weight = self.weights.get(node_id, self.default_weight)
+        position = (hash_key(f"{key}:{piece_index}:{node_id}") + 1) / (2**64 + 1)
+        return weight / -math.log(position)
+
+    def place(self, key, piece_index, node_ids):
+        ranked = sorted(
+            node_ids,
+            key=lambda node_id: self.score(key, piece_index, node_id),
+            reverse=True,
+        )
+        return ranked[: self.replicas]
+
+
+def create_placement(strategy, replicas=2, **options):
+    # Create the placement strategy selected by name
+    if strategy == "round_robin":
+        return RoundRobinPlacement(replicas)
+    if strategy == "consistent_hash":
+        return ConsistentHashPlacement(replicas, **options)
+    if strategy == "weighted":
+        return WeightedPlacement(replicas, **options)
+    raise ValueError(f"Unknown placement strategy: {strategy}")
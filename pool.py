@@ -0,0 +1,352 @@
+import socket
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+from compression import CODEC_NAMES
+from protocol import (
+    CMD_HELLO,
+    CODEC_FLAG,
+    STATUS_OK,
+    ProtocolError,
+    recv_frame,
+    recv_message,
+    send_frame,
+    send_message,
+)
+
+
+def resolve(future, result=None, error=None):
+    # Complete a reply future unless its caller already cancelled it
+    try:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+class CancelToken:
+    # Lets another thread abandon a request_frame call: the waiting caller
+    # gets CancelledError and a late reply is dropped
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callback = None
+
+    def attach(self, callback):
+        with self.lock:
+            if not self.cancelled:
+                self.callback = callback
+                return
+        callback()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callback, self.callback = self.callback, None
+        if callback is not None:
+            callback()
+
+
+class PeerConnection:
+    def __init__(self, address, connect_timeout):
+        self.address = address
+        self.sock = socket.create_connection(address, connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.next_request_id = 1
+        self.closed = False
+        self.answered = False
+        # Codecs the peer accepted in its hello reply
+        self.codecs = set()
+        self.legacy = False
+        self.last_used = time.monotonic()
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def request(self, command, file_hash, piece_index, payload=b""):
+        # Send one frame and return (request_id, future) for its reply
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            request_id = self.next_request_id
+            self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1
+            self.pending[request_id] = future
+            self.last_used = time.monotonic()
+        try:
+            with self.send_lock:
+                send_frame(
+                    self.sock,
+                    command,
+                    file_hash,
+                    piece_index,
+                    payload,
+                    request_id=request_id,
+                )
+        except OSError as e:
+            self.close(e)
+            raise ConnectionError(str(e))
+        return request_id, future
+
+    def negotiate(self, codecs, timeout):
+        # Agree on the codecs this connection may carry. Peers without
+        # hello support reply with an error and get uncompressed frames;
+        # peers without binary framing close the connection.
+        try:
+            _, future = self.request(CMD_HELLO, "00" * 20, 0, ",".join(codecs).encode())
+            frame = future.result(timeout)
+        except ConnectionError:
+            self.legacy = not self.answered
+            return
+        except TimeoutError:
+            return
+        if frame.status == STATUS_OK and frame.payload:
+            self.codecs = set(bytes(frame.payload).decode().split(","))
+
+    def cancel(self, request_id):
+        # Forget a request whose caller gave up; a late reply is dropped
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def read_loop(self):
+        # Hand each reply to the request with the matching id
+        try:
+            while True:
+                frame = recv_frame(self.sock)
+                with self.lock:
+                    future = self.pending.pop(frame.request_id, None)
+                    self.answered = True
+                    self.last_used = time.monotonic()
+                if future is not None:
+                    resolve(future, frame)
+        except (OSError, ProtocolError) as e:
+            self.close(e)
+
+    def is_idle(self, idle_timeout):
+        with self.lock:
+            return not self.pending and time.monotonic() - self.last_used > idle_timeout
+
+    def close(self, error=None):
+        # Close the socket and fail every request still waiting on it
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for future in pending.values():
+            resolve(future, error=ConnectionError(str(error or "Connection closed")))
+
+
+class ConnectionPool:
+    def __init__(self, idle_timeout=30, connect_timeout=5, codecs=(), probe_timeout=5):
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        # Legacy peers ignore framed messages without closing the socket, so
+        # the first reply from a peer is awaited at most `probe_timeout`
+        # seconds. Peers that answered once are known to speak frames.
+        self.probe_timeout = probe_timeout
+        self.framed_peers = set()
+        # Codecs offered on every new binary connection; none skips the hello
+        self.codecs = codecs
+        self.lock = threading.Lock()
+        # One multiplexed binary connection per peer
+        self.peers = {}
+        # Idle JSON control sockets per peer, as (socket, last used) pairs
+        self.controls = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        threading.Thread(target=self.evict_loop, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "open_peers": len(self.peers),
+                "idle_controls": sum(len(c) for c in self.controls.values()),
+            }
+
+    def get_peer(self, address):
+        # Return (connection, fresh) for a peer, connecting if needed
+        with self.lock:
+            connection = self.peers.get(address)
+            if connection is not None and not connection.closed:
+                self.hits += 1
+                return connection, False
+            self.misses += 1
+        connection = PeerConnection(address, self.connect_timeout)
+        if self.codecs:
+            connection.negotiate(self.codecs, self.connect_timeout)
+        with self.lock:
+            current = self.peers.get(address)
+            if current is not None and not current.closed:
+                # Another thread connected first; use its connection
+                connection.close()
+                return current, False
+            self.peers[address] = connection
+        return connection, True
+
+    def discard_peer(self, address, connection):
+        connection.close()
+        with self.lock:
+            if self.peers.get(address) is connection:
+                del self.peers[address]
+
+    def request_frame(
+        self,
+        address,
+        command,
+        file_hash,
+        piece_index,
+        payload=b"",
+        timeout=None,
+        compressed=None,
+        cancel=None,
+    ):
+        # Send a binary request over the peer's shared connection and return
+        # the reply frame. Returns None if a fresh connection was closed
+        # without any reply, which is how peers without binary framing react.
+        # A reused connection that turns out to be dead is retried once.
+        # `compressed` (codec byte and body) replaces the payload when the
+        # connection accepted its codec. Cancelling `cancel`, a CancelToken,
+        # makes the call raise CancelledError.
+        for _ in range(2):
+            connection, fresh = self.get_peer(address)
+            if connection.legacy:
+                self.discard_peer(address, connection)
+                return None
+            frame_command, frame_payload = command, payload
+            if compressed and CODEC_NAMES.get(compressed[0]) in connection.codecs:
+                frame_command, frame_payload = command | CODEC_FLAG, compressed
+            try:
+                request_id, future = connection.request(
+                    frame_command, file_hash, piece_index, frame_payload
+                )
+            except ConnectionError:
+                self.discard_peer(address, connection)
+                if fresh:
+                    raise
+                continue
+            if cancel is not None:
+                cancel.attach(lambda: (connection.cancel(request_id), future.cancel()))
+            try:
+                return future.result(timeout)
+            except TimeoutError:
+                connection.cancel(request_id)
+                raise
+            except ConnectionError:
+                self.discard_peer(address, connection)
+                if fresh and not connection.answered:
+                    return None
+                if fresh:
+                    raise
+        raise ConnectionError(f"Lost connection to {address}")
+
+    def checkout_control(self, address):
+        # Take an idle control socket for a peer, or open a new one
+        with self.lock:
+            idle = self.controls.get(address)
+            if idle:
+                self.hits += 1
+                return idle.pop()[0], False
+            self.misses += 1
+        sock = socket.create_connection(address, self.connect_timeout)
+        with self.lock:
+            framed = address in self.framed_peers
+        sock.settimeout(None if framed else self.probe_timeout)
+        return sock, True
+
+    def checkin_control(self, address, sock):
+        with self.lock:
+            self.controls.setdefault(address, []).append((sock, time.monotonic()))
+
+    def request_message(self, address, data):
+        # Send a framed JSON request over a pooled socket and return the
+        # reply, or None if a fresh socket was closed, or went unanswered by
+        # a peer not yet known to speak frames
+        for _ in range(2):
+            sock, fresh = self.checkout_control(address)
+            try:
+                send_message(sock, data)
+                response = recv_message(sock)
+            except TimeoutError:
+                sock.close()
+                with self.lock:
+                    framed = address in self.framed_peers
+                if fresh and not framed:
+                    return None
+                raise
+            except (OSError, ProtocolError):
+                sock.close()
+                if fresh:
+                    raise
+                continue
+            if response is None:
+                sock.close()
+                if fresh:
+                    return None
+                continue
+            if fresh:
+                sock.settimeout(None)
+                with self.lock:
+                    self.framed_peers.add(address)
+            self.checkin_control(address, sock)
+            return response
+        raise ConnectionError(f"Lost connection to {address}")
+
+    def evict_loop(self):
+        # Close connections that have sat idle past the timeout
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 0.1))
+            now = time.monotonic()
+            with self.lock:
+                stale = [
+                    (address, connection)
+                    for address, connection in self.peers.items()
+                    if connection.closed or connection.is_idle(self.idle_timeout)
+                ]
+                for address, _ in stale:
+                    del self.peers[address]
+                stale_controls = []
+                for address, idle in list(self.controls.items()):
+                    keep = [
+                        (sock, used)
+                        for sock, used in idle
+                        if now - used <= self.idle_timeout
+                    ]
+                    stale_controls.extend(
+                        sock for sock, used in idle if now - used > self.idle_timeout
+                    )
+                    if keep:
+                        self.controls[address] = keep
+                    else:
+                        del self.controls[address]
+                self.evictions += len(stale) + len(stale_controls)
+            for _, connection in stale:
+                connection.close()
+            for sock in stale_controls:
+                sock.close()
+
+    def close(self):
+        with self.lock:
+            peers, self.peers = list(self.peers.values()), {}
+            controls, self.controls = self.controls, {}
+        for connection in peers:
+            connection.close()
+        for idle in controls.values():
+            for sock, _ in idle:
+                sock.close()
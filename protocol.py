@@ -0,0 +1,184 @@
+import json
+import socket
+import struct
+from collections import namedtuple
+
+FORMAT = "utf-8"
+
+# Binary piece-transfer framing. Every message is a fixed header followed by
+# `payload_length` raw bytes, so pieces never go through hex or JSON.
+# Version 2 added request ids so several requests can share one connection.
+MAGIC = b"FS"
+VERSION = 2
+
+CMD_UPLOAD_PIECE = 1
+CMD_DOWNLOAD_PIECE = 2
+# Payload: comma-separated codecs the sender can decode. The reply lists the
+# ones the receiver can decode too, in the sender's order.
+CMD_HELLO = 3
+
+# Set on a command when its payload is a codec byte followed by a compressed
+# body. Only sent to peers that accepted the codec in their hello reply.
+CODEC_FLAG = 0x80
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# magic, version, command, status, request id, file hash (raw SHA-1),
+# piece index, payload length
+HEADER = struct.Struct("!2sBBBI20sIQ")
+HEADER_SIZE = HEADER.size
+
+Frame = namedtuple("Frame", "command status request_id file_hash piece_index payload")
+
+# Control messages are JSON documents behind a 4-byte length prefix. Legacy
+# peers send bare JSON, which always starts with "{", so a first byte of "{"
+# cannot be confused with a length prefix below MAX_MESSAGE_SIZE.
+MESSAGE_HEADER = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(
+    command, file_hash, piece_index, payload_length, status=STATUS_OK, request_id=0
+):
+    """Pack a binary frame header. `file_hash` is the hex SHA-1 digest."""
+    return HEADER.pack(
+        MAGIC,
+        VERSION,
+        command,
+        status,
+        request_id,
+        bytes.fromhex(file_hash),
+        piece_index,
+        payload_length,
+    )
+
+
+def unpack_header(data):
+    """Unpack a binary frame header into
+    (command, status, request_id, file_hash, piece_index, length)."""
+    magic, version, command, status, request_id, raw_hash, piece_index, length = (
+        HEADER.unpack(data)
+    )
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad magic {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return command, status, request_id, raw_hash.hex(), piece_index, length
+
+
+def recv_into_exact(sock, view):
+    """Fill the whole memoryview from the socket, raising if the peer closes early."""
+    received = 0
+    total = len(view)
+    while received < total:
+        n = sock.recv_into(view[received:], total - received)
+        if n == 0:
+            raise ConnectionError("Connection closed mid-message")
+        received += n
+
+
+def recv_exact(sock, size):
+    """Receive exactly `size` bytes into a fresh bytearray."""
+    buffer = bytearray(size)
+    recv_into_exact(sock, memoryview(buffer))
+    return buffer
+
+
+def send_frame(
+    sock, command, file_hash, piece_index, payload=b"", status=STATUS_OK, request_id=0
+):
+    """Send a header followed by the raw payload without concatenating them."""
+    sock.sendall(
+        pack_header(command, file_hash, piece_index, len(payload), status, request_id)
+    )
+    if payload:
+        sock.sendall(memoryview(payload))
+
+
+def send_frame_file(
+    sock, command, file_hash, piece_index, file, offset, count, request_id=0, prefix=b""
+):
+    """Send a header and `prefix`, then `count` bytes of `file` from `offset`
+    straight from the kernel with sendfile, so the payload never enters Python."""
+    sock.sendall(
+        pack_header(
+            command, file_hash, piece_index, len(prefix) + count, STATUS_OK, request_id
+        )
+        + prefix
+    )
+    sent = sock.sendfile(file, offset, count) if count else 0
+    if sent != count:
+        raise ConnectionError(f"Sent {sent} of {count} payload bytes")
+
+
+def recv_frame(sock):
+    """Receive one frame, or raise ConnectionError if the peer closes first."""
+    command, status, request_id, file_hash, piece_index, length = unpack_header(
+        recv_exact(sock, HEADER_SIZE)
+    )
+    payload = recv_exact(sock, length)
+    return Frame(command, status, request_id, file_hash, piece_index, payload)
+
+
+def encode_message(data):
+    """Encode a JSON control message with its length prefix."""
+    body = json.dumps(data).encode(FORMAT)
+    return MESSAGE_HEADER.pack(len(body)) + body
+
+
+def send_message(sock, data):
+    """Send one length-prefixed JSON control message."""
+    sock.sendall(encode_message(data))
+
+
+def recv_message(sock):
+    """Receive one length-prefixed JSON message, or None if the peer closed."""
+    prefix = sock.recv(MESSAGE_HEADER.size, socket.MSG_WAITALL)
+    if not prefix:
+        return None
+    if len(prefix) < MESSAGE_HEADER.size:
+        raise ConnectionError("Connection closed mid-message")
+    (length,) = MESSAGE_HEADER.unpack(prefix)
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Message of {length} bytes exceeds limit")
+    return json.loads(recv_exact(sock, length).decode(FORMAT))
+
+
+def is_legacy_message(sock):
+    """Peek at a connection to tell a bare JSON request from a framed one."""
+    prefix = sock.recv(1, socket.MSG_PEEK)
+    return prefix == b"{"
+
+
+def is_binary_request(sock):
+    """Peek at the first bytes of a connection to tell binary frames from JSON."""
+    prefix = sock.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    return prefix == MAGIC
+
+
+def recv_json(sock, limit=64 * 1024 * 1024):
+    """Read from the socket until the accumulated bytes form one JSON document.
+
+    Legacy peers send a bare JSON object and keep the connection open for the
+    reply, so the only boundary is the end of a parseable document.
+    """
+    decoder = json.JSONDecoder()
+    buffer = bytearray()
+    while len(buffer) < limit:
+        chunk = sock.recv(1024 * 1024)
+        if not chunk:
+            break
+        buffer += chunk
+        try:
+            document, _ = decoder.raw_decode(buffer.decode(FORMAT))
+            return document
+        except (ValueError, UnicodeDecodeError):
+            continue
+    if not buffer:
+        return None
+    return json.loads(buffer.decode(FORMAT))
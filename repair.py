@@ -0,0 +1,190 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from placement import WeightedPlacement
+from protocol import recv_message, send_message
+
+DEFAULT_PIECE_SIZE = 1024 * 1024
+
+
+class RepairScheduler:
+    # Restores the replication factor of pieces whose holders left. Pieces
+    # are queued with their live replica count and repaired fewest-replicas
+    # first; a token bucket caps repair traffic at `rate` bytes per second
+    # so repairs do not starve foreground downloads.
+    def __init__(
+        self, store, replication_factor=2, rate=8 * 1024 * 1024, max_workers=4
+    ):
+        self.store = store
+        self.replication_factor = replication_factor
+        self.rate = rate
+        self.timeout = 60
+        self.scan_interval = 600
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.queue = []
+        self.queued = set()
+        self.counter = itertools.count()
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.workers = threading.Semaphore(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.running = True
+        self.repaired = 0
+        self.failed = 0
+
+    def target_replicas(self, metadata):
+        return metadata.get("replication_factor") or self.replication_factor
+
+    def check(self, file_hash, piece_index):
+        # Queue a piece if it has fewer live replicas than it should
+        live, _, metadata = self.store.piece_info(file_hash, piece_index)
+        if metadata is None or len(live) >= self.target_replicas(metadata):
+            return
+        with self.lock:
+            key = (file_hash, str(piece_index))
+            if key in self.queued:
+                return
+            self.queued.add(key)
+            heapq.heappush(self.queue, (len(live), next(self.counter), key))
+            self.wakeup.notify()
+
+    def node_left(self, node_id):
+        # Check every piece the departed node held
+        for file_hash, piece_index in self.store.pieces_held(node_id):
+            self.check(file_hash, piece_index)
+
+    def scan(self):
+        # Check every known piece, e.g. after a restart
+        for file_hash, piece_index in self.store.all_pieces():
+            self.check(file_hash, piece_index)
+
+    def take(self, cost):
+        # Block until the token bucket holds `cost` bytes, then spend them
+        while self.running:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.refilled) * self.rate
+            )
+            self.refilled = now
+            if self.tokens >= min(cost, self.rate):
+                self.tokens -= cost
+                return
+            time.sleep((min(cost, self.rate) - self.tokens) / self.rate)
+
+    def run(self):
+        # Hand queued pieces to repair workers, most endangered first
+        while self.running:
+            with self.lock:
+                while self.running and not self.queue:
+                    self.wakeup.wait(1)
+                if not self.running:
+                    return
+                _, _, key = heapq.heappop(self.queue)
+                self.queued.discard(key)
+            file_hash, piece_index = key
+            live, _, metadata = self.store.piece_info(file_hash, piece_index)
+            if metadata is None:
+                continue
+            needed = self.target_replicas(metadata) - len(live)
+            if needed <= 0:
+                continue
+            self.workers.acquire()
+            self.take(piece_size(metadata) * needed)
+            future = self.executor.submit(self.repair, file_hash, piece_index)
+            future.add_done_callback(lambda _: self.workers.release())
+
+    def repair(self, file_hash, piece_index):
+        # Ask a live holder to copy the piece to new nodes
+        live, holders, metadata = self.store.piece_info(file_hash, piece_index)
+        if metadata is None:
+            return
+        needed = self.target_replicas(metadata) - len(live)
+        if needed <= 0:
+            return
+        if not live:
+            print(f"Piece {piece_index} of {file_hash} has no live holders")
+            return
+
+        nodes = self.store.get_nodes()
+        loads = self.store.get_loads()
+        # Copy from the least busy holder to the nodes with most free disk
+        source = min(
+            live, key=lambda n: loads.get(str(n), {}).get("active_transfers", 0)
+        )
+        candidates = [n for n in nodes if n not in {str(h) for h in holders}]
+        if not candidates:
+            return
+        placement = WeightedPlacement(
+            needed,
+            {
+                node_id: load["free_disk"]
+                for node_id, load in loads.items()
+                if load.get("free_disk")
+            },
+        )
+        targets = placement.place(file_hash, piece_index, candidates)
+
+        # Chunks of deduplicated files are copied under their own hash
+        key_hash, key_index = self.store.piece_key(file_hash, piece_index)
+        request = {
+            "command": "replicate_piece",
+            "file_hash": key_hash,
+            "piece_index": key_index,
+            "targets": {node_id: nodes[node_id] for node_id in targets},
+        }
+        try:
+            response = self.send(nodes[str(source)], request)
+        except (OSError, ValueError) as e:
+            response = {"status": "error", "message": str(e)}
+        if response.get("status") != "replicated":
+            self.failed += 1
+            print(
+                f"Failed to repair piece {piece_index} of {file_hash}: "
+                f"{response.get('message')}"
+            )
+            return
+        for node_id in response["node_ids"]:
+            self.store.add_holder(file_hash, piece_index, node_id)
+        self.repaired += 1
+        # Some targets may have failed; check again
+        self.check(file_hash, piece_index)
+
+    def send(self, node, request):
+        # Send one framed JSON request to a node and return its reply
+        address = (node["ip_address"], node["port"])
+        with socket.create_connection(address, timeout=self.timeout) as s:
+            send_message(s, request)
+            response = recv_message(s)
+        if response is None:
+            raise ConnectionError("Node closed the connection")
+        return response
+
+    def scan_loop(self):
+        # Periodically re-check everything, catching repairs that failed
+        while self.running:
+            self.scan()
+            time.sleep(self.scan_interval)
+
+    def start(self):
+        threading.Thread(target=self.scan_loop, daemon=True).start()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        self.executor.shutdown(wait=False)
+
+
+def piece_size(metadata):
+    # Upper bound on the size of one piece of a file
+    file_size = metadata.get("file_size")
+    total_pieces = metadata.get("total_pieces")
+    if not file_size or not total_pieces:
+        return DEFAULT_PIECE_SIZE
+    return -(-file_size // total_pieces)
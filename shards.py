@@ -0,0 +1,199 @@
+"""Run a sharded tracker: one membership service plus file shards.
+
+The membership service is a tracker that registers nodes, takes their
+heartbeats and load reports, and hands out the shard list. Each file shard
+is a tracker that owns the files whose name hashes to it and mirrors the
+node registry from the membership service. Nodes route file commands to
+the owning shard themselves, so shards never talk to each other.
+
+    python shards.py --host 127.0.0.1 --port 4000 --shards 4
+
+starts the membership service on port 4000 and shards on 4001-4004, each
+in its own process with its own directory under --directory.
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from placement import hash_key
+from protocol import recv_message, send_message
+
+
+def shard_index(file_name, count):
+    # Shard owning a file name. The shard count is fixed for a deployment:
+    # files are not moved when it changes.
+    return hash_key(file_name) % count
+
+
+class MembershipFollower:
+    # Keeps a file shard's node registry and load reports in step with the
+    # membership service, through the same incremental get_nodes requests
+    # nodes use. `on_left(node_id)` is called for every node that left.
+    def __init__(self, store, address, on_left, interval=1.0, timeout=10):
+        self.store = store
+        self.address = address
+        self.on_left = on_left
+        self.interval = interval
+        self.timeout = timeout
+        self.sock = None
+        self.nodes = {}
+        self.epoch = None
+        self.version = None
+        self.running = True
+        # Serializes the background sync with on-demand refreshes
+        self.lock = threading.Lock()
+
+    def request(self, data):
+        # One framed request over a persistent connection, reconnecting
+        # after errors
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        try:
+            send_message(self.sock, data)
+            response = recv_message(self.sock)
+        except OSError:
+            self.close()
+            raise
+        if response is None:
+            self.close()
+            raise ConnectionError("Membership service closed the connection")
+        return response
+
+    def sync(self):
+        with self.lock:
+            response = self.request(
+                {"command": "get_nodes", "epoch": self.epoch, "since": self.version}
+            )
+            status = response["status"]
+            if status == "success":
+                self.nodes = response["nodes"]
+            elif status == "delta":
+                for node_id in response["left"]:
+                    self.nodes.pop(node_id, None)
+                self.nodes.update(response["joined"])
+            if status in ("success", "delta"):
+                for node_id in self.store.mirror_nodes(self.nodes):
+                    self.on_left(node_id)
+            self.epoch = response.get("epoch")
+            self.version = response.get("version")
+            self.store.set_loads(self.request({"command": "get_loads"})["loads"])
+
+    def refresh(self):
+        # Sync now, for a request naming a node that joined since the last
+        # sync. Returns whether the sync succeeded.
+        try:
+            self.sync()
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def run(self):
+        failing = False
+        while self.running:
+            try:
+                self.sync()
+                failing = False
+            except (OSError, ValueError, KeyError) as e:
+                if not failing:
+                    print(f"Error syncing membership from {self.address}: {e}")
+                failing = True
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def run_tracker(host, port, directory, use_async, membership=None, shards=None):
+    # Process entry point for one tracker of the cluster. SIGTERM stops it
+    # after its journal is flushed.
+    from tracker import Tracker
+
+    tracker = Tracker(host, port, directory, membership=membership, shards=shards)
+
+    def stop(signum, frame):
+        tracker.running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        if use_async:
+            tracker.start_async()
+        else:
+            tracker.start()
+    finally:
+        tracker.repair.stop()
+        tracker.store.close()
+    # Connection threads may still be blocked on idle clients
+    os._exit(0)
+
+
+def quiet_run_tracker(*args):
+    sys.stdout = open(os.devnull, "w")
+    run_tracker(*args)
+
+
+def start_cluster(host, port, count, directory, use_async=False, quiet=False):
+    # Start the membership service on `port` and `count` shards on the
+    # ports after it, returning their processes
+    context = multiprocessing.get_context("forkserver")
+    shards = [(host, port + 1 + i) for i in range(count)]
+    specs = [(port, os.path.join(directory, "membership"), None, shards)]
+    specs += [
+        (shard_port, os.path.join(directory, f"shard{i}"), (host, port), None)
+        for i, (_, shard_port) in enumerate(shards)
+    ]
+    processes = []
+    for tracker_port, tracker_directory, membership, shard_list in specs:
+        process = context.Process(
+            target=quiet_run_tracker if quiet else run_tracker,
+            args=(
+                host,
+                tracker_port,
+                tracker_directory,
+                use_async,
+                membership,
+                shard_list,
+            ),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--directory", default="tracker")
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    args = parser.parse_args()
+
+    processes = start_cluster(
+        args.host, args.port, args.shards, args.directory, args.use_async
+    )
+    print("\033[1;31mPRESS ENTER TO TERMINATE!\033[0m")
+    try:
+        input("")
+    except (EOFError, KeyboardInterrupt):
+        pass
+    print("Exiting...")
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
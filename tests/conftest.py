@@ -0,0 +1,22 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run_in_thread():
+    # Run target() in a thread and return [result], or [] if it is still
+    # running after the timeout, so a hang fails the test instead of the run
+    def run(target, timeout=10):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(target()), daemon=True)
+        thread.start()
+        thread.join(timeout)
+        return result
+
+    return run
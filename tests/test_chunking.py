@@ -0,0 +1,76 @@
+import io
+import os
+import random
+
+import pytest
+
+from chunking import content_defined_chunks, fixed_chunks
+from function import generate_piece_hash
+from uploader import ChunkUploader
+
+SIZES = {"min_size": 1024, "average_size": 4096, "max_size": 16384}
+
+
+def test_fixed_chunks():
+    assert list(fixed_chunks(io.BytesIO(b"abcdefgh"), 3)) == [b"abc", b"def", b"gh"]
+
+
+def cdc(data):
+    pytest.importorskip("numpy")
+    return list(content_defined_chunks(io.BytesIO(data), **SIZES))
+
+
+def test_content_defined_chunks_cover_the_file():
+    data = random.Random(1).randbytes(1024 * 1024)
+    chunks = cdc(data)
+    assert b"".join(chunks) == data
+    assert all(SIZES["min_size"] <= len(c) <= SIZES["max_size"] for c in chunks[:-1])
+    assert len(data) / len(chunks) < 2 * SIZES["average_size"]
+
+
+def test_content_defined_chunks_resync_after_an_insertion():
+    data = random.Random(2).randbytes(512 * 1024)
+    before = cdc(data)
+    after = cdc(data[:1000] + b"inserted" + data[1000:])
+    shared = set(before) & set(after)
+    assert len(shared) >= len(before) - 3
+
+
+def test_unchunkable_data_is_cut_at_max_size():
+    chunks = cdc(bytes(100000))
+    assert [len(c) for c in chunks[:-1]] == [SIZES["max_size"]] * (len(chunks) - 1)
+
+
+class ChunkSink:
+    def __init__(self):
+        self.sent = []
+
+    def send_piece_upload(self, node_id, node, file_hash, index, piece, compressed):
+        self.sent.append((node_id, file_hash))
+        return True
+
+
+def test_chunk_uploader_sends_each_new_chunk_once(run_in_thread):
+    known = os.urandom(100)
+    repeated = os.urandom(100)
+    chunks = [repeated, known, os.urandom(100), repeated]
+    lookups = []
+
+    def find_chunks(hashes):
+        lookups.append(hashes)
+        return {generate_piece_hash(known): ["3"]}
+
+    sink = ChunkSink()
+    uploader = ChunkUploader(
+        sink, {"1": {}, "2": {}}, lambda chunk_hash: ["1", "2"], find_chunks
+    )
+    run_in_thread(lambda: uploader.run(iter(chunks)))
+    hashes = [generate_piece_hash(c) for c in chunks]
+    assert uploader.piece_hashes == hashes
+    assert uploader.chunk_sizes == [100] * 4
+    assert sorted(sink.sent) == sorted(
+        (node_id, h) for h in (hashes[0], hashes[2]) for node_id in ("1", "2")
+    )
+    assert uploader.piece_distribution[hashes[1]] == ["3"]
+    assert uploader.sent_bytes == 200
+    assert uploader.reused_bytes == 200
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from compression import (
+    STORED_MAGIC,
+    compress_piece,
+    decode_payload,
+    unwrap_stored,
+    wrap_stored,
+)
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma", "bz2"])
+def test_compressible_piece_round_trips(codec):
+    piece = b"the same words again and again " * 4096
+    payload, cpu_seconds = compress_piece(codec, piece)
+    assert payload is not None
+    assert len(payload) < len(piece) / 10
+    assert cpu_seconds >= 0
+    assert decode_payload(payload) == piece
+    assert unwrap_stored(wrap_stored(payload)) == piece
+
+
+def test_incompressible_piece_is_sent_raw():
+    payload, _ = compress_piece("zlib", os.urandom(256 * 1024))
+    assert payload is None
+
+
+def test_raw_piece_is_stored_as_is():
+    assert unwrap_stored(b"plain piece") == b"plain piece"
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compress_piece("zstd", b"a" * 100000)
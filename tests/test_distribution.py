@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from distribution import decode_distribution, encode_distribution, holder_lists
+
+
+def normalized(distribution):
+    # Holder order within a piece is not preserved
+    return {
+        str(i): sorted(set(map(str, holders)))
+        for i, holders in enumerate(holder_lists(distribution))
+    }
+
+
+def round_trip(distribution):
+    layout = encode_distribution(distribution)
+    assert normalized(decode_distribution(layout)) == normalized(distribution)
+    return layout
+
+
+def test_round_robin_is_a_pattern():
+    nodes = [1, 2, 3, 4]
+    distribution = {str(i): [nodes[i % 4], nodes[(i + 1) % 4]] for i in range(10000)}
+    layout = round_trip(distribution)
+    assert len(layout["pattern"]) == 4
+    assert "extra" not in layout and "exceptions" not in layout
+
+
+def test_downloader_holding_everything_is_one_range():
+    distribution = {str(i): [i % 3 + 1] for i in range(3000)}
+    for holders in distribution.values():
+        holders.append(9)
+    layout = round_trip(distribution)
+    assert "exceptions" not in layout
+
+
+def test_partial_downloader_is_an_extra_range():
+    distribution = {str(i): [i % 3 + 1, (i + 1) % 3 + 1] for i in range(3000)}
+    for i in range(50):
+        distribution[str(i)].append(9)
+    layout = round_trip(distribution)
+    assert layout.get("extra") == {"9": [[0, 50]]}
+
+
+def test_holders_that_left_become_exceptions():
+    distribution = {str(i): [i % 4 + 1, (i + 1) % 4 + 1] for i in range(400)}
+    for i in (7, 123, 399):
+        distribution[str(i)] = []
+    round_trip(distribution)
+
+
+def test_random_distribution():
+    rng = random.Random(1)
+    distribution = {
+        str(i): rng.sample(range(1, 20), rng.randint(0, 4)) for i in range(500)
+    }
+    round_trip(distribution)
+
+
+@pytest.mark.parametrize("keys", [str, int])
+def test_int_and_str_keys(keys):
+    distribution = {keys(i): [i % 2 + 1] for i in range(10)}
+    round_trip(distribution)
+
+
+def test_indices_with_gaps():
+    distribution = {"0": [1], "2": [2], "5": [1, 2]}
+    decoded = decode_distribution(encode_distribution(distribution))
+    assert sorted(decoded["5"]) == ["1", "2"]
+    assert decoded["1"] == [] and decoded["3"] == [] and decoded["4"] == []
+
+
+def test_empty_distribution():
+    assert decode_distribution(encode_distribution({})) == {}
@@ -0,0 +1,183 @@
+import errno
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from downloader import DownloadSink, PieceDownloader
+from function import generate_piece_hash
+from verify import PieceVerifier
+
+FILE_HASH = "ab" * 20
+
+
+class PieceSource:
+    # Stands in for a node: every holder returns the piece's index as data
+    def __init__(self):
+        self.asked = []
+
+    def request_piece(self, ip, port, file_hash, piece_index, timeout, cancel):
+        self.asked.append(port)
+        return bytes([piece_index]) * 10
+
+
+def make_downloader(source, on_piece, pieces=8, holders=("1",), **options):
+    nodes = {
+        node_id: {"ip_address": "127.0.0.1", "port": int(node_id)}
+        for node_id in holders
+    }
+    distribution = {str(i): list(holders) for i in range(pieces)}
+    return PieceDownloader(
+        source, FILE_HASH, range(pieces), distribution, nodes, on_piece, **options
+    )
+
+
+def test_download_completes(run_in_thread):
+    stored = {}
+    downloader = make_downloader(PieceSource(), stored.__setitem__)
+    assert run_in_thread(downloader.run) == [[]]
+    assert stored == {i: bytes([i]) * 10 for i in range(8)}
+
+
+def test_failed_holder_falls_back_to_another(run_in_thread):
+    class FlakySource(PieceSource):
+        def request_piece(self, ip, port, *args, **kwargs):
+            if port == 1:
+                self.asked.append(port)
+                return None
+            return super().request_piece(ip, port, *args, **kwargs)
+
+    stored = {}
+    downloader = make_downloader(FlakySource(), stored.__setitem__, holders=("1", "2"))
+    assert run_in_thread(downloader.run) == [[]]
+    assert sorted(stored) == list(range(8))
+
+
+def test_sink_writes_pieces_in_place(tmp_path):
+    path = str(tmp_path / "file")
+    sink = DownloadSink(path, FILE_HASH, 3, 4, file_size=10)
+    for i, piece in reversed(list(enumerate([b"aaaa", b"bbbb", b"cc"]))):
+        sink.write(i, piece)
+    assert sink.missing() == []
+    sink.close(complete=True)
+    with open(path, "rb") as f:
+        assert f.read() == b"aaaabbbbcc"
+    assert not os.path.exists(path + ".bitfield")
+
+
+def test_sink_resumes_from_bitfield(tmp_path):
+    path = str(tmp_path / "file")
+    sink = DownloadSink(path, FILE_HASH, 3, 4, file_size=10)
+    sink.write(1, b"bbbb")
+    sink.close(complete=False)
+
+    sink = DownloadSink(path, FILE_HASH, 3, 4, file_size=10)
+    assert sink.missing() == [0, 2]
+    assert sink.read(1, 4) == b"bbbb"
+    sink.write(0, b"aaaa")
+    sink.write(2, b"cc")
+    sink.close(complete=True)
+    with open(path, "rb") as f:
+        assert f.read() == b"aaaabbbbcc"
+
+
+def test_sink_ignores_bitfield_of_another_file(tmp_path):
+    path = str(tmp_path / "file")
+    sink = DownloadSink(path, FILE_HASH, 3, 4, file_size=10)
+    sink.write(1, b"bbbb")
+    sink.close(complete=False)
+    sink = DownloadSink(path, "cd" * 20, 3, 4, file_size=10)
+    assert sink.missing() == [0, 1, 2]
+    sink.close(complete=False)
+
+
+def test_sink_variable_piece_sizes(tmp_path):
+    path = str(tmp_path / "file")
+    sink = DownloadSink(path, FILE_HASH, 3, 0, file_size=9, piece_sizes=[2, 5, 2])
+    sink.write(2, b"zz")
+    sink.write(0, b"xx")
+    sink.write(1, b"yyyyy")
+    sink.close(complete=True)
+    with open(path, "rb") as f:
+        assert f.read() == b"xxyyyyyzz"
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+
+def test_corrupt_pieces_are_fetched_again(run_in_thread, executor):
+    class CorruptingSource(PieceSource):
+        def request_piece(self, ip, port, *args, **kwargs):
+            piece = super().request_piece(ip, port, *args, **kwargs)
+            return b"bad" if port == 1 else piece
+
+    hashes = [generate_piece_hash(bytes([i]) * 10) for i in range(8)]
+    stored = {}
+    downloader = make_downloader(
+        CorruptingSource(),
+        stored.__setitem__,
+        holders=("1", "2"),
+        verifier=PieceVerifier(hashes, executor),
+    )
+    assert run_in_thread(downloader.run) == [[]]
+    assert stored == {i: bytes([i]) * 10 for i in range(8)}
+
+
+def test_piece_corrupt_everywhere_fails(run_in_thread, executor):
+    hashes = ["00" * 20] * 8
+    downloader = make_downloader(
+        PieceSource(), lambda i, d: None, verifier=PieceVerifier(hashes, executor)
+    )
+    assert run_in_thread(downloader.run) == [list(range(8))]
+
+
+def full_disk(piece_index, piece_data):
+    raise OSError(errno.ENOSPC, "No space left on device")
+
+
+def test_store_failure_fails_pieces_instead_of_hanging(run_in_thread):
+    downloader = make_downloader(PieceSource(), full_disk)
+    assert run_in_thread(downloader.run) == [list(range(8))]
+
+
+def test_store_failure_after_verification_does_not_hang(run_in_thread, executor):
+    hashes = [generate_piece_hash(bytes([i]) * 10) for i in range(8)]
+    downloader = make_downloader(
+        PieceSource(), full_disk, verifier=PieceVerifier(hashes, executor)
+    )
+    assert run_in_thread(downloader.run) == [list(range(8))]
+
+
+def test_verifier_error_does_not_hang(run_in_thread):
+    class BrokenVerifier:
+        def submit(self, piece_index, piece_data):
+            future = Future()
+            future.set_exception(RuntimeError("hash pool died"))
+            return future
+
+    downloader = make_downloader(
+        PieceSource(), lambda i, d: None, verifier=BrokenVerifier()
+    )
+    assert run_in_thread(downloader.run) == [list(range(8))]
+
+
+def test_refresh_dropping_a_holder_does_not_stall(run_in_thread):
+    # Every refresh swaps in a registry without node 1; its queued pieces
+    # move to node 2
+    stored = {}
+    downloader = make_downloader(
+        PieceSource(),
+        stored.__setitem__,
+        pieces=64,
+        holders=("1", "2"),
+        refresh_interval=0,
+    )
+    distribution = dict(downloader.piece_distribution)
+    node = {"2": {"ip_address": "127.0.0.1", "port": 2}}
+    downloader.refresh = lambda: (distribution, node, {})
+    assert run_in_thread(downloader.run) == [[]]
+    assert sorted(stored) == list(range(64))
@@ -0,0 +1,55 @@
+import itertools
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from erasure import ErasureCoder, ErasureEncoder, ErasureLayout
+
+
+@pytest.mark.parametrize("k, m", [(2, 1), (4, 2), (6, 3)])
+def test_any_k_shards_recover_the_data(k, m):
+    coder = ErasureCoder(k, m)
+    data = [os.urandom(1000) for _ in range(k)]
+    shards = dict(enumerate(data + coder.encode(data)))
+    for chosen in itertools.combinations(range(k + m), k):
+        assert coder.decode({i: shards[i] for i in chosen}) == data
+
+
+def test_too_few_shards():
+    coder = ErasureCoder(4, 2)
+    data = [os.urandom(10) for _ in range(4)]
+    shards = dict(enumerate(data + coder.encode(data)))
+    with pytest.raises(ValueError):
+        coder.decode({i: shards[i] for i in (0, 4, 5)})
+
+
+def test_invalid_parameters():
+    with pytest.raises(ValueError):
+        ErasureCoder(0, 2)
+    with pytest.raises(ValueError):
+        ErasureCoder(200, 100)
+
+
+def test_encoder_pads_the_last_group():
+    layout = ErasureLayout(4, 2, data_pieces=6, piece_size=8)
+    assert layout.groups == 2
+    assert layout.total_pieces == 10
+    encoder = ErasureEncoder(layout)
+    pieces = [os.urandom(8) for _ in range(5)] + [b"tail"]
+    parity = {}
+    for index, piece in enumerate(pieces):
+        parity.update(encoder.add(index, piece))
+    assert sorted(parity) == [6, 7, 8, 9]
+
+    # Group 1 holds pieces 4 and 5 plus two zero pieces that are never stored
+    coder = ErasureCoder(4, 2)
+    group = [layout.pad(pieces[4]), layout.pad(pieces[5]), bytes(8), bytes(8)]
+    shards = {
+        2: bytes(8),
+        3: bytes(8),
+        layout.shard_index(8): parity[8],
+        layout.shard_index(9): parity[9],
+    }
+    assert coder.decode(shards) == group
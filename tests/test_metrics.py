@@ -0,0 +1,45 @@
+import os
+
+from metrics import Metrics
+
+
+def test_snapshot_reports_counters_histograms_and_gauges():
+    metrics = Metrics("test")
+    requests = metrics.counter("requests_total", "Requests", "command")
+    seconds = metrics.histogram("request_seconds", "Latency", "command")
+    metrics.gauge("cache", "Cache", lambda: {"hits": 3, "name": "lru"}, "stat")
+    requests.inc("get")
+    requests.inc("get")
+    requests.inc("put", 5)
+    seconds.observe("get", 0.00015)
+    seconds.observe("get", 0.0003)
+    stats = metrics.snapshot()
+    assert stats["requests_total"] == {"get": 2, "put": 5}
+    assert stats["request_seconds"]["get"]["count"] == 2
+    assert abs(stats["request_seconds"]["get"]["sum"] - 0.00045) < 1e-12
+    assert stats["request_seconds"]["get"]["p50"] == 0.0002
+    assert stats["request_seconds"]["get"]["p99"] == 0.0004
+    # Only numbers are reported for labelled gauges
+    assert stats["cache"] == {"hits": 3}
+    assert stats["threads"] >= 1
+
+
+def test_prometheus_text_format(tmp_path):
+    metrics = Metrics("test")
+    metrics.counter("requests_total", "Requests", "command").inc('say "hi"')
+    seconds = metrics.histogram("request_seconds", "Latency", "command")
+    seconds.observe("get", 0.00015)
+    seconds.observe("get", 100)
+    path = str(tmp_path / "metrics.prom")
+    metrics.dump(path)
+    assert not os.path.exists(path + ".tmp")
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{command="say \\"hi\\""} 1' in lines
+    assert "# TYPE test_request_seconds histogram" in lines
+    assert 'test_request_seconds_bucket{command="get",le="0.0001"} 0' in lines
+    assert 'test_request_seconds_bucket{command="get",le="0.0002"} 1' in lines
+    assert 'test_request_seconds_bucket{command="get",le="+Inf"} 2' in lines
+    assert 'test_request_seconds_count{command="get"} 2' in lines
+    assert "# TYPE test_threads gauge" in lines
@@ -0,0 +1,226 @@
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+
+from node import Node
+from piece_store import open_piece_store
+from protocol import CMD_DOWNLOAD_PIECE, pack_header, send_frame
+from test_tracker import register, upload
+from tracker import Tracker
+
+NODES = {str(i): {"ip_address": "127.0.0.1", "port": 9000 + i} for i in range(1, 4)}
+
+
+@pytest.fixture
+def node(request, tmp_path):
+    # A node that is never started: requests are dispatched directly and
+    # network calls are replaced by the tests
+    node = Node("127.0.0.1", 9000, host="127.0.0.1", port=9100, directory=str(tmp_path))
+    node.node_id = 100
+    backend = getattr(request, "param", "packed")
+    node.piece_store = open_piece_store(backend, str(tmp_path / "pieces"))
+    yield node
+    node.piece_store.close()
+    node.pool.close()
+    node.hash_executor.shutdown()
+
+
+@pytest.mark.parametrize("node", ["directory", "packed"], indirect=True)
+def test_abort_upload_deletes_staged_pieces(node):
+    staging_id = "ab" * 20
+    other = "cd" * 20
+    for i in range(3):
+        node.piece_store.put(staging_id, i, b"staged")
+    node.piece_store.put(other, 0, b"kept")
+    response = node.dispatch({"command": "abort_upload", "staging_id": staging_id})
+    assert response["status"] == "success"
+    assert list(node.piece_store.keys()) == [(other, 0)]
+
+
+def test_failed_upload_is_discarded_on_every_target(node, tmp_path):
+    # Node 2 refuses its pieces, so with one replica the upload fails and
+    # both nodes that were sent pieces are told to drop the staging
+    requests = []
+    node.replication_factor = 1
+    node.send_piece_upload = lambda node_id, *args: node_id != "2"
+    node.send_node_request = lambda data: requests.append(data) or {"status": "success"}
+    path = tmp_path / "file"
+    path.write_bytes(b"x" * 100)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr("node.SIZE", 10)
+        assert node.prepare_upload(str(path), "file", dict(NODES)) is None
+    assert {r["command"] for r in requests} == {"abort_upload"}
+    assert sorted(r["source_node_port"] for r in requests) == [9001, 9002, 9003]
+    assert len({r["staging_id"] for r in requests}) == 1
+
+
+def test_binary_connection_closes_on_partial_frame(node):
+    # Idle timeouts are tolerated while a request is in flight, but a frame
+    # cut off partway ends the connection instead of misaligning it
+    submitted = []
+    node.server_idle_timeout = 0.2
+    node.request_executor = SimpleNamespace(
+        submit=lambda handler, *args: submitted.append(args[-1])
+    )
+    server = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    try:
+        send_frame(client, CMD_DOWNLOAD_PIECE, "ab" * 20, 3)
+        served = threading.Thread(target=node.handle_binary_requests, args=(conn,))
+        served.start()
+        time.sleep(0.5)
+        assert served.is_alive()
+        client.sendall(pack_header(CMD_DOWNLOAD_PIECE, "ab" * 20, 4, 0)[:10])
+        served.join(2)
+        assert not served.is_alive()
+        assert [frame.piece_index for frame in submitted] == [3]
+    finally:
+        client.close()
+        conn.close()
+        server.close()
+
+
+def test_membership_cache_follows_tracker_deltas(node, tmp_path):
+    tracker = Tracker("127.0.0.1", 0, str(tmp_path / "tracker"))
+    requests = []
+
+    def send_request(data):
+        requests.append(data)
+        return tracker.dispatch(data)
+
+    node.send_request = send_request
+    node.membership_ttl = 0
+    try:
+        register(tracker, 5001)
+        register(tracker, 5002)
+        assert sorted(node.get_active_nodes()) == ["1", "2"]
+        tracker.dispatch({"command": "disconnect", "node_id": 1})
+        register(tracker, 5003)
+        assert sorted(node.get_active_nodes()) == ["2", "3"]
+        assert sorted(node.get_active_nodes()) == ["2", "3"]
+        assert [r["since"] for r in requests] == [None, 2, 4]
+
+        # Within the TTL the cache answers without asking the tracker
+        node.membership_ttl = 60
+        node.get_active_nodes()
+        assert len(requests) == 3
+    finally:
+        tracker.repair.stop()
+        tracker.store.close()
+
+
+def test_placement_is_kept_across_uploads(node):
+    node.placement_strategy = "consistent_hash"
+    placement = node.placement_for(2)
+    assert node.placement_for(2) is placement
+    assert node.placement_for(3) is not placement
+
+    node.placement_strategy = "weighted"
+    loads = {"1": {"free_disk": 100}}
+    node.send_request = lambda data: {"status": "success", "loads": loads}
+    weighted = node.placement_for(2)
+    assert node.placement_for(2) is weighted
+    loads["2"] = {"free_disk": 50}
+    assert node.placement_for(2).weights == {"1": 100, "2": 50}
+
+
+class BrokenPool:
+    def submit(self, *args):
+        raise BrokenProcessPool("A child process terminated abruptly")
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def test_broken_compression_pool_is_replaced(node):
+    node.compression = "zlib"
+    node.compression_executor = BrokenPool()
+    node.create_compression_executor = lambda: ThreadPoolExecutor(max_workers=1)
+    assert node.compress_piece(b"a" * 100000) is None
+    future = node.compress_piece(b"a" * 100000)
+    payload, _ = future.result()
+    assert payload is not None
+    node.compression_executor.shutdown()
+
+
+def test_compression_is_turned_off_after_repeated_failures(node):
+    node.compression = "zlib"
+    node.create_compression_executor = BrokenPool
+    node.compression_executor = BrokenPool()
+    for _ in range(node.compression_restarts + 1):
+        assert node.compress_piece(b"a" * 100000) is None
+    assert node.compression_executor is None
+    assert node.compress_piece(b"a" * 100000) is None
+
+
+def test_chunks_are_spread_over_the_nodes(node, tmp_path):
+    nodes = {str(i): {"ip_address": "127.0.0.1", "port": 9000 + i} for i in range(1, 6)}
+    holders = Counter()
+    node.chunking = "fixed"
+    node.find_chunks = lambda hashes: {}
+
+    def send_piece_upload(node_id, *args):
+        holders[node_id] += 1
+        return True
+
+    node.send_piece_upload = send_piece_upload
+    path = tmp_path / "file"
+    path.write_bytes(os.urandom(100 * 64))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr("node.SIZE", 100)
+        data = node.prepare_upload(str(path), "file", nodes)
+    assert len(data["chunks"]) == 64
+    assert sum(holders.values()) == 2 * 64
+    assert set(holders) == set(nodes)
+    assert max(holders.values()) < 64
+
+
+def test_stats_reports_requests_and_stored_bytes(node):
+    node.piece_store.put("ab" * 20, 0, b"x" * 100)
+    node.dispatch({"command": "no_such_command"})
+    stats = node.dispatch({"command": "stats"})["stats"]
+    assert stats["requests_total"] == {"unknown": 1, "stats": 1}
+    assert stats["piece_store_bytes"] >= 100
+    assert stats["connections"] == 0
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_files_are_resolved_in_batches(node, tmp_path, legacy):
+    # A legacy tracker knows neither batch nor resolve; the node falls back
+    # to one download request per file
+    tracker = Tracker("127.0.0.1", 0, str(tmp_path / "tracker"))
+    if legacy:
+        del tracker.handlers["batch"]
+        del tracker.handlers["resolve"]
+    commands = []
+
+    def send_request(data, address=None):
+        commands.append(data["command"])
+        return tracker.dispatch(data)
+
+    node.send_request = send_request
+    node.tracker_batch_size = 2
+    try:
+        holder = register(tracker, 5001)
+        names = ["file0", "file1", "file2", "missing"]
+        for i, name in enumerate(names[:3]):
+            upload(tracker, holder, name, f"{i:02x}" * 20, pieces=2)
+        commands.clear()
+        responses = node.send_batch([node.resolve_request(n) for n in names])
+        resolved = [node.resolve_file(n, r) for n, r in zip(names, responses)]
+        assert [r["status"] for r in resolved] == ["success"] * 3 + ["error"]
+        address = {"ip_address": "127.0.0.1", "port": 5001}
+        assert all(r["nodes"] == {str(holder): address} for r in resolved[:3])
+        assert commands.count("batch") == 2
+        assert commands.count("download") == (4 if legacy else 0)
+    finally:
+        tracker.repair.stop()
+        tracker.store.close()
@@ -0,0 +1,131 @@
+import os
+
+import pytest
+
+from piece_store import DirectoryPieceStore, PackedPieceStore, open_piece_store
+
+FILE_HASH = "ab" * 20
+OTHER_HASH = "cd" * 20
+
+
+@pytest.mark.parametrize("backend", ["directory", "packed"])
+def test_put_get_delete(tmp_path, backend):
+    store = open_piece_store(backend, str(tmp_path))
+    store.put(FILE_HASH, 0, b"zero")
+    store.put(FILE_HASH, 1, b"one")
+    assert store.get(FILE_HASH, 0) == b"zero"
+    assert store.get(FILE_HASH, 1) == b"one"
+    assert store.get(FILE_HASH, 2) is None
+    assert sorted(store.keys()) == [(FILE_HASH, 0), (FILE_HASH, 1)]
+    assert store.delete(FILE_HASH, 0)
+    assert store.get(FILE_HASH, 0) is None
+    store.close()
+
+
+@pytest.mark.parametrize("backend", ["directory", "packed"])
+def test_open_handle(tmp_path, backend):
+    store = open_piece_store(backend, str(tmp_path))
+    store.put(FILE_HASH, 4, b"piece data")
+    handle = store.open(FILE_HASH, 4)
+    assert handle.length == len(b"piece data")
+    assert handle.read() == b"piece data"
+    handle.close()
+    assert store.open(FILE_HASH, 5) is None
+    store.close()
+
+
+def test_packed_reopen(tmp_path):
+    store = PackedPieceStore(str(tmp_path))
+    store.put(FILE_HASH, 0, b"old")
+    store.put(FILE_HASH, 0, b"new")
+    store.put(FILE_HASH, 1, b"gone")
+    store.delete(FILE_HASH, 1)
+    store.put(OTHER_HASH, 2, b"other")
+    store.close()
+
+    store = PackedPieceStore(str(tmp_path))
+    assert store.get(FILE_HASH, 0) == b"new"
+    assert store.get(FILE_HASH, 1) is None
+    assert store.get(OTHER_HASH, 2) == b"other"
+    store.close()
+
+
+def test_packed_rename_file(tmp_path):
+    store = PackedPieceStore(str(tmp_path))
+    store.put(FILE_HASH, 0, b"staged")
+    assert store.rename_file(FILE_HASH, OTHER_HASH)
+    store.close()
+    store = PackedPieceStore(str(tmp_path))
+    assert store.get(OTHER_HASH, 0) == b"staged"
+    assert store.get(FILE_HASH, 0) is None
+    store.close()
+
+
+def test_packed_rolls_over_and_compacts(tmp_path):
+    store = PackedPieceStore(str(tmp_path), pack_size=200)
+    for i in range(6):
+        store.put(FILE_HASH, i, bytes([i]) * 60)
+    packs = [n for n in os.listdir(tmp_path) if n.startswith("pack_")]
+    assert len(packs) == 2
+    for i in (0, 1):
+        store.delete(FILE_HASH, i)
+    assert store.compact() == 1
+    assert len([n for n in os.listdir(tmp_path) if n.startswith("pack_")]) == 2
+    for i in range(2, 6):
+        assert store.get(FILE_HASH, i) == bytes([i]) * 60
+    store.close()
+
+    store = PackedPieceStore(str(tmp_path), pack_size=200)
+    assert sorted(i for _, i in store.keys()) == [2, 3, 4, 5]
+    assert store.get(FILE_HASH, 2) == bytes([2]) * 60
+    store.close()
+
+
+def test_compaction_keeps_reader_until_released(tmp_path):
+    store = PackedPieceStore(str(tmp_path), pack_size=200)
+    for i in range(4):
+        store.put(FILE_HASH, i, bytes([i]) * 60)
+    store.delete(FILE_HASH, 0)
+    store.delete(FILE_HASH, 1)
+    handle = store.open(FILE_HASH, 2)
+    assert store.compact() == 1
+    # The old pack is gone from disk but still readable through the handle
+    assert not handle.file.closed
+    assert handle.read() == bytes([2]) * 60
+    handle.close()
+    assert handle.file.closed
+    assert store.retired == set()
+    store.close()
+
+
+def test_replay_drops_records_past_pack_end(tmp_path):
+    store = PackedPieceStore(str(tmp_path))
+    store.put(FILE_HASH, 0, b"a" * 100)
+    store.put(FILE_HASH, 1, b"b" * 100)
+    store.close()
+    # A crash lost the tail of the pack but not the index record
+    pack = os.path.join(tmp_path, "pack_000000.dat")
+    os.truncate(pack, 150)
+
+    store = PackedPieceStore(str(tmp_path))
+    assert store.get(FILE_HASH, 0) == b"a" * 100
+    assert store.get(FILE_HASH, 1) is None
+    store.close()
+
+
+def test_replay_ignores_torn_index_record(tmp_path):
+    store = PackedPieceStore(str(tmp_path))
+    store.put(FILE_HASH, 0, b"kept")
+    store.close()
+    with open(os.path.join(tmp_path, "index.log"), "ab") as f:
+        f.write(b"\x01partial")
+    store = PackedPieceStore(str(tmp_path))
+    assert store.get(FILE_HASH, 0) == b"kept"
+    store.close()
+
+
+def test_directory_store_size(tmp_path):
+    store = DirectoryPieceStore(str(tmp_path))
+    store.put(FILE_HASH, 0, b"12345")
+    store.put(OTHER_HASH, 0, b"123")
+    assert store.size() == 8
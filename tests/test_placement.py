@@ -0,0 +1,81 @@
+from collections import Counter
+
+import pytest
+
+from placement import (
+    ConsistentHashPlacement,
+    RoundRobinPlacement,
+    WeightedPlacement,
+    create_placement,
+)
+
+NODES = [str(i) for i in range(1, 11)]
+
+
+def test_round_robin_rotates_over_nodes():
+    placement = RoundRobinPlacement(2)
+    assert [placement.place("f", i, NODES[:3]) for i in range(4)] == [
+        ["1", "2"],
+        ["2", "3"],
+        ["3", "1"],
+        ["1", "2"],
+    ]
+
+
+@pytest.mark.parametrize("strategy", ["round_robin", "consistent_hash", "weighted"])
+def test_replicas_go_to_distinct_nodes(strategy):
+    placement = create_placement(strategy, 3)
+    for i in range(100):
+        targets = placement.place("f", i, NODES)
+        assert len(targets) == len(set(targets)) == 3
+        assert set(targets) <= set(NODES)
+
+
+@pytest.mark.parametrize("strategy", ["round_robin", "consistent_hash", "weighted"])
+def test_fewer_nodes_than_replicas(strategy):
+    assert sorted(create_placement(strategy, 3).place("f", 0, ["1", "2"])) == [
+        "1",
+        "2",
+    ]
+
+
+def test_consistent_hash_is_stable_and_spread():
+    placement = ConsistentHashPlacement(1)
+    owners = [placement.place("f", i, NODES)[0] for i in range(2000)]
+    assert owners == [
+        ConsistentHashPlacement(1).place("f", i, reversed(NODES))[0]
+        for i in range(2000)
+    ]
+    assert set(Counter(owners)) == set(NODES)
+
+
+def test_consistent_hash_moves_few_pieces_when_a_node_joins():
+    placement = ConsistentHashPlacement(1)
+    before = [placement.place("f", i, NODES)[0] for i in range(2000)]
+    after = [placement.place("f", i, NODES + ["11"])[0] for i in range(2000)]
+    moved = [(a, b) for a, b in zip(before, after) if a != b]
+    assert all(b == "11" for _, b in moved)
+    assert len(moved) < 2000 / 5
+
+
+def test_consistent_hash_reuses_its_ring():
+    placement = ConsistentHashPlacement(2)
+    placement.place("f", 0, NODES)
+    points = placement.points
+    placement.place("f", 1, list(reversed(NODES)))
+    assert placement.points is points
+    placement.place("f", 2, NODES[:5])
+    assert placement.points is not points
+
+
+def test_weighted_follows_weights():
+    weights = {node_id: 1 for node_id in NODES}
+    weights["1"] = 10
+    placement = WeightedPlacement(1, weights)
+    owners = Counter(placement.place("f", i, NODES)[0] for i in range(2000))
+    assert owners["1"] > 3 * max(owners[n] for n in NODES[1:])
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        create_placement("random")
@@ -0,0 +1,50 @@
+import socket
+import threading
+
+from pool import ConnectionPool
+from protocol import recv_message, send_message
+
+
+def test_pool_gives_up_on_silent_legacy_peer():
+    # A legacy peer reads the framed request but neither replies nor
+    # closes; the pool must report it as unanswered instead of hanging
+    server = socket.create_server(("127.0.0.1", 0))
+    address = server.getsockname()
+    accepted = []
+
+    def accept():
+        conn, _ = server.accept()
+        accepted.append(conn)
+        conn.recv(1024)
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    pool = ConnectionPool(probe_timeout=0.5)
+    try:
+        assert pool.request_message(address, {"command": "register"}) is None
+    finally:
+        pool.close()
+        server.close()
+        for conn in accepted:
+            conn.close()
+
+
+def test_pool_reuses_framed_peer():
+    server = socket.create_server(("127.0.0.1", 0))
+    address = server.getsockname()
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            while (request := recv_message(conn)) is not None:
+                send_message(conn, {"echo": request["n"]})
+
+    threading.Thread(target=serve, daemon=True).start()
+    pool = ConnectionPool(probe_timeout=0.5)
+    try:
+        for n in range(3):
+            assert pool.request_message(address, {"n": n}) == {"echo": n}
+        assert pool.stats()["misses"] == 1
+    finally:
+        pool.close()
+        server.close()
@@ -0,0 +1,138 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from protocol import (
+    CMD_DOWNLOAD_PIECE,
+    HEADER_SIZE,
+    MAX_MESSAGE_SIZE,
+    MESSAGE_HEADER,
+    STATUS_ERROR,
+    ProtocolError,
+    encode_message,
+    is_binary_request,
+    is_legacy_message,
+    pack_header,
+    recv_frame,
+    recv_json,
+    recv_message,
+    send_frame,
+    send_message,
+    unpack_header,
+)
+
+FILE_HASH = "0123456789abcdef0123456789abcdef01234567"
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def test_header_round_trip():
+    header = pack_header(CMD_DOWNLOAD_PIECE, FILE_HASH, 7, 1234, STATUS_ERROR, 99)
+    assert len(header) == HEADER_SIZE
+    assert unpack_header(header) == (
+        CMD_DOWNLOAD_PIECE,
+        STATUS_ERROR,
+        99,
+        FILE_HASH,
+        7,
+        1234,
+    )
+
+
+def test_header_rejects_bad_magic():
+    header = b"XX" + pack_header(CMD_DOWNLOAD_PIECE, FILE_HASH, 0, 0)[2:]
+    with pytest.raises(ProtocolError):
+        unpack_header(header)
+
+
+def test_frame_round_trip(pair):
+    a, b = pair
+    payload = bytes(range(256)) * 100
+    send_frame(a, CMD_DOWNLOAD_PIECE, FILE_HASH, 3, payload, request_id=5)
+    frame = recv_frame(b)
+    assert frame.command == CMD_DOWNLOAD_PIECE
+    assert frame.request_id == 5
+    assert frame.file_hash == FILE_HASH
+    assert frame.piece_index == 3
+    assert bytes(frame.payload) == payload
+
+
+def test_frame_truncated(pair):
+    a, b = pair
+    a.sendall(pack_header(CMD_DOWNLOAD_PIECE, FILE_HASH, 0, 10) + b"short")
+    a.close()
+    with pytest.raises(ConnectionError):
+        recv_frame(b)
+
+
+def test_sniff_binary_frame(pair):
+    a, b = pair
+    send_frame(a, CMD_DOWNLOAD_PIECE, FILE_HASH, 0)
+    assert is_binary_request(b)
+    # Peeking leaves the frame to be read
+    assert recv_frame(b).piece_index == 0
+
+
+def test_sniff_json_request(pair):
+    a, b = pair
+    a.sendall(json.dumps({"command": "download_piece"}).encode())
+    assert not is_binary_request(b)
+    assert recv_json(b) == {"command": "download_piece"}
+
+
+def test_recv_json_across_reads(pair):
+    a, b = pair
+    body = json.dumps({"piece": "x" * 100000}).encode()
+
+    def send():
+        for i in range(0, len(body), 1000):
+            a.sendall(body[i : i + 1000])
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    assert recv_json(b) == {"piece": "x" * 100000}
+    thread.join()
+
+
+def test_message_round_trip(pair):
+    a, b = pair
+    message = {"command": "get_nodes", "since": 3, "text": "héllo"}
+    send_message(a, message)
+    assert recv_message(b) == message
+
+
+def test_message_none_on_close(pair):
+    a, b = pair
+    a.close()
+    assert recv_message(b) is None
+
+
+def test_message_too_large(pair):
+    a, b = pair
+    a.sendall(MESSAGE_HEADER.pack(MAX_MESSAGE_SIZE + 1))
+    with pytest.raises(ProtocolError):
+        recv_message(b)
+
+
+def test_sniff_legacy_json(pair):
+    a, b = pair
+    a.sendall(json.dumps({"command": "register"}).encode())
+    assert is_legacy_message(b)
+    assert not is_binary_request(b)
+    # Peeking leaves the request to be read
+    assert recv_json(b) == {"command": "register"}
+
+
+def test_sniff_framed_message(pair):
+    a, b = pair
+    a.sendall(encode_message({"command": "register"}))
+    assert not is_legacy_message(b)
+    assert recv_message(b) == {"command": "register"}
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from repair import RepairScheduler
+from tracker_store import TrackerStore
+
+FILE_HASH = "ab" * 20
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = TrackerStore(str(tmp_path))
+    for port in range(5001, 5005):
+        store.register_node("127.0.0.1", port)
+    # Piece 0 on nodes 1 and 2, piece 1 on nodes 1 and 3, piece 2 on 1 only
+    store.add_file(
+        {
+            "file_name": "file",
+            "file_hash": FILE_HASH,
+            "total_pieces": 3,
+            "file_size": 3000,
+            "replication_factor": 2,
+            "piece_distribution": {"0": ["1", "2"], "1": ["1", "3"], "2": ["1"]},
+        }
+    )
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def scheduler(store):
+    scheduler = RepairScheduler(store)
+    yield scheduler
+    scheduler.stop()
+
+
+def queued(scheduler):
+    return [(live, key) for live, _, key in sorted(scheduler.queue)]
+
+
+def test_node_left_queues_its_pieces_fewest_replicas_first(store, scheduler):
+    store.disconnect_node(3)
+    scheduler.node_left("3")
+    assert queued(scheduler) == [(1, (FILE_HASH, "1"))]
+
+    store.disconnect_node(1)
+    scheduler.node_left("1")
+    assert queued(scheduler) == [
+        (0, (FILE_HASH, "2")),
+        (1, (FILE_HASH, "1")),
+        (1, (FILE_HASH, "0")),
+    ]
+
+
+def test_scan_finds_under_replicated_pieces(scheduler):
+    scheduler.scan()
+    assert queued(scheduler) == [(1, (FILE_HASH, "2"))]
+
+
+def test_repair_copies_to_a_node_without_the_piece(store, scheduler):
+    sent = []
+
+    def send(node, request):
+        sent.append((node["port"], request))
+        return {"status": "replicated", "node_ids": list(request["targets"])}
+
+    scheduler.send = send
+    store.disconnect_node(2)
+    scheduler.repair(FILE_HASH, "0")
+    [(port, request)] = sent
+    assert port == 5001
+    assert request["file_hash"] == FILE_HASH
+    assert request["piece_index"] == 0
+    [target] = request["targets"]
+    assert target in ("3", "4")
+    live, _, _ = store.piece_info(FILE_HASH, "0")
+    assert sorted(live) == sorted(["1", target])
+    assert scheduler.repaired == 1
+
+
+def test_failed_repair_is_counted(store, scheduler):
+    scheduler.send = lambda node, request: {"status": "error", "message": "full"}
+    scheduler.repair(FILE_HASH, "2")
+    assert scheduler.failed == 1
+    assert store.piece_info(FILE_HASH, "2")[0] == ["1"]
+
+
+def test_token_bucket_limits_repair_traffic(scheduler):
+    scheduler.rate = 100_000
+    scheduler.tokens = 0
+    scheduler.refilled = time.monotonic()
+    start = time.monotonic()
+    for _ in range(5):
+        scheduler.take(10_000)
+    assert time.monotonic() - start >= 0.4
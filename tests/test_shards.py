@@ -0,0 +1,42 @@
+import asyncio
+import socket
+import time
+
+from shards import shard_index
+from tracker import Tracker
+
+
+def test_shard_index_is_stable_and_spread():
+    names = [f"file{i}" for i in range(1000)]
+    shards = [shard_index(name, 4) for name in names]
+    assert shards == [shard_index(name, 4) for name in names]
+    assert all(shards.count(shard) > 150 for shard in range(4))
+
+
+def test_membership_sync_does_not_block_the_event_loop(tmp_path):
+    # A membership service that accepts connections but never answers
+    silent = socket.create_server(("127.0.0.1", 0))
+    tracker = Tracker("127.0.0.1", 0, str(tmp_path), membership=silent.getsockname())
+    tracker.follower.timeout = 2
+
+    async def main():
+        # Naming an unknown node makes the shard sync with the membership
+        # service, which hangs until the follower's timeout
+        upload = asyncio.ensure_future(
+            tracker.dispatch_async({"command": "announce", "node_id": 5})
+        )
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        stats = await asyncio.wait_for(
+            tracker.dispatch_async({"command": "stats"}), timeout=1
+        )
+        assert stats["status"] == "success"
+        assert time.monotonic() - start < 1
+        assert (await upload)["message"] == "Node ID not found"
+
+    try:
+        asyncio.run(main())
+    finally:
+        tracker.repair.stop()
+        tracker.store.close()
+        silent.close()
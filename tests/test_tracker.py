@@ -0,0 +1,264 @@
+import asyncio
+import time
+from collections import deque
+
+import pytest
+
+from tracker import Tracker
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    tracker = Tracker("127.0.0.1", 0, str(tmp_path))
+    yield tracker
+    tracker.repair.stop()
+    tracker.store.close()
+
+
+def upload(tracker, node_id, file_name="file", file_hash="ab" * 20, pieces=4):
+    return tracker.dispatch(
+        {
+            "command": "upload",
+            "node_id": node_id,
+            "file_name": file_name,
+            "file_hash": file_hash,
+            "magnet_link": f"magnet:?xt=urn:btih:{file_hash}",
+            "total_pieces": pieces,
+            "piece_distribution": {str(i): [node_id] for i in range(pieces)},
+        }
+    )
+
+
+def register(tracker, port=5000, **options):
+    request = {"command": "register", "ip_address": "127.0.0.1", "port": port}
+    return tracker.dispatch(dict(request, **options))["node_id"]
+
+
+def test_slow_metadata_read_does_not_block_the_event_loop(tracker):
+    node_id = register(tracker)
+    assert upload(tracker, node_id)["status"] == "uploaded"
+    tracker.store.flush()
+    tracker.store.metadata.clear()
+    read_metadata = tracker.store.read_metadata
+
+    def slow_read(file_hash):
+        time.sleep(1)
+        return read_metadata(file_hash)
+
+    tracker.store.read_metadata = slow_read
+
+    async def main():
+        download = asyncio.ensure_future(
+            tracker.dispatch_async(
+                {"command": "download", "file_name": "file", "requester_id": node_id}
+            )
+        )
+        start = time.monotonic()
+        await asyncio.sleep(0.1)
+        assert time.monotonic() - start < 0.5
+        assert not download.done()
+        assert (await download)["status"] == "success"
+
+    asyncio.run(main())
+
+
+def test_get_nodes_sends_only_changes(tracker):
+    first = register(tracker, 5001)
+    full = tracker.dispatch({"command": "get_nodes"})
+    assert full["status"] == "success"
+    assert list(full["nodes"]) == [str(first)]
+    since = {"command": "get_nodes", "epoch": full["epoch"], "since": full["version"]}
+
+    assert tracker.dispatch(since)["status"] == "not_modified"
+
+    second = register(tracker, 5002)
+    tracker.dispatch({"command": "disconnect", "node_id": first})
+    delta = tracker.dispatch(since)
+    assert delta["status"] == "delta"
+    assert list(delta["joined"]) == [str(second)]
+    assert delta["left"] == [str(first)]
+    assert delta["version"] == full["version"] + 2
+
+
+def test_get_nodes_from_another_epoch_gets_the_full_list(tracker):
+    register(tracker, 5001)
+    response = tracker.dispatch({"command": "get_nodes", "epoch": "old", "since": 1})
+    assert response["status"] == "success"
+    assert len(response["nodes"]) == 1
+
+
+def test_get_nodes_beyond_the_change_log_gets_the_full_list(tracker):
+    tracker.store.membership_changes = deque(maxlen=2)
+    epoch = tracker.store.membership_epoch
+    for port in range(5001, 5005):
+        register(tracker, port)
+    response = tracker.dispatch({"command": "get_nodes", "epoch": epoch, "since": 1})
+    assert response["status"] == "success"
+    assert len(response["nodes"]) == 4
+    response = tracker.dispatch({"command": "get_nodes", "epoch": epoch, "since": 3})
+    assert response["status"] == "delta"
+
+
+def test_nodes_expire_after_missing_their_heartbeats(tracker, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("tracker_store.time.monotonic", lambda: clock[0])
+    fast = register(tracker, 5001, heartbeat_interval=1)
+    slow = register(tracker, 5002, heartbeat_interval=60)
+    legacy = register(tracker, 5003)
+
+    clock[0] += 5
+    assert tracker.store.expire_nodes() == [str(fast)]
+    clock[0] += 100
+    heartbeat = {"command": "heartbeat", "node_id": slow}
+    assert tracker.dispatch(heartbeat)["status"] == "alive"
+    clock[0] += 100
+    assert tracker.store.expire_nodes() == []
+    clock[0] += 100
+    assert tracker.store.expire_nodes() == [str(slow)]
+    assert list(tracker.store.get_nodes()) == [str(legacy)]
+
+
+def test_expired_node_is_readmitted_with_its_interval(tracker, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("tracker_store.time.monotonic", lambda: clock[0])
+    node_id = register(tracker, 5001, heartbeat_interval=60)
+    clock[0] += 200
+    assert tracker.store.expire_nodes() == [str(node_id)]
+    heartbeat = {
+        "command": "heartbeat",
+        "node_id": node_id,
+        "ip_address": "127.0.0.1",
+        "port": 5001,
+        "heartbeat_interval": 60,
+    }
+    assert tracker.dispatch(heartbeat)["status"] == "alive"
+    clock[0] += 100
+    assert tracker.store.expire_nodes() == []
+    assert tracker.store.has_node(node_id)
+
+
+def test_node_ttl_survives_restart(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("tracker_store.time.monotonic", lambda: clock[0])
+    tracker = Tracker("127.0.0.1", 0, str(tmp_path))
+    node_id = register(tracker, 5001, heartbeat_interval=60)
+    tracker.repair.stop()
+    tracker.store.close()
+
+    tracker = Tracker("127.0.0.1", 0, str(tmp_path))
+    try:
+        clock[0] += 100
+        assert tracker.store.expire_nodes() == []
+        clock[0] += 100
+        assert tracker.store.expire_nodes() == [str(node_id)]
+    finally:
+        tracker.repair.stop()
+        tracker.store.close()
+
+
+@pytest.mark.parametrize("interval", ["10", None, -1, 0, float("nan"), True])
+def test_invalid_heartbeat_interval_is_rejected(tracker, interval):
+    response = tracker.dispatch(
+        {
+            "command": "register",
+            "ip_address": "127.0.0.1",
+            "port": 5000,
+            "heartbeat_interval": interval,
+        }
+    )
+    assert response["status"] == "error"
+    assert tracker.store.get_nodes() == {}
+
+
+def test_find_chunks_reports_stored_chunks(tracker):
+    first = register(tracker, 5001)
+    second = register(tracker, 5002)
+    chunks = ["11" * 20, "22" * 20, "11" * 20]
+    response = tracker.dispatch(
+        {
+            "command": "upload",
+            "node_id": first,
+            "file_name": "file",
+            "file_hash": "ab" * 20,
+            "magnet_link": "magnet:?xt=urn:btih:" + "ab" * 20,
+            "total_pieces": 3,
+            "chunks": chunks,
+            "chunk_sizes": [10, 10, 10],
+            "piece_distribution": {"0": [first], "1": [second], "2": [first]},
+        }
+    )
+    assert response["status"] == "uploaded"
+    found = tracker.dispatch(
+        {"command": "find_chunks", "chunks": ["11" * 20, "22" * 20, "33" * 20]}
+    )["chunks"]
+    assert found == {"11" * 20: [str(first)], "22" * 20: [str(second)]}
+
+    tracker.dispatch({"command": "disconnect", "node_id": second})
+    found = tracker.dispatch({"command": "find_chunks", "chunks": ["22" * 20]})
+    assert found["chunks"] == {}
+
+
+def test_stats_counts_requests_and_reports_the_store(tracker):
+    node_id = register(tracker)
+    upload(tracker, node_id)
+    tracker.dispatch({"command": "no_such_command"})
+    stats = tracker.dispatch({"command": "stats"})["stats"]
+    assert stats["requests_total"] == {
+        "register": 1,
+        "upload": 1,
+        "unknown": 1,
+        "stats": 1,
+    }
+    assert stats["request_seconds"]["upload"]["count"] == 1
+    assert stats["nodes"] == 1
+    assert stats["files"] == 1
+
+
+def test_batch_answers_every_request_in_order(tracker):
+    node_id = register(tracker)
+    response = tracker.dispatch(
+        {
+            "command": "batch",
+            "requests": [
+                {"command": "heartbeat", "node_id": node_id},
+                {"command": "no_such_command"},
+                {"command": "batch", "requests": []},
+                "get_nodes",
+                {"command": "get_nodes"},
+            ],
+        }
+    )
+    assert response["status"] == "success"
+    assert [r["status"] for r in response["responses"]] == [
+        "alive",
+        "error",
+        "error",
+        "error",
+        "success",
+    ]
+    assert list(response["responses"][4]["nodes"]) == [str(node_id)]
+
+    tracker.max_batch = 2
+    response = tracker.dispatch(
+        {"command": "batch", "requests": [{"command": "get_nodes"}] * 3}
+    )
+    assert response["status"] == "error"
+
+
+def test_resolve_includes_the_holders_addresses(tracker):
+    holder = register(tracker, 5001)
+    register(tracker, 5002)
+    upload(tracker, holder)
+    tracker.dispatch(
+        {"command": "heartbeat", "node_id": holder, "load": {"active_transfers": 2}}
+    )
+    response = tracker.dispatch(
+        {"command": "resolve", "file_name": "file", "requester_id": 2}
+    )
+    assert response["status"] == "success"
+    assert response["nodes"] == {str(holder): {"ip_address": "127.0.0.1", "port": 5001}}
+    assert response["loads"] == {str(holder): 2}
+    missing = tracker.dispatch(
+        {"command": "resolve", "file_name": "missing", "requester_id": 2}
+    )
+    assert missing["status"] == "error"
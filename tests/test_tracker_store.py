@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+
+import pytest
+
+from tracker_store import JOURNAL_FILE, TrackerStore
+
+FILE_HASH = "ab" * 20
+
+
+def metadata(file_hash=FILE_HASH, name="file", distribution=None):
+    return {
+        "file_name": name,
+        "file_hash": file_hash,
+        "total_pieces": 2,
+        "piece_distribution": distribution or {"0": ["1"], "1": ["1", "2"]},
+    }
+
+
+@pytest.fixture
+def store(tmp_path):
+    stores = []
+
+    def open_store(**options):
+        store = TrackerStore(str(tmp_path), **options)
+        stores.append(store)
+        return store
+
+    yield open_store
+    for store in stores:
+        if store.running:
+            store.close()
+
+
+def test_state_survives_restart(store, tmp_path):
+    first = store()
+    assert first.register_node("10.0.0.1", 5000) == 1
+    assert first.register_node("10.0.0.2", 5000) == 2
+    first.add_file(metadata())
+    first.add_holder(FILE_HASH, 0, "2")
+    first.disconnect_node(1)
+    first.close()
+
+    second = store()
+    assert second.get_nodes() == {"2": {"ip_address": "10.0.0.2", "port": 5000}}
+    file_hash, restored = second.get_file("file")
+    assert file_hash == FILE_HASH
+    assert restored["piece_distribution"] == {"0": ["1", "2"], "1": ["1", "2"]}
+    # New ids continue after the ones already handed out
+    assert second.register_node("10.0.0.3", 5000) == 3
+
+
+def test_torn_journal_line_is_ignored(store, tmp_path):
+    first = store()
+    first.register_node("10.0.0.1", 5000)
+    first.close()
+    with open(tmp_path / JOURNAL_FILE, "a") as f:
+        f.write('{"op": "register", "node_id": 7, "ip_')
+
+    assert list(store().get_nodes()) == ["1"]
+
+
+def test_journal_is_compacted_into_a_snapshot(store, tmp_path):
+    first = store(snapshot_every=5)
+    for i in range(12):
+        first.register_node("10.0.0.1", 5000 + i)
+    first.close()
+    with open(tmp_path / JOURNAL_FILE) as f:
+        assert len(f.readlines()) < 5
+
+    assert len(store().get_nodes()) == 12
+
+
+def test_legacy_registry_is_migrated(store, tmp_path):
+    (tmp_path / "nodes.json").write_text(
+        json.dumps({"3": {"ip_address": "10.0.0.3", "port": 5000}})
+    )
+    (tmp_path / "files.json").write_text(json.dumps({"file": FILE_HASH}))
+    (tmp_path / f"{FILE_HASH}_metadata.json").write_text(json.dumps(metadata()))
+
+    migrated = store()
+    assert migrated.get_nodes() == {"3": {"ip_address": "10.0.0.3", "port": 5000}}
+    assert migrated.get_file("file")[0] == FILE_HASH
+    assert migrated.file_holders[FILE_HASH] == {"1", "2"}
+    assert migrated.register_node("10.0.0.4", 5000) == 4
+    assert os.path.exists(tmp_path / "snapshot.json")
+
+
+def test_metadata_is_written_in_compact_form(store, tmp_path):
+    first = store()
+    first.add_file(metadata())
+    first.close()
+    with open(tmp_path / f"{FILE_HASH}_metadata.json") as f:
+        stored = json.load(f)
+    assert "piece_distribution" not in stored
+    assert "piece_layout" in stored
+
+
+def test_pieces_held_follows_uploads_and_new_holders(store):
+    first = store()
+    first.add_file(metadata())
+    first.add_holder(FILE_HASH, 0, "3")
+    assert first.pieces_held("1") == [(FILE_HASH, "0"), (FILE_HASH, "1")]
+    assert first.pieces_held(2) == [(FILE_HASH, "1")]
+    assert first.pieces_held("3") == [(FILE_HASH, "0")]
+    assert first.pieces_held("4") == []
+
+
+def test_pieces_held_reads_metadata_without_the_lock(store):
+    first = store()
+    first.add_file(metadata())
+    first.close()
+    second = store()
+    read_metadata = second.read_metadata
+
+    def read_unlocked(file_hash):
+        # Another thread can take the lock while the metadata is read
+        taken = threading.Thread(target=second.get_nodes)
+        taken.start()
+        taken.join(1)
+        assert not taken.is_alive()
+        return read_metadata(file_hash)
+
+    second.read_metadata = read_unlocked
+    assert second.pieces_held("2") == [(FILE_HASH, "1")]
+    second.read_metadata = read_metadata
+    assert second.pieces_held("1") == [(FILE_HASH, "0"), (FILE_HASH, "1")]
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from function import generate_piece_hash
+from uploader import PieceUploader
+
+NODES = {"1": {}, "2": {}, "3": {}}
+
+
+class PieceSink:
+    # Stands in for a node, accepting every piece except those to `refuse`
+    def __init__(self, refuse=()):
+        self.refuse = set(refuse)
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_piece_upload(self, node_id, node, file_hash, index, piece, compressed):
+        with self.lock:
+            self.sent.append((node_id, file_hash, index, piece, compressed))
+        return node_id not in self.refuse
+
+
+def pieces(count=20):
+    return [bytes([i]) * (100 + i) for i in range(count)]
+
+
+def test_upload_hashes_and_places_every_piece(run_in_thread):
+    sink = PieceSink()
+    uploader = PieceUploader(
+        sink,
+        "staging",
+        NODES,
+        lambda index: [str(index % 3 + 1), str((index + 1) % 3 + 1)],
+    )
+    data = pieces()
+    assert run_in_thread(lambda: uploader.run(iter(data))) == [
+        hashlib.sha1(b"".join(data)).hexdigest()
+    ]
+    assert uploader.file_size == sum(map(len, data))
+    assert uploader.data_pieces == len(data)
+    assert uploader.piece_hashes == [generate_piece_hash(p) for p in data]
+    assert len(sink.sent) == 2 * len(data)
+    assert all(staging == "staging" for _, staging, _, _, _ in sink.sent)
+    for index in range(len(data)):
+        assert sorted(uploader.piece_distribution[index]) == sorted(
+            [str(index % 3 + 1), str((index + 1) % 3 + 1)]
+        )
+
+
+def test_refused_pieces_are_not_recorded(run_in_thread):
+    uploader = PieceUploader(
+        PieceSink(refuse={"2"}), "staging", NODES, lambda i: ["1", "2"]
+    )
+    assert len(run_in_thread(lambda: uploader.run(pieces()))) == 1
+    assert all(holders == ["1"] for holders in uploader.piece_distribution.values())
+
+
+def test_upload_buffers_a_bounded_number_of_pieces(run_in_thread):
+    # With a stalled network the producer stops after filling the queue
+    # and one piece per worker, instead of reading the whole file
+    release = threading.Event()
+    read = []
+
+    class StalledSink(PieceSink):
+        def send_piece_upload(self, *args):
+            release.wait()
+            return super().send_piece_upload(*args)
+
+    def produce():
+        for i, piece in enumerate(pieces()):
+            read.append(i)
+            yield piece
+
+    uploader = PieceUploader(
+        StalledSink(), "staging", NODES, lambda i: ["1"], max_workers=2, queue_size=3
+    )
+    thread = threading.Thread(target=uploader.run, args=(produce(),))
+    thread.start()
+    thread.join(0.5)
+    assert len(read) <= 2 + 3 + 1
+    release.set()
+    thread.join(10)
+    assert len(read) == 20
+
+
+def compressor_failing_on_submit(piece):
+    raise BrokenProcessPool("A child process terminated abruptly")
+
+
+def compressor_failing_in_worker(piece):
+    future = Future()
+    future.set_exception(MemoryError("compression worker died"))
+    return future
+
+
+@pytest.mark.parametrize(
+    "compress", [compressor_failing_on_submit, compressor_failing_in_worker]
+)
+def test_failed_compression_sends_pieces_raw(run_in_thread, compress):
+    sink = PieceSink()
+    uploader = PieceUploader(sink, "staging", NODES, lambda i: ["1"], compress=compress)
+    assert len(run_in_thread(lambda: uploader.run(pieces()))) == 1
+    assert sorted((index, compressed) for _, _, index, _, compressed in sink.sent) == [
+        (i, None) for i in range(20)
+    ]
+    assert all(holders == ["1"] for holders in uploader.piece_distribution.values())
@@ -1,25 +1,193 @@
-import os
+import argparse
+import asyncio
 import socket
 import threading
 import json
 import time
 
+from protocol import (
+    MAX_MESSAGE_SIZE,
+    MESSAGE_HEADER,
+    encode_message,
+    is_legacy_message,
+    recv_json,
+    recv_message,
+    send_message,
+)
+from distribution import decode_distribution, encode_distribution
+from metrics import Metrics
+from repair import RepairScheduler
+from shards import MembershipFollower
+from tracker_store import TrackerStore
+
 FORMAT = "utf-8"
 SIZE = 1024 * 1024
-NODES_FILE = "nodes.json"
-FILES_FILE = "files.json"
+
+# Commands served from memory alone, which the asyncio server runs on its
+# event loop; the rest may read file metadata or sync with the membership
+# service, so they run on the default executor
+MEMORY_COMMANDS = frozenset(
+    [
+        "register",
+        "heartbeat",
+        "get_nodes",
+        "get_loads",
+        "get_shards",
+        "find_chunks",
+        "stats",
+    ]
+)
+
+
+async def read_legacy_json(reader, data):
+    # Keep reading until the bytes so far form one JSON document
+    decoder = json.JSONDecoder()
+    buffer = bytearray(data)
+    while True:
+        try:
+            request, _ = decoder.raw_decode(buffer.decode(FORMAT))
+            return request
+        except (ValueError, UnicodeDecodeError):
+            if len(buffer) > MAX_MESSAGE_SIZE:
+                raise
+        chunk = await reader.read(SIZE)
+        if not chunk:
+            return json.loads(buffer.decode(FORMAT))
+        buffer += chunk
 
 
 class Tracker:
-    def __init__(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        directory="tracker",
+        max_connections=20000,
+        backlog=4096,
+        node_ttl=30,
+        heartbeat_misses=3,
+        replication_factor=2,
+        metrics_file=None,
+        metrics_interval=10,
+        membership=None,
+        shards=None,
+    ):
         self.host = host
         self.port = port
-        self.nodes = {}
-        self.node_counter = 0
+        # Heartbeating nodes expire after missing `heartbeat_misses` of the
+        # heartbeats they announced; `node_ttl` applies to nodes registered
+        # before intervals were recorded
+        self.heartbeat_misses = heartbeat_misses
+        self.store = TrackerStore(directory, node_ttl=node_ttl)
+        # Re-replicates pieces whose holders left or expired
+        self.repair = RepairScheduler(self.store, replication_factor)
         self.running = True
+        # In a sharded deployment (see shards.py) the membership service
+        # lists the file shards, (host, port) in shard order, for nodes to
+        # route by; a file shard mirrors the nodes of the membership
+        # service at `membership` instead of registering them itself.
+        self.shards = [
+            {"ip_address": shard_host, "port": shard_port}
+            for shard_host, shard_port in shards or []
+        ]
+        self.follower = None
+        if membership is not None:
+            self.follower = MembershipFollower(
+                self.store, tuple(membership), self.node_left
+            )
+        self.handlers = {
+            "register": self.register_node,
+            "upload": self.upload_node,
+            "download": self.download_node,
+            "disconnect": self.disconnect_node,
+            "get_nodes": self.get_nodes,
+            "heartbeat": self.heartbeat,
+            "get_loads": self.get_loads,
+            "find_chunks": self.find_chunks,
+            "announce": self.announce,
+            "get_holders": self.get_holders,
+            "stats": self.stats,
+            "resolve": self.resolve,
+            "batch": self.batch,
+            "get_shards": self.get_shards,
+        }
+        # Most sub-requests one batch request may carry
+        self.max_batch = 1000
+        # Limits for the asyncio server
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        # Served by the stats command, and dumped in Prometheus text format
+        # to `metrics_file` every `metrics_interval` seconds if set
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics = Metrics("tracker")
+        self.requests = self.metrics.counter(
+            "requests_total", "Requests served", "command"
+        )
+        self.request_seconds = self.metrics.histogram(
+            "request_seconds", "Request handling time", "command"
+        )
+        self.metrics.gauge(
+            "connections", "Open client connections", lambda: self.connections
+        )
+        self.metrics.gauge("nodes", "Registered nodes", lambda: len(self.store.nodes))
+        self.metrics.gauge("files", "Known files", lambda: len(self.store.files))
+        self.metrics.gauge(
+            "metadata_cache",
+            "File metadata cache",
+            self.store.metadata_stats,
+            "stat",
+        )
+        self.metrics.gauge(
+            "repair",
+            "Repair scheduler counters",
+            lambda: {
+                "queued": len(self.repair.queue),
+                "repaired": self.repair.repaired,
+                "failed": self.repair.failed,
+            },
+            "stat",
+        )
+
+    def expire_loop(self):
+        # Drop nodes that stopped sending heartbeats
+        while self.running:
+            time.sleep(1)
+            for node_id in self.store.expire_nodes():
+                print(f"\033[1;31mNode {node_id} expired\033[0m")
+                self.repair.node_left(node_id)
+
+    def node_left(self, node_id):
+        # A mirrored node left the membership service
+        print(f"\033[1;31mNode {node_id} left\033[0m")
+        self.repair.node_left(node_id)
+
+    def known_node(self, node_id):
+        # Whether a node is registered. A file shard syncs first if the node
+        # is not mirrored yet, since it may have joined since the last sync.
+        if self.store.has_node(node_id):
+            return True
+        return (
+            self.follower is not None
+            and self.follower.refresh()
+            and self.store.has_node(node_id)
+        )
+
+    def start_background(self):
+        threading.Thread(target=self.expire_loop, daemon=True).start()
+        self.repair.start()
+        if self.follower is not None:
+            self.follower.start()
+        if self.metrics_file:
+            self.metrics.start_dump(
+                self.metrics_file, self.metrics_interval, lambda: self.running
+            )
 
     def start(self):
         # Start the tracker server to listen for incoming connections
+        self.start_background()
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind((self.host, self.port))
             s.listen()
@@ -35,188 +203,410 @@ class Tracker:
                 except Exception as e:
                     print(f"Error accepting connection: {e}")
 
+    async def serve_async(self):
+        # Serve the same commands from one asyncio event loop
+        self.connections = 0
+        server = await asyncio.start_server(
+            self.handle_async_client, self.host, self.port, backlog=self.backlog
+        )
+        print(
+            f"\033[1;32mTracker (asyncio) listening on [{self.host}:{self.port}]\033[0m"
+        )
+        async with server:
+            while self.running:
+                await asyncio.sleep(1)
+
+    def start_async(self):
+        # Start the asyncio tracker server, blocking until it stops
+        self.start_background()
+        asyncio.run(self.serve_async())
+
+    async def handle_async_client(self, reader, writer):
+        # Serve framed requests on one connection until the client closes it
+        if self.connections >= self.max_connections:
+            writer.write(
+                encode_message({"status": "error", "message": "Too many connections"})
+            )
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                prefix = await reader.read(MESSAGE_HEADER.size)
+                if not prefix:
+                    break
+                if prefix.startswith(b"{"):
+                    # Legacy client: one bare JSON request, bare JSON reply
+                    request = await read_legacy_json(reader, prefix)
+                    response = await self.dispatch_async(request)
+                    writer.write(json.dumps(response).encode(FORMAT))
+                    await writer.drain()
+                    break
+                if len(prefix) < MESSAGE_HEADER.size:
+                    prefix += await reader.readexactly(
+                        MESSAGE_HEADER.size - len(prefix)
+                    )
+                (length,) = MESSAGE_HEADER.unpack(prefix)
+                if length > MAX_MESSAGE_SIZE:
+                    writer.write(
+                        encode_message(
+                            {"status": "error", "message": "Message too large"}
+                        )
+                    )
+                    break
+                request = json.loads(await reader.readexactly(length))
+                writer.write(encode_message(await self.dispatch_async(request)))
+                # Stop reading from clients that are not reading their replies
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"Error handling request: {e}")
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def dispatch_async(self, request):
+        # Run a command without blocking the event loop on disk or network
+        if request.get("command") in MEMORY_COMMANDS:
+            return self.dispatch(request)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.dispatch, request)
+
     def handle_request(self, client_socket):
         # Handle incoming requests from nodes
+        with self.connections_lock:
+            self.connections += 1
         try:
-            data = client_socket.recv(SIZE).decode(FORMAT)
-            if not data:
-                print("Received empty data. Closing connection.")
+            if is_legacy_message(client_socket):
+                request = recv_json(client_socket)
+                if not request:
+                    print("Received empty data. Closing connection.")
+                    return
+                response = self.dispatch(request)
+                client_socket.sendall(json.dumps(response).encode(FORMAT))
                 return
 
-            request = json.loads(data)
-            command = request.get("command")
-            if command != "get_nodes":
-                print(f"\033[1;33mReceived command: {command}\033[0m")
-
-            if command == "register":
-                self.register_node(request, client_socket)
-            elif command == "upload":
-                self.upload_node(request, client_socket)
-            elif command == "download":
-                self.download_node(request, client_socket)
-            elif command == "disconnect":
-                self.disconnect_node(request, client_socket)
-            elif command == "get_nodes":
-                self.get_nodes(request, client_socket)
-            else:
-                response = {"error": "Unknown command"}
-                client_socket.send(json.dumps(response).encode(FORMAT))
+            while self.running:
+                request = recv_message(client_socket)
+                if request is None:
+                    return
+                send_message(client_socket, self.dispatch(request))
         except Exception as e:
             print(f"Error handling request: {e}")
-
-    def load_json(self, path):
-        # Load JSON data from a file
-        if os.path.exists(path):
-            with open(path, "r") as f:
-                return json.load(f)
-        return {}
-
-    def save_json(self, path, data):
-        # Save JSON data to a file
-        with open(path, "w") as f:
-            json.dump(data, f)
-
-    def register_node(self, request, client_socket):
+        finally:
+            with self.connections_lock:
+                self.connections -= 1
+            client_socket.close()
+
+    def dispatch(self, request):
+        # Run one command and return its response, recording how long it took
+        command = request.get("command")
+        if command not in (
+            "get_nodes",
+            "heartbeat",
+            "stats",
+            "announce",
+            "get_holders",
+        ):
+            print(f"\033[1;33mReceived command: {command}\033[0m")
+        handler = self.handlers.get(command)
+        if handler is None:
+            self.requests.inc("unknown")
+            return {"status": "error", "message": "Unknown command"}
+        self.requests.inc(command)
+        with self.request_seconds.time(command):
+            return handler(request)
+
+    def register_node(self, request):
         # Register a new node with the tracker
-        self.node_counter += 1
-        node_id = self.node_counter
-
-        self.nodes[node_id] = {
-            "ip_address": request["ip_address"],
-            "port": request["port"],
-        }
-
-        tracker_directory = "tracker"
-        os.makedirs(tracker_directory, exist_ok=True)
-
-        node_registry_path = os.path.join(tracker_directory, NODES_FILE)
-        node_registry = self.load_json(node_registry_path)
-
-        node_registry[node_id] = {
-            "ip_address": request["ip_address"],
-            "port": request["port"],
-        }
-
-        self.save_json(node_registry_path, node_registry)
+        # Nodes that announce a heartbeat interval are expired when they
+        # stop sending heartbeats; older nodes stay until they disconnect
+        try:
+            ttl = self.heartbeat_ttl(request)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        node_id = self.store.register_node(request["ip_address"], request["port"], ttl)
 
         response = {"status": "registered", "node_id": node_id}
+        if self.shards:
+            response["shards"] = self.shards
         print(f"Registered node {node_id}")
-        client_socket.send(json.dumps(response).encode(FORMAT))
+        return response
 
-    def upload_node(self, request, client_socket):
+    def upload_node(self, request):
         # Handle file upload from a node
         node_id = request["node_id"]
         file_name = request["file_name"]
         file_hash = request["file_hash"]
         magnet_link = request["magnet_link"]
         total_pieces = request["total_pieces"]
-        piece_distribution = request["piece_distribution"]
+        # Nodes send the compact layout; older ones the full distribution
+        if "piece_layout" in request:
+            piece_distribution = decode_distribution(request["piece_layout"])
+        else:
+            piece_distribution = request["piece_distribution"]
 
-        if node_id not in self.nodes:
+        if not self.known_node(node_id):
             response = {"status": "error", "message": "Node ID not found"}
-            client_socket.send(json.dumps(response).encode(FORMAT))
-            return
-
-        tracker_directory = "tracker"
-        os.makedirs(tracker_directory, exist_ok=True)
-
-        file_registry_path = os.path.join(tracker_directory, FILES_FILE)
-        file_registry = self.load_json(file_registry_path)
-        file_registry[file_name] = file_hash
-        self.save_json(file_registry_path, file_registry)
+            return response
 
         metadata = {
             "file_name": file_name,
             "file_hash": file_hash,
             "magnet_link": magnet_link,
             "total_pieces": total_pieces,
+            "file_size": request.get("file_size"),
+            "piece_hashes": request.get("piece_hashes"),
+            "replication_factor": request.get("replication_factor"),
+            "erasure": request.get("erasure"),
+            "chunks": request.get("chunks"),
+            "chunk_sizes": request.get("chunk_sizes"),
             "node_id": node_id,
             "piece_distribution": piece_distribution,
         }
-        metadata_file_path = os.path.join(
-            tracker_directory, f"{file_hash}_metadata.json"
-        )
-        self.save_json(metadata_file_path, metadata)
+        self.store.add_file(metadata)
 
         response = {"status": "uploaded"}
         print(f"Node {node_id} uploaded file {file_name}")
-        client_socket.send(json.dumps(response).encode(FORMAT))
+        return response
 
-    def download_node(self, request, client_socket):
+    def download_node(self, request):
         # Handle file download request from a node
-        file_name = request["file_name"]
-        file_registry_path = os.path.join("tracker", FILES_FILE)
-
-        if not os.path.exists(file_registry_path):
-            response = {"status": "error", "message": "File registry not found"}
-            client_socket.send(json.dumps(response).encode(FORMAT))
-            return
+        response, _ = self.describe_file(request)
+        return response
 
-        file_registry = self.load_json(file_registry_path)
-
-        file_hash = file_registry.get(file_name)
+    def describe_file(self, request):
+        # The download response for a file and its live piece distribution
+        file_name = request["file_name"]
+        file_hash, metadata = self.store.get_file(file_name)
         if not file_hash:
             response = {"status": "error", "message": "File hash not found"}
-            client_socket.send(json.dumps(response).encode(FORMAT))
-            return
+            return response, None
 
-        metadata_file_path = os.path.join("tracker", f"{file_hash}_metadata.json")
-        metadata = self.load_json(metadata_file_path)
         if not metadata:
             response = {"status": "error", "message": "Metadata file not found"}
-            client_socket.send(json.dumps(response).encode(FORMAT))
-            return
+            return response, None
 
         response = {
             "status": "success",
             "file_hash": file_hash,
             "magnet_link": metadata["magnet_link"],
             "total_pieces": metadata["total_pieces"],
-            "piece_distribution": metadata["piece_distribution"],
+            "file_size": metadata.get("file_size"),
+            "piece_hashes": metadata.get("piece_hashes"),
+            "erasure": metadata.get("erasure"),
+            "chunks": metadata.get("chunks"),
+            "chunk_sizes": metadata.get("chunk_sizes"),
         }
+        distribution = self.store.live_distribution(metadata)
+        self.add_distribution(response, request, distribution)
         requester_id = request["requester_id"]
         print(f"Node {requester_id} downloaded file {file_name}")
 
-        client_socket.send(json.dumps(response).encode(FORMAT))
+        return response, distribution
 
-    def disconnect_node(self, request, client_socket):
+    def disconnect_node(self, request):
         # Handle node disconnection
         node_id = request["node_id"]
-        if node_id in self.nodes:
-            del self.nodes[node_id]
+        if self.store.disconnect_node(node_id):
             print(f"\033[1;31mNode {node_id} disconnected\033[0m")
+            self.repair.node_left(node_id)
 
-            tracker_directory = "tracker"
-            node_registry_path = os.path.join(tracker_directory, NODES_FILE)
-            node_registry = self.load_json(node_registry_path)
+        response = {"status": "disconnected"}
+        return response
 
-            if str(node_id) in node_registry:
-                del node_registry[str(node_id)]
-                self.save_json(node_registry_path, node_registry)
+    def heartbeat(self, request):
+        # Keep a node alive and record its load report. A node that already
+        # expired is re-admitted under its old id so the pieces it holds
+        # count again.
+        node_id = request["node_id"]
+        if not self.store.heartbeat(node_id, request.get("load")):
+            if "ip_address" not in request:
+                return {"status": "error", "message": "Node ID not found"}
+            try:
+                ttl = self.heartbeat_ttl(request) or self.store.node_ttl
+            except ValueError as e:
+                return {"status": "error", "message": str(e)}
+            self.store.register_node(
+                request["ip_address"], request["port"], ttl, node_id=node_id
+            )
+            self.store.heartbeat(node_id, request.get("load"))
+            print(f"Node {node_id} rejoined")
+        return {"status": "alive"}
+
+    def heartbeat_ttl(self, request):
+        # Seconds a node may go without a heartbeat, or None if it did not
+        # announce an interval. Raises ValueError for an invalid interval.
+        if "heartbeat_interval" not in request:
+            return None
+        interval = request["heartbeat_interval"]
+        if (
+            isinstance(interval, bool)
+            or not isinstance(interval, (int, float))
+            or not 0 < interval < float("inf")
+        ):
+            raise ValueError(f"Invalid heartbeat interval: {interval!r}")
+        return self.heartbeat_misses * interval
+
+    def get_loads(self, request):
+        # Provide the latest load report of every heartbeating node
+        return {"status": "success", "loads": self.store.get_loads()}
+
+    def announce(self, request):
+        # Record pieces a downloading node now stores and serves
+        node_id = str(request["node_id"])
+        if not self.known_node(node_id):
+            return {"status": "error", "message": "Node ID not found"}
+        if not self.store.add_holders(request["file_hash"], request["pieces"], node_id):
+            return {"status": "error", "message": "File hash not found"}
+        return {"status": "success"}
+
+    def get_holders(self, request):
+        # Provide the current live holders of every piece of a file
+        metadata = self.store.get_metadata(request["file_hash"])
+        if not metadata:
+            return {"status": "error", "message": "File hash not found"}
+        response = {"status": "success"}
+        self.add_distribution(response, request, self.store.live_distribution(metadata))
+        return response
+
+    def add_distribution(self, response, request, distribution):
+        # The live holders of every piece, as a compact layout for nodes
+        # that ask for one
+        if request.get("compact"):
+            response["piece_layout"] = encode_distribution(distribution)
+        else:
+            response["piece_distribution"] = distribution
+
+    def resolve(self, request):
+        # A download's file metadata plus the address and load of every live
+        # holder, so the downloader needs no separate get_nodes or get_loads
+        response, distribution = self.describe_file(request)
+        if response["status"] != "success":
+            return response
+        holders = {str(n) for ids in distribution.values() for n in ids}
+        nodes = self.store.get_nodes()
+        loads = self.store.get_loads()
+        response["nodes"] = {n: nodes[n] for n in holders if n in nodes}
+        response["loads"] = {
+            n: loads.get(n, {}).get("active_transfers", 0) for n in response["nodes"]
+        }
+        return response
+
+    def batch(self, request):
+        # Run several commands in one round trip and return their responses
+        # in order. A failing command does not affect the others.
+        requests = request.get("requests")
+        if not isinstance(requests, list):
+            return {"status": "error", "message": "Batch needs a list of requests"}
+        if len(requests) > self.max_batch:
+            return {
+                "status": "error",
+                "message": f"Batch of {len(requests)} exceeds {self.max_batch}",
+            }
+        responses = []
+        for sub_request in requests:
+            if not isinstance(sub_request, dict) or sub_request.get("command") in (
+                None,
+                "batch",
+            ):
+                responses.append({"status": "error", "message": "Invalid request"})
+                continue
+            try:
+                responses.append(self.dispatch(sub_request))
+            except Exception as e:
+                responses.append({"status": "error", "message": str(e)})
+        return {"status": "success", "responses": responses}
+
+    def get_shards(self, request):
+        # Provide the file shards of a sharded deployment, in shard order;
+        # empty when this tracker holds every file itself
+        return {"status": "success", "shards": self.shards}
+
+    def stats(self, request):
+        # Report request counts and latencies, connections and registry size
+        return {"status": "success", "stats": self.metrics.snapshot()}
+
+    def find_chunks(self, request):
+        # Tell an uploading node which of its chunks are already stored, and
+        # where, so it only sends the new ones
+        return {
+            "status": "success",
+            "chunks": self.store.find_chunks(request["chunks"]),
+        }
+
+    def get_nodes(self, request):
+        # Provide the list of active nodes, or only the joins and leaves since
+        # the membership version the node last saw
+        epoch = self.store.membership_epoch
+        changes = self.store.get_nodes_since(request.get("epoch"), request.get("since"))
+        if changes is None:
+            with self.store.lock:
+                nodes = self.store.get_nodes()
+                version = self.store.membership_version
+            return {
+                "status": "success",
+                "nodes": nodes,
+                "epoch": epoch,
+                "version": version,
+            }
+
+        joined, left, version = changes
+        if not joined and not left:
+            return {"status": "not_modified", "epoch": epoch, "version": version}
+        return {
+            "status": "delta",
+            "epoch": epoch,
+            "version": version,
+            "joined": joined,
+            "left": left,
+        }
 
-        response = {"status": "disconnected"}
-        client_socket.send(json.dumps(response).encode(FORMAT))
 
-    def get_nodes(self, request, client_socket):
-        # Provide the list of active nodes
-        node_registry_path = os.path.join("tracker", NODES_FILE)
-        node_registry = self.load_json(node_registry_path)
-        response = {"status": "success", "nodes": node_registry}
-        client_socket.send(json.dumps(response).encode(FORMAT))
+def parse_address(value):
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
 
 
 if __name__ == "__main__":
-    # print("192.168.2.5")
-    # ip_address = input("Enter tracker ip address: ")
-    # port = int(input("Enter tracker port: "))
-    tracker = Tracker("192.168.2.5", 4000)
+    parser = argparse.ArgumentParser(description="Run the tracker")
+    parser.add_argument("--host", default="192.168.2.5")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--directory", default="tracker")
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--metrics-file", help="dump Prometheus metrics here")
+    parser.add_argument(
+        "--membership",
+        type=parse_address,
+        help="run as a file shard of the membership service at host:port",
+    )
+    parser.add_argument(
+        "--shards",
+        type=lambda value: [parse_address(a) for a in value.split(",")],
+        help="run as the membership service of these host:port file shards",
+    )
+    args = parser.parse_args()
+    tracker = Tracker(
+        args.host,
+        args.port,
+        args.directory,
+        metrics_file=args.metrics_file,
+        membership=args.membership,
+        shards=args.shards,
+    )
 
     print("\033[1;31mPRESS ENTER TO TERMINATE!\033[0m")
-    threading.Thread(target=tracker.start).start()
+    if args.use_async:
+        threading.Thread(target=tracker.start_async).start()
+    else:
+        threading.Thread(target=tracker.start).start()
     time.sleep(1)
     while True:
         command = input("")
         if command == "":
             print("Exiting...")
             tracker.running = False
+            tracker.repair.stop()
+            tracker.store.close()
             break
@@ -0,0 +1,663 @@
+import heapq
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from distribution import decode_distribution, encode_distribution
+
+NODES_FILE = "nodes.json"
+FILES_FILE = "files.json"
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_FILE = "journal.log"
+
+
+def load_json(path):
+    # Load JSON data from a file
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_json(path, data):
+    # Save JSON data atomically so a crash never leaves a torn file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class TrackerStore:
+    def __init__(
+        self,
+        directory="tracker",
+        snapshot_every=1000,
+        flush_interval=0.05,
+        node_ttl=30,
+        metadata_cache_size=256,
+    ):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+
+        # All lookups are served from these indexes, guarded by `lock`
+        self.lock = threading.RLock()
+        self.nodes = {}
+        self.files = {}
+        # File metadata is read from {hash}_metadata.json on first use and
+        # kept in an LRU cache of `metadata_cache_size` files. Files with
+        # changes not yet written are never evicted.
+        self.metadata = OrderedDict()
+        self.metadata_cache_size = metadata_cache_size
+        self.metadata_hits = 0
+        self.metadata_misses = 0
+        # file_hash -> {node_id} of every node holding any of its pieces,
+        # journaled so it is known without reading the metadata
+        self.file_holders = {}
+        # node_id -> {file_hash: {piece_index}} of the pieces each node
+        # holds, for pieces_held(). A file is indexed when its metadata is
+        # first loaded or added, and kept in step with it from then on.
+        self.node_pieces = {}
+        self.indexed_files = set()
+        # Hashes of files stored as deduplicated chunks
+        self.chunked = set()
+        # Content-addressed chunks of deduplicated files:
+        # chunk_hash -> {"holders": {node_id}, "files": {file_hash}}, where
+        # the number of files is the chunk's reference count
+        self.chunks = {}
+        self.node_counter = 0
+
+        # Membership version, bumped on every join and leave. The epoch
+        # changes on every start, so versions from an earlier run are
+        # never mistaken for current ones.
+        self.membership_epoch = uuid.uuid4().hex
+        self.membership_version = 0
+        self.membership_changes = deque(maxlen=10000)
+
+        # Liveness of heartbeating nodes: each has a deadline, and a heap of
+        # (deadline, node_id) yields the next one due without scanning the
+        # registry. Superseded heap entries are skipped when popped. Nodes
+        # that registered without heartbeats never expire. Each node has its
+        # own TTL, from the heartbeat interval it announced; `node_ttl` is
+        # for nodes journaled before TTLs were.
+        self.node_ttl = node_ttl
+        self.ttls = {}
+        self.deadlines = {}
+        self.deadline_heap = []
+        self.loads = {}
+
+        # Write-behind queue drained by the flusher thread
+        self.pending = []
+        # file_hash -> metadata awaiting a (re)write
+        self.pending_metadata = {}
+        self.flush_condition = threading.Condition(self.lock)
+        self.journal_entries = 0
+        self.running = True
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+        self.journal = open(self.journal_path, "a")
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def load(self):
+        # Rebuild state from the snapshot and journal, or migrate the old
+        # nodes.json/files.json registry the first time
+        if os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path):
+            snapshot = load_json(self.snapshot_path)
+            self.nodes = snapshot.get("nodes", {})
+            self.files = snapshot.get("files", {})
+            self.node_counter = snapshot.get("node_counter", 0)
+            self.file_holders = {
+                file_hash: set(holders)
+                for file_hash, holders in snapshot.get("holders", {}).items()
+            }
+            self.chunked = set(snapshot.get("chunked", []))
+            self.ttls = snapshot.get("ttls", {})
+            # Restored nodes get a full TTL to send their next heartbeat
+            for node_id in snapshot.get("expiring", []):
+                self.touch(node_id)
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, "r") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # A torn final line from a crash mid-append
+                            break
+                        self.apply(entry)
+                        self.journal_entries += 1
+        else:
+            self.migrate()
+
+        # Files recorded before holders were journaled are indexed from their
+        # metadata once, and a snapshot keeps the result
+        unindexed = [
+            file_hash
+            for file_hash in set(self.files.values())
+            if file_hash not in self.file_holders
+        ]
+        for file_hash in unindexed:
+            metadata = self.load_metadata(file_hash)
+            if metadata:
+                self.index_holdings(metadata)
+                if metadata.get("chunks"):
+                    self.chunked.add(file_hash)
+        if unindexed:
+            self.write_snapshot(self.snapshot_state())
+            open(self.journal_path, "w").close()
+            self.journal_entries = 0
+        # The chunk index needs the chunk lists of deduplicated files
+        for file_hash in self.chunked:
+            metadata = self.load_metadata(file_hash)
+            if metadata:
+                self.index_chunks(metadata)
+
+    def migrate(self):
+        # Import the registry files written by older trackers
+        nodes = load_json(os.path.join(self.directory, NODES_FILE))
+        files = load_json(os.path.join(self.directory, FILES_FILE))
+        if not nodes and not files:
+            return
+        self.nodes = {str(node_id): info for node_id, info in nodes.items()}
+        self.files = dict(files)
+        self.node_counter = max((int(n) for n in self.nodes), default=0)
+        self.write_snapshot(self.snapshot_state())
+        print(
+            f"Migrated {len(self.nodes)} nodes and {len(self.files)} files "
+            f"from {NODES_FILE}/{FILES_FILE}"
+        )
+
+    def index_holdings(self, metadata):
+        holders = self.file_holders.setdefault(metadata["file_hash"], set())
+        for piece_holders in metadata["piece_distribution"].values():
+            holders.update(str(node_id) for node_id in piece_holders)
+
+    def index_pieces(self, metadata):
+        # Replace a file's entries in the node -> pieces index
+        file_hash = metadata["file_hash"]
+        if file_hash in self.indexed_files:
+            for node_id in self.file_holders.get(file_hash, ()):
+                self.node_pieces.get(node_id, {}).pop(file_hash, None)
+        self.indexed_files.add(file_hash)
+        for piece_index, holders in metadata["piece_distribution"].items():
+            for node_id in holders:
+                self.index_piece(file_hash, piece_index, node_id)
+
+    def index_piece(self, file_hash, piece_index, node_id):
+        pieces = self.node_pieces.setdefault(str(node_id), {})
+        pieces.setdefault(file_hash, set()).add(str(piece_index))
+
+    def index_chunks(self, metadata):
+        chunks = metadata.get("chunks")
+        if not chunks:
+            return
+        for piece_index, chunk_hash in enumerate(chunks):
+            chunk = self.chunks.setdefault(
+                chunk_hash, {"holders": set(), "files": set()}
+            )
+            chunk["files"].add(metadata["file_hash"])
+            chunk["holders"].update(
+                str(n) for n in metadata["piece_distribution"].get(str(piece_index), [])
+            )
+
+    def metadata_path(self, file_hash):
+        return os.path.join(self.directory, f"{file_hash}_metadata.json")
+
+    def read_metadata(self, file_hash):
+        # Metadata as stored, with its compact piece layout expanded; files
+        # written by older trackers hold the distribution itself
+        metadata = load_json(self.metadata_path(file_hash))
+        if "piece_layout" in metadata:
+            metadata["piece_distribution"] = decode_distribution(
+                metadata.pop("piece_layout")
+            )
+        return metadata
+
+    def load_metadata(self, file_hash):
+        # A file's metadata from the cache or its file, or None if unknown.
+        # Called with the lock held.
+        metadata = self.metadata.get(file_hash)
+        if metadata is not None:
+            self.metadata.move_to_end(file_hash)
+            self.metadata_hits += 1
+            return metadata
+        if file_hash is None:
+            return None
+        self.metadata_misses += 1
+        metadata = self.read_metadata(file_hash)
+        if not metadata:
+            return None
+        if file_hash not in self.indexed_files:
+            self.index_pieces(metadata)
+        self.cache_metadata(metadata)
+        return metadata
+
+    def cache_metadata(self, metadata):
+        self.metadata[metadata["file_hash"]] = metadata
+        self.metadata.move_to_end(metadata["file_hash"])
+        if len(self.metadata) <= self.metadata_cache_size:
+            return
+        for file_hash in list(self.metadata):
+            if file_hash not in self.pending_metadata:
+                del self.metadata[file_hash]
+                if len(self.metadata) <= self.metadata_cache_size:
+                    return
+
+    def metadata_stats(self):
+        with self.lock:
+            return {
+                "cached": len(self.metadata),
+                "hits": self.metadata_hits,
+                "misses": self.metadata_misses,
+            }
+
+    def apply(self, entry):
+        # Apply one journal entry to the in-memory state. Entries are
+        # idempotent so replaying over a newer snapshot is harmless.
+        op = entry["op"]
+        if op == "register":
+            node_id = str(entry["node_id"])
+            self.nodes[node_id] = {
+                "ip_address": entry["ip_address"],
+                "port": entry["port"],
+            }
+            self.node_counter = max(self.node_counter, int(node_id))
+            ttl = entry.get("ttl") or (self.node_ttl if entry.get("expires") else None)
+            if ttl:
+                self.ttls[node_id] = ttl
+                self.touch(node_id)
+            self.membership_changed(node_id, self.nodes[node_id])
+        elif op == "disconnect":
+            node_id = str(entry["node_id"])
+            self.deadlines.pop(node_id, None)
+            self.ttls.pop(node_id, None)
+            self.loads.pop(node_id, None)
+            if self.nodes.pop(node_id, None) is not None:
+                self.membership_changed(node_id, None)
+        elif op == "upload":
+            self.files[entry["file_name"]] = entry["file_hash"]
+            if "holders" in entry:
+                self.file_holders.setdefault(entry["file_hash"], set()).update(
+                    entry["holders"]
+                )
+            if entry.get("chunked"):
+                self.chunked.add(entry["file_hash"])
+        elif op == "hold":
+            self.file_holders.setdefault(entry["file_hash"], set()).add(
+                entry["node_id"]
+            )
+
+    def membership_changed(self, node_id, info):
+        # Log a join (info) or leave (None) under a new membership version
+        self.membership_version += 1
+        self.membership_changes.append((self.membership_version, node_id, info))
+
+    def record(self, entry):
+        # Apply an entry now and queue it for the journal
+        with self.lock:
+            self.apply(entry)
+            self.pending.append(entry)
+            self.flush_condition.notify()
+
+    def register_node(self, ip_address, port, ttl=None, node_id=None):
+        # Register a node under a new id, or re-admit one under its old id.
+        # A node with a `ttl` expires after that many seconds without a
+        # heartbeat.
+        with self.lock:
+            if node_id is None:
+                node_id = self.node_counter + 1
+            entry = {
+                "op": "register",
+                "node_id": node_id,
+                "ip_address": ip_address,
+                "port": port,
+            }
+            if ttl:
+                entry["ttl"] = ttl
+            self.record(entry)
+            return node_id
+
+    def touch(self, node_id):
+        # Push a node's expiry deadline one TTL into the future
+        deadline = time.monotonic() + self.ttls.get(node_id, self.node_ttl)
+        self.deadlines[node_id] = deadline
+        heapq.heappush(self.deadline_heap, (deadline, node_id))
+
+    def heartbeat(self, node_id, load=None):
+        # Record that a node is alive, returning False if it is not
+        # registered (it expired or the tracker lost it)
+        node_id = str(node_id)
+        with self.lock:
+            if node_id not in self.nodes:
+                return False
+            self.touch(node_id)
+            if load is not None:
+                self.loads[node_id] = load
+            return True
+
+    def expire_nodes(self):
+        # Remove every node whose deadline has passed and return their ids
+        expired = []
+        now = time.monotonic()
+        with self.lock:
+            while self.deadline_heap and self.deadline_heap[0][0] <= now:
+                deadline, node_id = heapq.heappop(self.deadline_heap)
+                if self.deadlines.get(node_id) != deadline:
+                    continue
+                self.record({"op": "disconnect", "node_id": node_id})
+                expired.append(node_id)
+        return expired
+
+    def get_loads(self):
+        with self.lock:
+            return dict(self.loads)
+
+    def set_loads(self, loads):
+        with self.lock:
+            self.loads = dict(loads)
+
+    def mirror_nodes(self, nodes):
+        # Replace the registry with one kept by a membership service and
+        # return the ids of the nodes that left. Mirrored nodes are not
+        # journaled or expired here: the membership service owns them.
+        nodes = {str(node_id): info for node_id, info in nodes.items()}
+        with self.lock:
+            left = [node_id for node_id in self.nodes if node_id not in nodes]
+            for node_id in left:
+                self.deadlines.pop(node_id, None)
+                self.ttls.pop(node_id, None)
+                self.membership_changed(node_id, None)
+            for node_id, info in nodes.items():
+                if self.nodes.get(node_id) != info:
+                    self.membership_changed(node_id, info)
+            self.nodes = nodes
+            self.node_counter = max(
+                [self.node_counter] + [int(node_id) for node_id in nodes]
+            )
+            return left
+
+    def disconnect_node(self, node_id):
+        # Remove a node, returning whether it was registered
+        with self.lock:
+            if str(node_id) not in self.nodes:
+                return False
+            self.record({"op": "disconnect", "node_id": str(node_id)})
+            return True
+
+    def add_file(self, metadata):
+        with self.lock:
+            # The metadata file must be on disk before the journal entry
+            # that references it
+            self.pending_metadata[metadata["file_hash"]] = metadata
+            self.cache_metadata(metadata)
+            self.index_pieces(metadata)
+            self.index_chunks(metadata)
+            holders = {
+                str(node_id)
+                for piece_holders in metadata["piece_distribution"].values()
+                for node_id in piece_holders
+            }
+            entry = {
+                "op": "upload",
+                "file_name": metadata["file_name"],
+                "file_hash": metadata["file_hash"],
+                "holders": sorted(holders),
+            }
+            if metadata.get("chunks"):
+                entry["chunked"] = True
+            self.record(entry)
+
+    def has_node(self, node_id):
+        with self.lock:
+            return str(node_id) in self.nodes
+
+    def get_nodes(self):
+        with self.lock:
+            return dict(self.nodes)
+
+    def get_nodes_since(self, epoch, version):
+        # Return the membership changes after `version` as
+        # (joined, left, current version), or None if they are no longer
+        # in the change log and the caller needs the full list
+        with self.lock:
+            current = self.membership_version
+            if epoch != self.membership_epoch or version is None or version > current:
+                return None
+            if version == current:
+                return {}, [], current
+            oldest = self.membership_changes[0][0] if self.membership_changes else 1
+            if version + 1 < oldest:
+                return None
+            joined = {}
+            left = []
+            for change_version, node_id, info in self.membership_changes:
+                if change_version <= version:
+                    continue
+                if info is None:
+                    joined.pop(node_id, None)
+                    left.append(node_id)
+                else:
+                    joined[node_id] = info
+                    if node_id in left:
+                        left.remove(node_id)
+            return joined, left, current
+
+    def add_holder(self, file_hash, piece_index, node_id):
+        # Record a new replica of a piece. The metadata file is rewritten by
+        # the flusher, once per batch of updates.
+        piece_index = str(piece_index)
+        with self.lock:
+            metadata = self.load_metadata(file_hash)
+            if metadata is None:
+                return
+            holders = metadata["piece_distribution"].setdefault(piece_index, [])
+            if node_id not in holders:
+                holders.append(node_id)
+            self.index_piece(file_hash, piece_index, node_id)
+            chunks = metadata.get("chunks")
+            if chunks:
+                self.chunks[chunks[int(piece_index)]]["holders"].add(str(node_id))
+            if str(node_id) not in self.file_holders.get(file_hash, ()):
+                self.record(
+                    {"op": "hold", "file_hash": file_hash, "node_id": str(node_id)}
+                )
+            self.pending_metadata[file_hash] = metadata
+            self.flush_condition.notify()
+
+    def add_holders(self, file_hash, piece_indices, node_id):
+        # Record a node as holder of several pieces of one file, as announced
+        # by a downloader. Returns False for unknown files.
+        with self.lock:
+            metadata = self.load_metadata(file_hash)
+            if metadata is None:
+                return False
+            for piece_index in piece_indices:
+                if str(piece_index) in metadata["piece_distribution"]:
+                    self.add_holder(file_hash, piece_index, node_id)
+            return True
+
+    def get_metadata(self, file_hash):
+        with self.lock:
+            return self.load_metadata(file_hash)
+
+    def pieces_held(self, node_id):
+        # (file_hash, piece_index) of every piece a node holds. Files not
+        # indexed yet are read without the lock, which is fine since any
+        # file with changes in memory is indexed already.
+        node_id = str(node_id)
+        with self.lock:
+            unindexed = [
+                file_hash
+                for file_hash, holders in self.file_holders.items()
+                if node_id in holders and file_hash not in self.indexed_files
+            ]
+        for file_hash in unindexed:
+            metadata = self.read_metadata(file_hash)
+            with self.lock:
+                if metadata and file_hash not in self.indexed_files:
+                    self.index_pieces(metadata)
+        with self.lock:
+            return [
+                (file_hash, piece_index)
+                for file_hash, piece_indices in self.node_pieces.get(
+                    node_id, {}
+                ).items()
+                for piece_index in sorted(piece_indices, key=int)
+            ]
+
+    def all_pieces(self):
+        # Every known piece, one file at a time so the cache stays bounded
+        with self.lock:
+            file_hashes = list(self.file_holders)
+        for file_hash in file_hashes:
+            with self.lock:
+                metadata = self.load_metadata(file_hash)
+                piece_indices = list(metadata["piece_distribution"]) if metadata else []
+            for piece_index in piece_indices:
+                yield file_hash, piece_index
+
+    def piece_info(self, file_hash, piece_index):
+        # Return (live holders, all holders, metadata) for one piece
+        with self.lock:
+            metadata = self.load_metadata(file_hash)
+            if metadata is None:
+                return [], [], None
+            chunks = metadata.get("chunks")
+            if chunks:
+                # Shared chunks gain holders through other files too
+                holders = list(self.chunks[chunks[int(piece_index)]]["holders"])
+            else:
+                holders = list(metadata["piece_distribution"].get(str(piece_index), []))
+            live = [n for n in holders if str(n) in self.nodes]
+            return live, holders, metadata
+
+    def piece_key(self, file_hash, piece_index):
+        # (hash, index) a piece is stored under on its holders: chunks of
+        # deduplicated files are stored under their own content hash
+        with self.lock:
+            metadata = self.load_metadata(file_hash)
+            chunks = metadata.get("chunks") if metadata else None
+            if chunks:
+                return chunks[int(piece_index)], 0
+            return file_hash, int(piece_index)
+
+    def find_chunks(self, chunk_hashes):
+        # Live holders of each chunk that is already stored somewhere
+        with self.lock:
+            found = {}
+            for chunk_hash in chunk_hashes:
+                chunk = self.chunks.get(chunk_hash)
+                if chunk is None:
+                    continue
+                live = [n for n in chunk["holders"] if n in self.nodes]
+                if live:
+                    found[chunk_hash] = live
+            return found
+
+    def live_distribution(self, metadata):
+        # A file's distribution without holders that are no longer registered
+        with self.lock:
+            chunks = metadata.get("chunks")
+            if chunks:
+                return {
+                    str(piece_index): [
+                        n for n in self.chunks[chunk_hash]["holders"] if n in self.nodes
+                    ]
+                    for piece_index, chunk_hash in enumerate(chunks)
+                }
+            return {
+                piece_index: [n for n in holders if str(n) in self.nodes]
+                for piece_index, holders in metadata["piece_distribution"].items()
+            }
+
+    def get_file(self, file_name):
+        # Return (file_hash, metadata) for a file name, either may be None
+        with self.lock:
+            file_hash = self.files.get(file_name)
+            return file_hash, self.load_metadata(file_hash)
+
+    def snapshot_state(self):
+        return {
+            "nodes": dict(self.nodes),
+            "files": dict(self.files),
+            "node_counter": self.node_counter,
+            "expiring": list(self.deadlines),
+            "ttls": dict(self.ttls),
+            "holders": {
+                file_hash: sorted(holders)
+                for file_hash, holders in self.file_holders.items()
+            },
+            "chunked": sorted(self.chunked),
+        }
+
+    def write_snapshot(self, state):
+        save_json(self.snapshot_path, state)
+
+    def flush_loop(self):
+        # Drain queued entries to the journal in batches
+        while self.running:
+            with self.lock:
+                if not self.pending and not self.pending_metadata:
+                    self.flush_condition.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        # Write queued metadata files and journal entries, then compact the
+        # journal into a snapshot once it has grown long enough
+        with self.lock:
+            entries, self.pending = self.pending, []
+            pending_metadata, self.pending_metadata = self.pending_metadata, {}
+            # Copy distributions under the lock; repairs keep changing them
+            metadata_list = [
+                dict(
+                    metadata,
+                    piece_distribution={
+                        piece_index: list(holders)
+                        for piece_index, holders in metadata[
+                            "piece_distribution"
+                        ].items()
+                    },
+                )
+                for metadata in pending_metadata.values()
+            ]
+            self.journal_entries += len(entries)
+            state = None
+            if self.journal_entries >= self.snapshot_every:
+                state = self.snapshot_state()
+                self.journal_entries = 0
+        for metadata in metadata_list:
+            # Stored with the distribution in its compact form
+            metadata["piece_layout"] = encode_distribution(
+                metadata.pop("piece_distribution")
+            )
+            save_json(self.metadata_path(metadata["file_hash"]), metadata)
+        if not entries:
+            return
+
+        self.journal.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+        if state is not None:
+            # The snapshot covers everything already applied, including the
+            # entries just written, so the journal can start over
+            self.write_snapshot(state)
+            self.journal.close()
+            self.journal = open(self.journal_path, "w")
+
+    def close(self):
+        # Stop the flusher and persist anything still queued
+        self.running = False
+        with self.lock:
+            self.flush_condition.notify()
+        self.flusher.join()
+        self.flush()
+        self.journal.close()
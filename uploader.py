@@ -0,0 +1,198 @@
+import hashlib
+import queue
+import threading
+
+from function import generate_piece_hash
+
+
+class PieceUploader:
+    def __init__(
+        self,
+        node,
+        staging_id,
+        active_nodes,
+        targets_for,
+        max_workers=4,
+        queue_size=4,
+        hash_executor=None,
+        compress=None,
+    ):
+        self.node = node
+        self.staging_id = staging_id
+        self.active_nodes = active_nodes
+        self.targets_for = targets_for
+        self.max_workers = max_workers
+        self.hash_executor = hash_executor
+        # Returns a future of (compressed payload or None, cpu seconds), or
+        # None when compression is off
+        self.compress = compress
+        # Bounded so a fast disk cannot run ahead of the network: at most
+        # `queue_size` sends are buffered, plus one piece per busy worker
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+
+        self.file_size = 0
+        self.data_pieces = 0
+        self.piece_hashes = []
+        self.piece_distribution = {}
+        # Every node sent a piece, stored or not, so an abandoned upload
+        # can be discarded wherever it may have been staged
+        self.targets = set()
+
+    def worker(self):
+        # Send queued pieces to their targets until told to stop. Items are
+        # (stored under hash, index, distribution key, piece, node, compressed).
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            file_hash, piece_index, record_key, piece, node_id, compressed = item
+            if compressed is not None:
+                try:
+                    compressed, _ = compressed.result()
+                except Exception as e:
+                    # A raw piece is always accepted, so a failed compression
+                    # only costs bandwidth
+                    print(f"Error compressing piece {piece_index}, sending it raw: {e}")
+                    compressed = None
+            sent = self.node.send_piece_upload(
+                node_id,
+                self.active_nodes[node_id],
+                file_hash,
+                piece_index,
+                piece,
+                compressed,
+            )
+            if sent:
+                with self.lock:
+                    self.piece_distribution[record_key].append(node_id)
+
+    def start_compression(self, piece_index, piece):
+        # A future of the compressed piece, or None to send it raw
+        if self.compress is None:
+            return None
+        try:
+            return self.compress(piece)
+        except Exception as e:
+            print(f"Error compressing piece {piece_index}, sending it raw: {e}")
+            return None
+
+    def send(self, piece_index, piece, piece_hashes):
+        # Hash a piece and queue it for each of its targets
+        if self.hash_executor is not None:
+            piece_hashes[piece_index] = self.hash_executor.submit(
+                generate_piece_hash, piece
+            )
+        else:
+            piece_hashes[piece_index] = generate_piece_hash(piece)
+        self.piece_distribution[piece_index] = []
+        # Compressed once, however many targets the piece goes to
+        compressed = self.start_compression(piece_index, piece)
+        for node_id in self.targets_for(piece_index):
+            self.targets.add(node_id)
+            self.queue.put(
+                (self.staging_id, piece_index, piece_index, piece, node_id, compressed)
+            )
+
+    def start_workers(self):
+        workers = [
+            threading.Thread(target=self.worker) for _ in range(self.max_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def stop_workers(self, workers):
+        for _ in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def run(self, pieces, encoder=None):
+        # Hash and send every piece in a single pass, returning the file hash.
+        # With an erasure encoder, each group's parity pieces are sent as
+        # soon as the group is complete.
+        workers = self.start_workers()
+        file_hasher = hashlib.sha1()
+        piece_hashes = {}
+        try:
+            for piece_index, piece in enumerate(pieces):
+                # The whole-file hash is inherently sequential; piece hashes
+                # are computed on the hashing pool alongside it
+                file_hasher.update(piece)
+                self.file_size += len(piece)
+                self.data_pieces += 1
+                self.send(piece_index, piece, piece_hashes)
+                if encoder is not None:
+                    for parity_index, parity in encoder.add(piece_index, piece):
+                        self.send(parity_index, parity, piece_hashes)
+        finally:
+            self.stop_workers(workers)
+        self.piece_hashes = [
+            h if isinstance(h, str) else h.result()
+            for _, h in sorted(piece_hashes.items())
+        ]
+        return file_hasher.hexdigest()
+
+
+class ChunkUploader(PieceUploader):
+    # Uploads a file as content-addressed chunks, each stored under its own
+    # hash. Chunks the tracker already knows about, or that appeared earlier
+    # in the same file, are not sent again.
+    def __init__(self, node, active_nodes, targets_for, find_chunks, **options):
+        super().__init__(node, None, active_nodes, targets_for, **options)
+        # Returns {chunk_hash: [holders]} for the chunks already stored
+        self.find_chunks = find_chunks
+        # Chunks looked up in one tracker request
+        self.batch_size = 16
+        self.chunk_sizes = []
+        # chunk_hash -> node ids holding it, new and existing chunks alike
+        self.piece_distribution = {}
+        self.sent_bytes = 0
+        self.reused_bytes = 0
+
+    def send_batch(self, batch):
+        hashes = [h if isinstance(h, str) else h.result() for h, _ in batch]
+        existing = self.find_chunks(
+            [h for h in hashes if h not in self.piece_distribution]
+        )
+        for chunk_hash, (_, chunk) in zip(hashes, batch):
+            self.piece_hashes.append(chunk_hash)
+            self.chunk_sizes.append(len(chunk))
+            if chunk_hash in self.piece_distribution:
+                self.reused_bytes += len(chunk)
+                continue
+            if chunk_hash in existing:
+                self.piece_distribution[chunk_hash] = existing[chunk_hash]
+                self.reused_bytes += len(chunk)
+                continue
+            self.piece_distribution[chunk_hash] = []
+            self.sent_bytes += len(chunk)
+            compressed = self.start_compression(0, chunk)
+            for node_id in self.targets_for(chunk_hash):
+                self.queue.put((chunk_hash, 0, chunk_hash, chunk, node_id, compressed))
+
+    def run(self, chunks):
+        # Hash every chunk, ask the tracker about each batch and send the new
+        # ones, returning the file hash
+        workers = self.start_workers()
+        file_hasher = hashlib.sha1()
+        batch = []
+        try:
+            for chunk in chunks:
+                file_hasher.update(chunk)
+                self.file_size += len(chunk)
+                self.data_pieces += 1
+                if self.hash_executor is not None:
+                    chunk_hash = self.hash_executor.submit(generate_piece_hash, chunk)
+                else:
+                    chunk_hash = generate_piece_hash(chunk)
+                batch.append((chunk_hash, chunk))
+                if len(batch) >= self.batch_size:
+                    self.send_batch(batch)
+                    batch = []
+            if batch:
+                self.send_batch(batch)
+        finally:
+            self.stop_workers(workers)
+        return file_hasher.hexdigest()
@@ -0,0 +1,24 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from function import generate_piece_hash
+
+
+def create_hash_executor(workers=None):
+    # hashlib releases the GIL while hashing large buffers, so a thread
+    # pool hashes pieces on several cores at once
+    return ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+
+class PieceVerifier:
+    def __init__(self, piece_hashes, executor):
+        self.piece_hashes = piece_hashes
+        self.executor = executor
+
+    def check(self, piece_index, piece_data):
+        return generate_piece_hash(piece_data) == self.piece_hashes[piece_index]
+
+    def submit(self, piece_index, piece_data):
+        # Hash a piece on the worker pool; the future resolves to whether it
+        # matches the hash recorded at upload
+        return self.executor.submit(self.check, piece_index, piece_data)